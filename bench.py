@@ -0,0 +1,295 @@
+"""
+Benchmarks for the PFSS hot paths: access checks, allow-list filtering,
+listing pages and downloads.
+
+Every scenario builds a synthetic share in a temporary directory, loads a
+fresh copy of main.py pointed at it (SHARE_DIR, see harness.py) and times the code through
+plain calls or the Flask test client. Results are ops/sec plus p50/p99
+latency per operation.
+
+    python bench.py                          # run everything, print a table
+    python bench.py --quick                  # small trees only
+    python bench.py --save baseline.json     # record a baseline
+    python bench.py --compare baseline.json  # exit 1 on regressions
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+
+import harness
+
+PASSWORD = "bench"
+SEED = 1337
+
+
+# ---------------- Synthetic trees ----------------
+def write_file(path, size=64):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(b"x" * size)
+
+
+def build_flat(root, n, rng):
+    """``n`` files in the share root and ``n`` in one subfolder, allow-list of literals."""
+    names = [f"file-{i:06d}.txt" for i in range(n)]
+    for name in names:
+        write_file(os.path.join(root, name))
+        write_file(os.path.join(root, "sub", name))
+    allowed = rng.sample(names, max(1, n // 2))
+    rules = sorted(allowed) + ["sub/"]
+    return rules, names
+
+
+def build_deep(root, depth, fanout, rng):
+    """A chain of ``depth`` nested folders with ``fanout`` files at every level."""
+    names = []
+    parts = []
+    for level in range(depth):
+        parts.append(f"level-{level:02d}")
+        for i in range(fanout):
+            rel = "/".join(parts + [f"file-{i:04d}.txt"])
+            write_file(os.path.join(root, rel))
+            names.append(rel)
+    rules = ["level-00/", "!level-00/level-01/*.tmp", "**/file-0000.txt"]
+    return rules, names
+
+
+def build_large_rules(root, n, rng):
+    """A small tree guarded by an ``n``-line allow-list mixing literals and globs."""
+    names = [f"file-{i:06d}.txt" for i in range(1000)]
+    for name in names:
+        write_file(os.path.join(root, name))
+        write_file(os.path.join(root, "sub", name))
+    rules = []
+    for i in range(n):
+        kind = i % 4
+        if kind == 0:
+            rules.append(f"file-{rng.randrange(10 ** 6):06d}.txt")
+        elif kind == 1:
+            rules.append(f"dir-{i}/")
+        elif kind == 2:
+            rules.append(f"dir-{i}/*.log")
+        else:
+            rules.append(f"!file-{rng.randrange(10 ** 6):06d}.txt")
+    rules += ["*.txt", "sub/"]
+    return rules, names
+
+
+def build_wildcard_rules(root, n, rng):
+    """Like build_large_rules, but every rule is an unanchored wildcard matched at any depth."""
+    names = [f"file-{i:06d}.txt" for i in range(1000)]
+    for name in names:
+        write_file(os.path.join(root, name))
+        write_file(os.path.join(root, "sub", name))
+    rules = []
+    for i in range(n):
+        kind = i % 4
+        if kind == 0:
+            rules.append(f"file-{rng.randrange(10 ** 6):06d}*")
+        elif kind == 1:
+            rules.append(f"*-{i}.log")
+        elif kind == 2:
+            rules.append(f"build-{i}-*.tar.[gx]z")
+        else:
+            rules.append(f"!cache-?{i}")
+    rules += ["*.txt", "sub/"]
+    return rules, names
+
+
+# ---------------- Harness ----------------
+def load_server(root, rules):
+    return harness.load_server(root, rules, PASSWORD)
+
+
+def login(module):
+    return harness.login(module, PASSWORD)
+
+
+def percentile(samples, q):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def measure(fn, min_time, batch=1):
+    """
+    Call ``fn`` in batches of ``batch`` until ``min_time`` seconds have
+    passed. Each batch yields one per-operation latency sample; cheap
+    operations use large batches so timer overhead stays out of the result.
+    """
+    fn()  # warm-up: caches, compiled rules, template bytecode
+    samples = []
+    ops = 0
+    started = time.perf_counter()
+    while True:
+        t0 = time.perf_counter()
+        for _ in range(batch):
+            fn()
+        t1 = time.perf_counter()
+        samples.append((t1 - t0) / batch)
+        ops += batch
+        if t1 - started >= min_time and len(samples) >= 5:
+            break
+    elapsed = time.perf_counter() - started
+    return {
+        "ops_per_sec": ops / elapsed,
+        "p50_us": percentile(samples, 0.50) * 1e6,
+        "p99_us": percentile(samples, 0.99) * 1e6,
+        "samples": len(samples),
+    }
+
+
+def fetch(client, url):
+    response = client.get(url, buffered=True)
+    body = response.get_data()
+    response.close()
+    if response.status_code != 200:
+        raise RuntimeError(f"GET {url} returned {response.status_code}")
+    return len(body)
+
+
+def bench_scenario(name, module, names, rng, min_time, results):
+    paths = [rng.choice(names) for _ in range(1000)]
+    paths += [f"missing-{i}.txt" for i in range(250)]
+    rng.shuffle(paths)
+    cursor = [0]
+
+    def check_one():
+        cursor[0] = (cursor[0] + 1) % len(paths)
+        module.is_allowed(paths[cursor[0]])
+
+    results[f"{name}/is_allowed"] = measure(check_one, min_time, batch=1000)
+
+    deepest = max((os.path.dirname(n) for n in names), key=lambda p: p.count("/"))
+    with os.scandir(os.path.join(module.BASE_DIR, deepest)) as it:
+        entries = [{"name": e.name, "type": module.entry_type(e)} for e in it]
+    results[f"{name}/filter_allowed_items"] = measure(
+        lambda: module.filter_allowed_items(entries, parent_path=deepest), min_time)
+
+    client = login(module)
+    results[f"{name}/list_root"] = measure(lambda: fetch(client, "/list"), min_time)
+
+    def cold_list():
+        module.LISTING_CACHE.invalidate()
+        fetch(client, "/list")
+
+    results[f"{name}/list_root_cold"] = measure(cold_list, min_time)
+    sub = "sub" if os.path.isdir(os.path.join(module.BASE_DIR, "sub")) else names[0].split("/")[0]
+    results[f"{name}/list_sub"] = measure(lambda: fetch(client, f"/list/{sub}"), min_time)
+
+
+def bench_downloads(root, module, size_mb, min_time, results):
+    with open(os.path.join(root, "payload.bin"), "wb") as f:
+        f.write(os.urandom(1024 * 1024) * size_mb)
+    client = login(module)
+    stats = measure(lambda: fetch(client, "/download/payload.bin"), min_time)
+    stats["mb_per_sec"] = stats["ops_per_sec"] * size_mb
+    results[f"download/{size_mb}MiB"] = stats
+    results["download/small"] = measure(lambda: fetch(client, "/download/small.txt"), min_time)
+
+
+def run(args):
+    sizes = [10, 1000] if args.quick else [10, 1000, 100000]
+    scenarios = [(f"flat-{n}", build_flat, (n,)) for n in sizes]
+    scenarios.append(("deep-20", build_deep, (20, 50)))
+    scenarios.append((f"rules-{2000 if args.quick else 20000}", build_large_rules,
+                      (2000 if args.quick else 20000,)))
+    scenarios.append((f"globs-{2000 if args.quick else 20000}", build_wildcard_rules,
+                      (2000 if args.quick else 20000,)))
+    if args.only:
+        scenarios = [s for s in scenarios if any(key in s[0] for key in args.only)]
+
+    results = {}
+    workdir = tempfile.mkdtemp(prefix="pfss-bench-")
+    try:
+        for name, build, build_args in scenarios:
+            root = os.path.join(workdir, name)
+            os.makedirs(root)
+            # Seeded per scenario so --only picks the same trees as a full run
+            rng = random.Random(f"{SEED}-{name}")
+            t0 = time.perf_counter()
+            rules, names = build(root, *build_args, rng)
+            module = load_server(root, rules)
+            print(f"{name}: {len(names)} files, {len(rules)} rules "
+                  f"(built in {time.perf_counter() - t0:.1f}s)", file=sys.stderr)
+            bench_scenario(name, module, names, rng, args.min_time, results)
+
+        if not args.only or any("download" in key for key in args.only):
+            root = os.path.join(workdir, "download")
+            os.makedirs(root)
+            write_file(os.path.join(root, "small.txt"), 4096)
+            module = load_server(root, ["payload.bin", "small.txt"])
+            bench_downloads(root, module, 4 if args.quick else 64, args.min_time, results)
+    finally:
+        if args.keep:
+            print(f"Trees kept in {workdir}", file=sys.stderr)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+# ---------------- Reporting ----------------
+def print_table(results, baseline=None):
+    header = f"{'benchmark':<34} {'ops/sec':>12} {'p50 us':>10} {'p99 us':>10}"
+    if baseline is not None:
+        header += f" {'vs base':>9}"
+    print(header)
+    print("-" * len(header))
+    for key, stats in results.items():
+        line = f"{key:<34} {stats['ops_per_sec']:>12.1f} {stats['p50_us']:>10.1f} {stats['p99_us']:>10.1f}"
+        if baseline is not None and key in baseline:
+            line += f" {stats['ops_per_sec'] / baseline[key]['ops_per_sec'] - 1:>+9.1%}"
+        if "mb_per_sec" in stats:
+            line += f"  ({stats['mb_per_sec']:.0f} MiB/s)"
+        print(line)
+
+
+def regressions(results, baseline, tolerance):
+    found = []
+    for key, stats in results.items():
+        base = baseline.get(key)
+        if base is None:
+            continue
+        if stats["ops_per_sec"] < base["ops_per_sec"] * (1 - tolerance):
+            found.append(f"{key}: {stats['ops_per_sec']:.1f} ops/sec vs {base['ops_per_sec']:.1f} baseline")
+    return found
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--quick", action="store_true", help="small trees and payloads only")
+    parser.add_argument("--only", nargs="*", help="run scenarios whose name contains any of these")
+    parser.add_argument("--min-time", type=float, default=1.0, help="seconds per benchmark")
+    parser.add_argument("--save", metavar="FILE", help="write results as a JSON baseline")
+    parser.add_argument("--compare", metavar="FILE", help="baseline JSON to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="allowed ops/sec drop before a result counts as a regression")
+    parser.add_argument("--keep", action="store_true", help="keep the generated trees")
+    args = parser.parse_args(argv)
+
+    results = run(args)
+    baseline = None
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)["results"]
+    print_table(results, baseline)
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump({"python": sys.version.split()[0], "created": time.time(), "results": results},
+                      f, indent=2, sort_keys=True)
+    if baseline is not None:
+        found = regressions(results, baseline, args.tolerance)
+        for line in found:
+            print(f"REGRESSION {line}")
+        return 1 if found else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
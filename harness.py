@@ -0,0 +1,104 @@
+"""
+Shared scaffolding for bench.py and the test modules: load a private copy
+of main.py pointed at a throwaway share, log a client in, and run the
+``serve`` launcher as a subprocess.
+"""
+
+import os
+import sys
+import time
+import socket
+import tempfile
+import subprocess
+import contextlib
+import importlib.util
+
+MAIN_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+
+
+def server_env(root, password, **env):
+    """SHARE_* settings for a share at ``root``; ``env`` overrides the defaults."""
+    return {
+        "SHARE_DIR": str(root),
+        "SHARE_PW": password,
+        "SHARE_LOGIN_RATE": "0",
+        "SHARE_LOGIN_GLOBAL_RATE": "0",
+        "SHARE_CACHE_DIR": os.path.join(root, ".cache"),
+        "SHARE_DOWNLOAD_MODE": "python",
+        **env,
+    }
+
+
+def write_rules(root, rules):
+    with open(os.path.join(root, "allowed_files.txt"), "w", encoding="utf-8") as f:
+        f.write("\n".join(rules) + "\n")
+
+
+def load_server(root, rules, password, **env):
+    """
+    Import a private copy of main.py serving ``root`` with ``rules`` as its
+    allowed_files.txt. main.py reads its configuration at import time, so
+    the environment is only patched while the module loads.
+    """
+    write_rules(root, rules)
+    settings = server_env(root, password, **env)
+    saved = {key: os.environ.get(key) for key in settings}
+    os.environ.update(settings)
+    try:
+        name = f"pfss_{abs(hash((str(root), tuple(sorted(settings.items())))))}"
+        spec = importlib.util.spec_from_file_location(name, MAIN_PATH)
+        module = importlib.util.module_from_spec(spec)
+        with contextlib.redirect_stdout(open(os.devnull, "w")):
+            spec.loader.exec_module(module)
+            module.ACCESS_INDEX.reload(force=True)
+    finally:
+        for key, value in saved.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+    return module
+
+
+def login(module, password, **data):
+    client = module.app.test_client()
+    client.post("/", data={"pw": password, **data})
+    return client
+
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+@contextlib.contextmanager
+def launcher(root, password, *args, **env):
+    """
+    Run ``main.py serve`` on a free port for the duration of the block and
+    yield (process, port). ``args`` are extra serve options.
+    """
+    port = free_port()
+    log = tempfile.TemporaryFile()
+    process = subprocess.Popen(
+        [sys.executable, MAIN_PATH, "serve", "--host", "127.0.0.1", "--port", str(port), *args],
+        env=dict(os.environ, **server_env(root, password, **{"SHARE_SEARCH": "0", **env})),
+        stdout=log, stderr=subprocess.STDOUT)
+    try:
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=1).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline or process.poll() is not None:
+                    log.seek(0)
+                    raise RuntimeError("serve did not start:\n"
+                                       + log.read().decode(errors="replace")[-2000:])
+                time.sleep(0.1)
+        yield process, port
+    finally:
+        if process.poll() is None:
+            process.terminate()
+        process.wait(timeout=30)
+        log.close()
@@ -8,16 +8,190 @@ Modern Flask File Sharing App
 """
 
 import os
+import re
+import sys
+import errno
+import signal
+import socket
+import argparse
+import getpass
+import traceback
+import json
+import stat
+import time
+import base64
+import codecs
+import hashlib
+import hmac
+import ctypes
+import ctypes.util
+import mmap
+import struct
+import secrets
+import heapq
+import sqlite3
+import unicodedata
 import mimetypes
-from flask import Flask, request, session, redirect, url_for, send_from_directory, abort, render_template_string
+import tarfile
+import tempfile
+import threading
+import zipfile
+import io
+import zlib
+import fcntl
+import shutil
+import contextlib
+import configparser
+import asyncio
+import contextvars
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from urllib.parse import quote
+from flask import (Flask, Response, request, session, redirect, url_for, abort, g,
+                   has_request_context, render_template, stream_with_context, jsonify)
+from flask.sessions import SessionInterface, SessionMixin
+from werkzeug.datastructures import CallbackDict
 from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+from werkzeug.wsgi import LimitedStream
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import argon2
+except ImportError:
+    argon2 = None
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
 
 # ---------------- Configuration ----------------
-BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+# Shared directory; defaults to the directory holding this script
+BASE_DIR = os.path.realpath(os.environ.get("SHARE_DIR") or os.path.dirname(os.path.abspath(__file__)))
 PASSWORD = os.environ.get("SHARE_PW", "changeme")
-PASSWORD_HASH = generate_password_hash(PASSWORD)
+# Precomputed hash (see `main.py hash-password`); skips hashing SHARE_PW at startup
+PASSWORD_HASH = os.environ.get("SHARE_PW_HASH", "")
+# scrypt[:n:r:p] | pbkdf2[:sha256[:iterations]] | argon2[:time:memory_kib:parallelism]
+PASSWORD_METHOD = os.environ.get("SHARE_PW_METHOD", "scrypt")
+API_TOKENS = os.environ.get("SHARE_API_TOKENS", "")
+API_TOKENS_FILE = os.environ.get("SHARE_API_TOKENS_FILE", "")
+# INI file of [user:<name>] / [group:<name>] sections with per-user rules; unset = shared password only
+USERS_FILE = os.environ.get("SHARE_USERS_FILE", "")
 SECRET_KEY = os.environ.get("FLASK_SECRET") or os.urandom(24)
 ALLOWED_FILES_CONFIG = os.path.join(BASE_DIR, "allowed_files.txt")
+ACL_CHECK_INTERVAL = float(os.environ.get("SHARE_ACL_CHECK_INTERVAL", "1.0"))
+LISTING_CACHE_SIZE = int(os.environ.get("SHARE_LISTING_CACHE_SIZE", "256"))
+LISTING_CACHE_TTL = float(os.environ.get("SHARE_LISTING_CACHE_TTL", "2.0"))
+LISTING_PAGE_SIZE = int(os.environ.get("SHARE_LISTING_PAGE_SIZE", "500"))
+LISTING_MAX_PAGE_SIZE = int(os.environ.get("SHARE_LISTING_MAX_PAGE_SIZE", "5000"))
+STREAM_BUFFER_EVENTS = int(os.environ.get("SHARE_STREAM_BUFFER_EVENTS", "256"))
+PREVIEW_MAX_BYTES = int(os.environ.get("SHARE_PREVIEW_MAX_BYTES", str(256 * 1024)))
+PREVIEW_CHUNK_SIZE = 64 * 1024
+DEFAULT_CACHE_CONTROL = os.environ.get("SHARE_CACHE_CONTROL", "private, no-cache")
+TRANSFER_CHUNK_SIZE = 256 * 1024
+MAX_RANGES = 16
+# python | sendfile | x-accel-redirect | x-sendfile
+DOWNLOAD_MODE = os.environ.get("SHARE_DOWNLOAD_MODE", "python").lower()
+ACCEL_REDIRECT_PREFIX = os.environ.get("SHARE_ACCEL_PREFIX", "/protected/")
+# Sessions, upload state, the metadata index and cached derivatives; must not be writable by other users
+CACHE_DIR = os.environ.get("SHARE_CACHE_DIR") or os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"), "pfss")
+COMPRESSION_ENABLED = os.environ.get("SHARE_COMPRESSION", "1") != "0"
+COMPRESS_LEVEL = int(os.environ.get("SHARE_COMPRESS_LEVEL", "6"))
+COMPRESS_MIN_SIZE = 1024
+COMPRESS_MAX_FILE_SIZE = int(os.environ.get("SHARE_COMPRESS_MAX_FILE_SIZE", str(64 * 1024 * 1024)))
+COMPRESS_CACHE_MAX_BYTES = int(os.environ.get("SHARE_COMPRESS_CACHE_MAX_BYTES", str(1024 * 1024 * 1024)))
+MIME_CACHE_SIZE = int(os.environ.get("SHARE_MIME_CACHE_SIZE", "8192"))
+ASGI_THREADS = int(os.environ.get("SHARE_ASGI_THREADS", "32"))
+METRICS_ENABLED = os.environ.get("SHARE_METRICS", "0") == "1"
+INDEX_ENABLED = os.environ.get("SHARE_INDEX", "1") != "0"
+INDEX_DB = os.environ.get("SHARE_INDEX_DB") or os.path.join(CACHE_DIR, "metadata.sqlite3")
+INDEX_INTERVAL = float(os.environ.get("SHARE_INDEX_INTERVAL", "60"))
+HASH_WORKERS = int(os.environ.get("SHARE_HASH_WORKERS", "2"))
+# Deepest path (in segments) that routes, archives and the indexer will follow
+MAX_DEPTH = int(os.environ.get("SHARE_MAX_DEPTH", "32"))
+SEARCH_ENABLED = os.environ.get("SHARE_SEARCH", "1") != "0"
+# Full rebuild interval where inotify is unavailable
+SEARCH_REFRESH = float(os.environ.get("SHARE_SEARCH_REFRESH", "300"))
+SEARCH_LIMIT = 50
+SEARCH_MAX_LIMIT = 1000
+# "<attempts>/<seconds>"; "0" disables the limit
+LOGIN_RATE = os.environ.get("SHARE_LOGIN_RATE", "10/60")
+LOGIN_GLOBAL_RATE = os.environ.get("SHARE_LOGIN_GLOBAL_RATE", "100/60")
+# Per-client download bandwidth in bytes/second; 0 disables the cap
+DOWNLOAD_RATE = int(os.environ.get("SHARE_DOWNLOAD_RATE", "0"))
+DOWNLOAD_BURST = int(os.environ.get("SHARE_DOWNLOAD_BURST", str(4 * 1024 * 1024)))
+# Thumbnails and resized image previews (needs Pillow)
+THUMBNAILS_ENABLED = os.environ.get("SHARE_THUMBNAILS", "1") != "0"
+THUMB_SIZE = int(os.environ.get("SHARE_THUMB_SIZE", "256"))
+PREVIEW_IMAGE_SIZE = int(os.environ.get("SHARE_PREVIEW_IMAGE_SIZE", "1600"))
+# Images up to this size are shown as they are
+PREVIEW_IMAGE_MIN_BYTES = int(os.environ.get("SHARE_PREVIEW_IMAGE_MIN_BYTES", str(512 * 1024)))
+THUMB_WORKERS = int(os.environ.get("SHARE_THUMB_WORKERS", "2"))
+THUMB_CACHE_MAX_BYTES = int(os.environ.get("SHARE_THUMB_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+UPLOADS_ENABLED = os.environ.get("SHARE_UPLOADS", "0") == "1"
+UPLOAD_DIR = os.environ.get("SHARE_UPLOAD_DIR") or os.path.join(CACHE_DIR, "uploads")
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+UPLOAD_MAX_CHUNK_SIZE = int(os.environ.get("SHARE_UPLOAD_MAX_CHUNK_SIZE", str(64 * 1024 * 1024)))
+# Largest accepted file in bytes; 0 means no limit
+UPLOAD_MAX_SIZE = int(os.environ.get("SHARE_UPLOAD_MAX_SIZE", "0"))
+# Uploads with no chunk for this many seconds are discarded
+UPLOAD_TTL = float(os.environ.get("SHARE_UPLOAD_TTL", str(24 * 3600)))
+# Let clients ask for an existing file to be replaced ("overwrite": true)
+UPLOAD_OVERWRITE = os.environ.get("SHARE_UPLOAD_OVERWRITE", "0") == "1"
+UPLOAD_PART_PREFIX = ".pfss-upload-"
+# sqlite (shared by all worker processes) | memory (this process only)
+SESSION_BACKEND = os.environ.get("SHARE_SESSION_BACKEND", "sqlite").lower()
+SESSION_DB = os.environ.get("SHARE_SESSION_DB") or os.path.join(CACHE_DIR, "sessions.sqlite3")
+# Idle lifetime of a login session in seconds
+SESSION_TTL = float(os.environ.get("SHARE_SESSION_TTL", str(12 * 3600)))
+SESSION_SWEEP_INTERVAL = 300
+# Pre-fork launcher: children exiting within RESPAWN_FAST_EXIT seconds of
+# starting are restarted after a delay that doubles up to RESPAWN_MAX_DELAY
+RESPAWN_FAST_EXIT = 2.0
+RESPAWN_MIN_DELAY = 0.5
+RESPAWN_MAX_DELAY = 30.0
+# ------------------------------------------------
+
+# ---------------- State Directories ----------------
+def private_dir(path):
+    """
+    Create ``path`` (mode 0700) if it is missing and refuse to start unless
+    it belongs to this user and nobody else can write to it. A directory
+    planted by another local user would let them forge session rows or
+    swap cached files.
+    """
+    try:
+        os.makedirs(path, mode=0o700, exist_ok=True)
+        st = os.stat(path)
+    except OSError as e:
+        sys.exit(f"ERROR: cannot create state directory {path}: {e}")
+    if st.st_uid != os.getuid() or st.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        sys.exit(f"ERROR: {path} is owned by uid {st.st_uid} with mode {stat.S_IMODE(st.st_mode):o}; "
+                 f"it must be owned by uid {os.getuid()} and not writable by group or others")
+    return path
+
+
+private_dir(CACHE_DIR)
+if SESSION_BACKEND != "memory":
+    private_dir(os.path.dirname(os.path.abspath(SESSION_DB)))
+if UPLOADS_ENABLED:
+    private_dir(UPLOAD_DIR)
+if INDEX_ENABLED:
+    private_dir(os.path.dirname(os.path.abspath(INDEX_DB)))
 # ------------------------------------------------
 
 app = Flask(__name__)
@@ -25,7 +199,6 @@ app.secret_key = SECRET_KEY
 
 # Minimalist Router-Style CSS
 COMMON_STYLE = """
-<style>
     * {
         margin: 0;
         padding: 0;
@@ -92,7 +265,7 @@ COMMON_STYLE = """
         padding: 15px;
     }
 
-    input[type="password"] {
+    input[type="password"], input[type="text"] {
         width: 100%;
         padding: 8px;
         border: 1px solid #000000;
@@ -100,7 +273,7 @@ COMMON_STYLE = """
         font-family: Arial, sans-serif;
     }
 
-    input[type="password"]:focus {
+    input[type="password"]:focus, input[type="text"]:focus {
         outline: 2px solid #000000;
     }
 
@@ -155,6 +328,15 @@ COMMON_STYLE = """
         border-bottom: 2px solid #000000;
     }
 
+    .breadcrumbs {
+        margin-bottom: 15px;
+        font-size: 13px;
+    }
+
+    .breadcrumbs .back-link {
+        margin-bottom: 0;
+    }
+
     table {
         width: 100%;
         border-collapse: collapse;
@@ -194,6 +376,52 @@ COMMON_STYLE = """
         text-decoration: none;
     }
 
+    th a.sort-link {
+        color: #000000;
+        text-decoration: none;
+    }
+
+    th a.sort-link:hover {
+        text-decoration: underline;
+    }
+
+    code.digest {
+        font-size: 12px;
+        color: #555555;
+    }
+
+    img.thumb {
+        width: 48px;
+        height: 48px;
+        object-fit: cover;
+        vertical-align: middle;
+        margin-right: 8px;
+        border: 1px solid #000000;
+    }
+
+    .search-form {
+        display: flex;
+        gap: 8px;
+        margin-bottom: 15px;
+    }
+
+    input[type="search"] {
+        flex: 1;
+        padding: 8px;
+        border: 1px solid #000000;
+        font-size: 14px;
+        font-family: Arial, sans-serif;
+    }
+
+    .pager {
+        margin-top: 15px;
+        font-size: 13px;
+    }
+
+    .pager .btn {
+        margin-right: 8px;
+    }
+
     .empty-state {
         text-align: center;
         padding: 40px 20px;
@@ -264,7 +492,6 @@ COMMON_STYLE = """
             padding: 8px 5px;
         }
     }
-</style>
 """
 
 LOGIN_HTML = """
@@ -274,7 +501,7 @@ LOGIN_HTML = """
     <meta charset="UTF-8">
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
     <title>Login - File Share</title>
-    """ + COMMON_STYLE + """
+    <link rel="stylesheet" href="{{ style_url }}">
 </head>
 <body>
     <div class="header-bar">
@@ -288,6 +515,12 @@ LOGIN_HTML = """
                 <div class="error">{{ error }}</div>
                 {% endif %}
                 <form method="post">
+                    {% if users_enabled %}
+                    <div class="form-group">
+                        <label>Username (leave empty for the shared password):</label>
+                        <input type="text" name="user" autocomplete="username">
+                    </div>
+                    {% endif %}
                     <div class="form-group">
                         <label>Password:</label>
                         <input type="password" name="pw" required autofocus>
@@ -308,7 +541,7 @@ LIST_HTML = """
     <meta charset="UTF-8">
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
     <title>Polydevs File Sharing System - PFSS</title>
-    """ + COMMON_STYLE + """
+    <link rel="stylesheet" href="{{ style_url }}">
 </head>
 <body>
     <div class="header-bar">
@@ -326,33 +559,51 @@ LIST_HTML = """
             <div class="section-header">Directory Listing</div>
             <div class="section-content">
                 <div class="path">{{ base_dir }}</div>
+                {% if search_enabled %}
+                <form action="{{ url_for('search') }}" class="search-form">
+                    <input type="search" name="q" placeholder="Search file names">
+                    <button type="submit">Search</button>
+                </form>
+                {% endif %}
 
                 {% if items %}
                 <table>
                     <thead>
                         <tr>
-                            <th>Name</th>
+                            <th><a href="{{ pager.sort_urls.name }}" class="sort-link">Name{% if pager.sort == 'name' %} {{ '&#9650;'|safe if pager.order == 'asc' else '&#9660;'|safe }}{% endif %}</a></th>
                             <th>Type</th>
+                            <th><a href="{{ pager.sort_urls.size }}" class="sort-link">Size{% if pager.sort == 'size' %} {{ '&#9650;'|safe if pager.order == 'asc' else '&#9660;'|safe }}{% endif %}</a></th>
+                            <th><a href="{{ pager.sort_urls.mtime }}" class="sort-link">Modified{% if pager.sort == 'mtime' %} {{ '&#9650;'|safe if pager.order == 'asc' else '&#9660;'|safe }}{% endif %}</a></th>
+                            <th>SHA-256</th>
                             <th>Actions</th>
                         </tr>
                     </thead>
                     <tbody>
                         {% for it in items %}
                         <tr>
-                            <td>{{ it.name }}</td>
+                            <td>{% if it.type == 'File' and it.name is thumbnailable %}<img src="{{ url_for('thumbnail', filename=it.name) }}" class="thumb" loading="lazy" decoding="async" alt="">{% endif %}{{ it.name }}</td>
                             <td>{{ it.type }}</td>
+                            <td>{{ it.size|filesizeformat if it.size is not none else '-' }}</td>
+                            <td>{{ it.mtime|mtime }}</td>
+                            <td>{% if it.sha256 %}<code class="digest" title="{{ it.sha256 }}">{{ it.sha256[:12] }}</code>{% else %}-{% endif %}</td>
                             <td>
                                 {% if it.type == 'File' %}
                                     <a href="{{ url_for('view_file', filename=it.name) }}" class="action-link">View</a>
                                     <a href="{{ url_for('download_file', filename=it.name) }}" class="action-link">Download</a>
                                 {% elif it.type == 'Folder' %}
                                     <a href="{{ url_for('list_sub', name=it.name) }}" class="action-link">Open</a>
+                                    <a href="{{ url_for('download_folder', name=it.name) }}" class="action-link">Download ZIP</a>
                                 {% endif %}
                             </td>
                         </tr>
                         {% endfor %}
                     </tbody>
                 </table>
+                <div class="pager">
+                    {% if pager.first_url %}<a href="{{ pager.first_url }}" class="btn">&laquo; First page</a>{% endif %}
+                    {% if pager.next_url %}<a href="{{ pager.next_url }}" class="btn">Next page &raquo;</a>{% endif %}
+                    {{ items|length }} of {{ pager.total }} items
+                </div>
                 {% else %}
                 <div class="empty-state">No files found</div>
                 {% endif %}
@@ -363,6 +614,70 @@ LIST_HTML = """
 </html>
 """
 
+SEARCH_HTML = """
+<!doctype html>
+<html lang="en">
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>Search - Polydevs File Sharing System - PFSS</title>
+    <link rel="stylesheet" href="{{ style_url }}">
+</head>
+<body>
+    <div class="header-bar">
+        <h1>Polydevs File Sharing System - PFSS - Search</h1>
+        <a href="{{ url_for('logout') }}" class="logout">Logout</a>
+    </div>
+    <div class="container">
+        <a href="{{ url_for('list_root') }}" class="back-link">&laquo; Back to root directory</a>
+
+        <div class="section">
+            <div class="section-header">Search</div>
+            <div class="section-content">
+                <form action="{{ url_for('search') }}" class="search-form">
+                    <input type="search" name="q" value="{{ query }}" placeholder="Search file names" autofocus>
+                    <button type="submit">Search</button>
+                </form>
+                {% if not ready %}
+                <div class="warning-banner">The search index is still being built; results may be incomplete.</div>
+                {% endif %}
+                {% if results %}
+                <table>
+                    <thead>
+                        <tr>
+                            <th>Path</th>
+                            <th>Type</th>
+                            <th>Actions</th>
+                        </tr>
+                    </thead>
+                    <tbody>
+                        {% for path, kind in results %}
+                        <tr>
+                            <td>{{ path }}</td>
+                            <td>{{ kind }}</td>
+                            <td>
+                                {% if kind == 'File' %}
+                                    <a href="{{ url_for('view_file', filename=path) }}" class="action-link">View</a>
+                                    <a href="{{ url_for('download_file', filename=path) }}" class="action-link">Download</a>
+                                {% elif kind == 'Folder' %}
+                                    <a href="{{ url_for('list_sub', name=path) }}" class="action-link">Open</a>
+                                {% endif %}
+                            </td>
+                        </tr>
+                        {% endfor %}
+                    </tbody>
+                </table>
+                <div class="pager">{{ results|length }} of {{ total }} matches ({{ '%.1f'|format(elapsed_ms) }} ms)</div>
+                {% elif query %}
+                <div class="empty-state">No files match "{{ query }}"</div>
+                {% endif %}
+            </div>
+        </div>
+    </div>
+</body>
+</html>
+"""
+
 DIR_LIST_HTML = """
 <!doctype html>
 <html lang="en">
@@ -370,7 +685,7 @@ DIR_LIST_HTML = """
     <meta charset="UTF-8">
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
     <title>{{ dirname }} - Polydevs File Sharing System - PFSS</title>
-    """ + COMMON_STYLE + """
+    <link rel="stylesheet" href="{{ style_url }}">
 </head>
 <body>
     <div class="header-bar">
@@ -378,37 +693,61 @@ DIR_LIST_HTML = """
         <a href="{{ url_for('logout') }}" class="logout">Logout</a>
     </div>
     <div class="container">
-        <a href="{{ url_for('list_root') }}" class="back-link">&laquo; Back to root directory</a>
+        <div class="breadcrumbs">
+            <a href="{{ url_for('list_root') }}" class="back-link">Root</a>
+            {% for crumb in breadcrumbs %}
+            /
+            {% if loop.last %}<span>{{ crumb.name }}</span>{% else %}<a href="{{ url_for('list_sub', name=crumb.path) }}" class="back-link">{{ crumb.name }}</a>{% endif %}
+            {% endfor %}
+        </div>
 
         <div class="section">
             <div class="section-header">Folder Contents</div>
             <div class="section-content">
+                <div class="path">
+                    Download folder as:
+                    {% for fmt in archive_formats %}
+                    <a href="{{ url_for('download_folder', name=dirname, format=fmt) }}" class="action-link">{{ fmt }}</a>
+                    {% endfor %}
+                </div>
                 {% if items %}
                 <table>
                     <thead>
                         <tr>
-                            <th>Name</th>
+                            <th><a href="{{ pager.sort_urls.name }}" class="sort-link">Name{% if pager.sort == 'name' %} {{ '&#9650;'|safe if pager.order == 'asc' else '&#9660;'|safe }}{% endif %}</a></th>
                             <th>Type</th>
+                            <th><a href="{{ pager.sort_urls.size }}" class="sort-link">Size{% if pager.sort == 'size' %} {{ '&#9650;'|safe if pager.order == 'asc' else '&#9660;'|safe }}{% endif %}</a></th>
+                            <th><a href="{{ pager.sort_urls.mtime }}" class="sort-link">Modified{% if pager.sort == 'mtime' %} {{ '&#9650;'|safe if pager.order == 'asc' else '&#9660;'|safe }}{% endif %}</a></th>
+                            <th>SHA-256</th>
                             <th>Actions</th>
                         </tr>
                     </thead>
                     <tbody>
                         {% for it in items %}
                         <tr>
-                            <td>{{ it.name }}</td>
+                            <td>{% if it.type == 'File' and it.name is thumbnailable %}<img src="{{ url_for('thumbnail', filename=dirname ~ '/' ~ it.name) }}" class="thumb" loading="lazy" decoding="async" alt="">{% endif %}{{ it.name }}</td>
                             <td>{{ it.type }}</td>
+                            <td>{{ it.size|filesizeformat if it.size is not none else '-' }}</td>
+                            <td>{{ it.mtime|mtime }}</td>
+                            <td>{% if it.sha256 %}<code class="digest" title="{{ it.sha256 }}">{{ it.sha256[:12] }}</code>{% else %}-{% endif %}</td>
                             <td>
                                 {% if it.type == 'File' %}
-                                    <a href="{{ url_for('view_sub_file', folder=dirname, filename=it.name) }}" class="action-link">View</a>
-                                    <a href="{{ url_for('download_sub_file', folder=dirname, filename=it.name) }}" class="action-link">Download</a>
-                                {% else %}
-                                    <span style="color: #999;">Subfolder</span>
+                                    <a href="{{ url_for('view_file', filename=dirname ~ '/' ~ it.name) }}" class="action-link">View</a>
+                                    <a href="{{ url_for('download_file', filename=dirname ~ '/' ~ it.name) }}" class="action-link">Download</a>
+                                {% elif it.type == 'Folder' %}
+                                    <a href="{{ url_for('list_sub', name=dirname ~ '/' ~ it.name) }}" class="action-link">Open</a>
+                                    <a href="{{ url_for('download_folder', name=dirname ~ '/' ~ it.name) }}" class="action-link">Download ZIP</a>
                                 {% endif %}
                             </td>
                         </tr>
                         {% endfor %}
                     </tbody>
                 </table>
+                <div class="pager">
+                    {% if pager.first_url %}<a href="{{ pager.first_url }}" class="btn">&laquo; First page</a>{% endif %}
+                    {% if pager.next_url %}<a href="{{ pager.next_url }}" class="btn">Next page &raquo;</a>{% endif %}
+                    {{ items|length }} of {{ pager.total }} items
+                </div>
                 {% else %}
                 <div class="empty-state">No files found</div>
                 {% endif %}
@@ -426,7 +765,7 @@ TEXT_VIEW_HTML = """
     <meta charset="UTF-8">
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
     <title>{{ filename }} - File Viewer</title>
-    """ + COMMON_STYLE + """
+    <link rel="stylesheet" href="{{ style_url }}">
 </head>
 <body>
     <div class="header-bar">
@@ -439,7 +778,18 @@ TEXT_VIEW_HTML = """
         <div class="section">
             <div class="section-header">File Contents</div>
             <div class="section-content">
-                <div class="content-viewer">{{ content }}</div>
+                {% if window and window.partial %}
+                <div class="path">Bytes {{ window.start }}&ndash;{{ window.end }} of {{ window.size }}</div>
+                {% endif %}
+                <div class="content-viewer">{% for chunk in content %}{{ chunk }}{% endfor %}</div>
+                {% if window and window.partial %}
+                <div class="pager">
+                    {% if window.prev_url %}<a href="{{ window.prev_url }}" class="btn">&laquo; Previous</a>{% endif %}
+                    {% if window.next_url %}<a href="{{ window.next_url }}" class="btn">Next &raquo;</a>{% endif %}
+                    <a href="{{ window.tail_url }}" class="btn">Tail</a>
+                    <a href="{{ download_url }}" class="btn">Download File</a>
+                </div>
+                {% endif %}
             </div>
         </div>
     </div>
@@ -454,7 +804,7 @@ NO_PREVIEW_HTML = """
     <meta charset="UTF-8">
     <meta name="viewport" content="width=device-width, initial-scale=1.0">
     <title>{{ filename }} - Preview Unavailable</title>
-    """ + COMMON_STYLE + """
+    <link rel="stylesheet" href="{{ style_url }}">
 </head>
 <body>
     <div class="header-bar">
@@ -480,16 +830,252 @@ NO_PREVIEW_HTML = """
 """
 
 
+# ---------------- Metrics ----------------
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Histogram:
+    __slots__ = ("counts", "sum")
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.sum += value
+
+    def render(self, name, labels):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels}le="{bound}"}} {cumulative}')
+        lines.append(f"{name}_sum{{{labels.rstrip(',')}}} {self.sum:.6f}")
+        lines.append(f"{name}_count{{{labels.rstrip(',')}}} {cumulative}")
+        return lines
+
+
+class _Phase:
+    __slots__ = ("metrics", "name", "start")
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe_phase(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class _NoPhase:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NO_PHASE = _NoPhase()
+
+
+class Metrics:
+    """
+    In-process counters and histograms, rendered in the Prometheus text
+    format. Everything is per process: behind the pre-fork launcher each
+    scrape reports the worker that happened to answer it.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = {}  # (route, method) -> Histogram
+        self.statuses = {}  # (route, method, status) -> count
+        self.bytes_sent = {}  # route -> bytes
+        self.phases = {}  # phase -> Histogram
+        self.fs_calls = {}  # call -> count
+
+    def observe_request(self, route, method, status, seconds, sent):
+        with self._lock:
+            hist = self.requests.get((route, method))
+            if hist is None:
+                hist = self.requests[(route, method)] = Histogram()
+            hist.observe(seconds)
+            key = (route, method, status)
+            self.statuses[key] = self.statuses.get(key, 0) + 1
+            self.bytes_sent[route] = self.bytes_sent.get(route, 0) + sent
+
+    def observe_phase(self, name, seconds):
+        with self._lock:
+            hist = self.phases.get(name)
+            if hist is None:
+                hist = self.phases[name] = Histogram()
+            hist.observe(seconds)
+
+    def phase(self, name):
+        return _Phase(self, name)
+
+    def count_fs(self, call, n):
+        with self._lock:
+            self.fs_calls[call] = self.fs_calls.get(call, 0) + n
+
+    def render(self):
+        out = []
+
+        def family(name, kind, help_text):
+            out.append(f"# HELP {name} {help_text}")
+            out.append(f"# TYPE {name} {kind}")
+
+        with self._lock:
+            family("pfss_request_duration_seconds", "histogram",
+                   "Time from receiving a request until its response body is finished.")
+            for (route, method), hist in sorted(self.requests.items()):
+                out.extend(hist.render("pfss_request_duration_seconds",
+                                       f'route="{route}",method="{method}",'))
+            family("pfss_requests_total", "counter", "Requests by route, method and status.")
+            for (route, method, status), count in sorted(self.statuses.items()):
+                out.append(f'pfss_requests_total{{route="{route}",method="{method}",status="{status}"}} {count}')
+            family("pfss_response_bytes_total", "counter", "Response body bytes sent by route.")
+            for route, sent in sorted(self.bytes_sent.items()):
+                out.append(f'pfss_response_bytes_total{{route="{route}"}} {sent}')
+            family("pfss_phase_duration_seconds", "histogram",
+                   "Time spent in ACL loading, directory scans, template rendering and compression.")
+            for name, hist in sorted(self.phases.items()):
+                out.extend(hist.render("pfss_phase_duration_seconds", f'phase="{name}",'))
+            family("pfss_fs_calls_total", "counter", "Filesystem calls made by the server.")
+            for call, count in sorted(self.fs_calls.items()):
+                out.append(f'pfss_fs_calls_total{{call="{call}"}} {count}')
+
+        caches = {"listing": LISTING_CACHE.stats(), "compressed": COMPRESSED_CACHE.stats(),
+                  "mime": MIME_CACHE.stats()}
+        family("pfss_cache_hits_total", "counter", "Cache hits.")
+        for cache, stats in caches.items():
+            out.append(f'pfss_cache_hits_total{{cache="{cache}"}} {stats["hits"]}')
+        family("pfss_cache_misses_total", "counter", "Cache misses.")
+        for cache, stats in caches.items():
+            out.append(f'pfss_cache_misses_total{{cache="{cache}"}} {stats["misses"]}')
+        family("pfss_cache_hit_ratio", "gauge", "Hits over lookups since start.")
+        for cache, stats in caches.items():
+            lookups = stats["hits"] + stats["misses"]
+            out.append(f'pfss_cache_hit_ratio{{cache="{cache}"}} {stats["hits"] / lookups if lookups else 0:.4f}')
+        family("pfss_listing_cache_entries", "gauge", "Directory listings currently cached.")
+        out.append(f'pfss_listing_cache_entries {caches["listing"]["size"]}')
+        family("pfss_compressed_cache_bytes", "gauge", "Size of the compressed-file disk cache.")
+        out.append(f'pfss_compressed_cache_bytes {caches["compressed"]["bytes"]}')
+        family("pfss_acl_rules", "gauge", "Rules in the current allow-list snapshot.")
+        out.append(f"pfss_acl_rules {ACCESS_INDEX.current().count}")
+        return "\n".join(out) + "\n"
+
+
+class _MeteredBody:
+    """Response iterable that counts the bytes it yields and reports on close()."""
+
+    def __init__(self, body, finish):
+        self.body = body
+        self.finish = finish
+        self.sent = 0
+
+    def __iter__(self):
+        for chunk in self.body:
+            self.sent += len(chunk)
+            yield chunk
+
+    def close(self):
+        try:
+            if hasattr(self.body, "close"):
+                self.body.close()
+        finally:
+            self.finish(self.sent)
+
+
+class MetricsMiddleware:
+    """
+    WSGI wrapper timing each request through the end of its body. File
+    wrapper bodies are handed to the server untouched so sendfile keeps
+    working; for those the time to hand-off and Content-Length are
+    recorded instead.
+    """
+
+    def __init__(self, wsgi_app, metrics):
+        self.wsgi_app = wsgi_app
+        self.metrics = metrics
+
+    def __call__(self, environ, start_response):
+        start = time.perf_counter()
+        response = {}
+
+        def metered_start_response(status, headers, exc_info=None):
+            response["status"] = status.split(" ", 1)[0]
+            response["headers"] = headers
+            return start_response(status, headers, exc_info)
+
+        def finish(sent):
+            self.metrics.observe_request(environ.get("pfss.endpoint") or "none",
+                                         environ.get("REQUEST_METHOD", ""),
+                                         response.get("status", "-"),
+                                         time.perf_counter() - start, sent)
+
+        body = self.wsgi_app(environ, metered_start_response)
+        if hasattr(body, "filelike"):
+            length = next((v for k, v in response.get("headers", ()) if k.lower() == "content-length"), 0)
+            finish(int(length))
+            return body
+        return _MeteredBody(body, finish)
+
+
+METRICS = Metrics() if METRICS_ENABLED else None
+
+
+def phase(name):
+    """Context manager timing one phase of request handling; free when metrics are off."""
+    return NO_PHASE if METRICS is None else METRICS.phase(name)
+
+
+def count_fs(call, n=1):
+    if METRICS is not None:
+        METRICS.count_fs(call, n)
+
+
+if METRICS is not None:
+    app.wsgi_app = MetricsMiddleware(app.wsgi_app, METRICS)
+
+    @app.before_request
+    def tag_endpoint():
+        request.environ["pfss.endpoint"] = request.endpoint
+
+
+@app.route("/metrics")
+def metrics():
+    if METRICS is None:
+        abort(404)
+    if not is_authenticated():
+        return Response("authentication required\n", status=401, mimetype="text/plain")
+    return Response(METRICS.render(), mimetype="text/plain; version=0.0.4")
+
+
+# -----------------------------------------
+
 # ---------------- Access Control ----------------
 def load_allowed_items():
     """
-    Đọc file allowed_files.txt và trả về set các đường dẫn được phép.
+    Đọc file allowed_files.txt và trả về list các rule theo đúng thứ tự trong file.
     Format trong file:
     - file.txt (file ở root)
-    - folder/ (folder ở root - cho phép truy cập folder)
+    - folder/ hoặc folder (folder ở root - cho phép truy cập folder và toàn bộ nội dung)
     - folder/file.txt (file trong folder)
+    - *.log, reports/**/2026-*.csv (pattern kiểu gitignore: *, ?, [abc], **)
+    - !secret.txt (phủ định: chặn những gì các rule phía trên đã cho phép)
+    - @cache-control *.iso public, max-age=86400 (header Cache-Control khi tải file)
+    - @upload incoming/, @upload !incoming/*.exe (quyền upload; đường dẫn vẫn phải được phép đọc)
+    Rule đứng sau được ưu tiên hơn rule đứng trước. Rule nào khớp một folder
+    (literal hay glob, ví dụ docs/*) thì áp dụng cho toàn bộ cây con của folder đó.
     """
-    allowed = set()
+    allowed = []
     if not os.path.exists(ALLOWED_FILES_CONFIG):
         print(f"WARNING: {ALLOWED_FILES_CONFIG} không tồn tại!")
         return allowed
@@ -502,7 +1088,7 @@ def load_allowed_items():
                 if line and not line.startswith('#'):
                     # Chuẩn hóa đường dẫn
                     line = line.replace('\\', '/')
-                    allowed.add(line)
+                    allowed.append(line)
         print(f"Loaded {len(allowed)} allowed items from {ALLOWED_FILES_CONFIG}")
     except Exception as e:
         print(f"ERROR reading {ALLOWED_FILES_CONFIG}: {e}")
@@ -510,270 +1096,4372 @@ def load_allowed_items():
     return allowed
 
 
-def is_allowed(path):
+GLOB_CHARS = frozenset("*?[")
+
+
+def glob_to_regex(pattern):
     """
-    Kiểm tra xem một đường dẫn có được phép truy cập không.
-    path: đường dẫn tương đối, ví dụ: "file.txt" hoặc "folder/file.txt"
+    Chuyển glob của một segment (không chứa '/') thành regex: *, ?, [abc], [!abc].
     """
-    allowed_items = load_allowed_items()
+    out = []
+    i, n = 0, len(pattern)
+    while i < n:
+        c = pattern[i]
+        if c == '*':
+            out.append('[^/]*')
+        elif c == '?':
+            out.append('[^/]')
+        elif c == '[':
+            j = i + 1
+            if j < n and pattern[j] in '!^':
+                j += 1
+            if j < n and pattern[j] == ']':
+                j += 1
+            j = pattern.find(']', j)
+            if j == -1:
+                out.append(re.escape(c))
+            else:
+                body = pattern[i + 1:j]
+                negate = body[:1] in ('!', '^')
+                if negate:
+                    body = body[1:]
+                for special in ('\\', '^', '[', ']'):
+                    body = body.replace(special, '\\' + special)
+                char_class = f"[{'^/' if negate else ''}{body}]"
+                try:
+                    re.compile(char_class)
+                except re.error:
+                    # Khoảng ký tự không hợp lệ (ví dụ [z-a]) -> coi như literal
+                    char_class = re.escape(pattern[i:j + 1])
+                out.append(char_class)
+                i = j
+        else:
+            out.append(re.escape(c))
+        i += 1
+    return ''.join(out)
 
-    # Nếu file config không tồn tại hoặc rỗng, chặn tất cả
-    if not allowed_items:
-        return False
 
-    # Chuẩn hóa path
-    path = path.replace('\\', '/')
+class _RuleNode:
+    """Một trạng thái trong automaton của các rule, ứng với một segment của đường dẫn."""
+    __slots__ = ("children", "globs", "deep", "loop", "rule", "closure")
 
-    # Kiểm tra chính xác
-    if path in allowed_items:
-        return True
+    def __init__(self, loop=False):
+        self.children = {}   # segment literal -> node
+        self.globs = None    # _GlobSet: segment có ký tự glob -> node
+        self.deep = None     # node của segment "**" ngay sau node này
+        self.loop = loop     # True nếu chính node này là "**" (nuốt thêm segment)
+        self.rule = None     # (thứ tự rule, giá trị) của rule kết thúc tại đây
+        self.closure = (self,)  # node này và node "**" theo sau (khớp cả 0 segment)
 
-    # Nếu là folder, kiểm tra có trailing slash
-    if path + '/' in allowed_items:
-        return True
 
-    # Kiểm tra xem folder cha có được phép không (cho phép list folder)
-    parts = path.split('/')
-    if len(parts) > 1:
-        folder = parts[0]
-        if folder + '/' in allowed_items:
-            return True
+def _later(a, b):
+    """Chọn rule đứng sau trong hai kết quả (thứ tự, giá trị); None = không khớp."""
+    if a is None:
+        return b
+    if b is None or a[0] > b[0]:
+        return a
+    return b
+
 
-    return False
+def _glob_split(glob):
+    """Tách glob của một segment thành (tiền tố literal, phần giữa, hậu tố literal)."""
+    first = min((i for i in (glob.find(c) for c in "*?[") if i != -1), default=len(glob))
+    last = max(glob.rfind(c) for c in "*?[]")
+    return glob[:first], glob[first:last + 1], glob[last + 1:]
 
 
-def filter_allowed_items(entries, parent_path=""):
+class _GlobSet:
     """
-    Lọc danh sách entries chỉ giữ lại những items được phép.
-    entries: list các dict {'name': ..., 'type': ...}
-    parent_path: đường dẫn folder cha (nếu có)
+    Các glob của một segment (ví dụ "report-*.csv") gom theo cặp (tiền tố
+    literal, hậu tố literal). Một segment chỉ cần tra dict một lần cho mỗi
+    cặp độ dài (tiền tố, hậu tố) có trong tập, rồi chỉ so regex với phần
+    giữa của những glob trong đúng bucket đó, nên chi phí không tăng theo
+    số rule. Glob có phần giữa là "*" (ví dụ "*.txt") khớp mà không cần regex.
     """
-    filtered = []
-    for entry in entries:
-        if parent_path:
-            path = f"{parent_path}/{entry['name']}"
-        else:
-            path = entry['name']
-
-        # Nếu là folder, thêm trailing slash để check
-        if entry['type'] == 'Folder':
-            if is_allowed(path) or is_allowed(path + '/'):
-                filtered.append(entry)
-        else:
-            if is_allowed(path):
-                filtered.append(entry)
-
-    return filtered
+    __slots__ = ("nodes", "_buckets", "_shapes")
 
+    def __init__(self):
+        self.nodes = {}
+        self._buckets = {}
+        self._shapes = ()
 
-# ------------------------------------------------
+    def node_for(self, glob):
+        node = self.nodes.get(glob)
+        if node is None:
+            node = self.nodes[glob] = _RuleNode()
+        return node
 
-# ---------------- Helpers ----------------
-def require_login():
-    if not session.get("logged_in"):
-        return redirect(url_for("login"))
-    return None
+    def compile(self):
+        buckets = {}
+        for glob, node in self.nodes.items():
+            head, middle, tail = _glob_split(glob)
+            regex = None if middle == '*' else re.compile(glob_to_regex(middle), re.DOTALL)
+            buckets.setdefault((head, tail), []).append((regex, node))
+        self._buckets = buckets
+        self._shapes = sorted({(len(head), len(tail)) for head, tail in buckets},
+                              key=lambda shape: shape[0] + shape[1])
 
+    def match(self, seg):
+        n = len(seg)
+        for head, tail in self._shapes:
+            if head + tail > n:
+                break
+            bucket = self._buckets.get((seg[:head], seg[n - tail:]))
+            if bucket is None:
+                continue
+            middle = seg[head:n - tail]
+            for regex, node in bucket:
+                if regex is None or regex.fullmatch(middle):
+                    yield node
 
-def is_direct_child(path):
-    """Ensure path is a direct child of BASE_DIR."""
-    real = os.path.realpath(path)
-    if not real.startswith(BASE_DIR + os.sep) and real != BASE_DIR:
-        return False
-    return os.path.dirname(real) == BASE_DIR
 
+class PathMatcher:
+    """
+    Tập pattern kiểu allowed_files.txt, mỗi pattern gắn với một giá trị;
+    match() trả về giá trị của rule khớp đứng sau cùng (None nếu không khớp).
+    Các rule được gộp thành một automaton theo segment: segment literal nằm
+    trong dict, segment có glob nằm trong _GlobSet, "**" là node tự lặp.
+    Mỗi lần kiểm tra chỉ duyệt các segment của đường dẫn, không phụ thuộc
+    số rule. Pattern glob không có '/' khớp ở bất kỳ cấp nào ("**/pattern");
+    rule literal luôn tính từ root.
+    Giống gitignore, rule khớp một folder thì áp dụng cho cả cây con của nó.
+    """
 
-def is_child_under(folder, name):
-    """Ensure folder is direct child of BASE_DIR, and name is direct child of that folder."""
-    folder_path = os.path.join(BASE_DIR, folder)
-    if not os.path.isdir(folder_path):
-        return False
-    real_folder = os.path.realpath(folder_path)
-    if os.path.dirname(real_folder) != BASE_DIR:
-        return False
-    candidate = os.path.join(real_folder, name)
-    real_candidate = os.path.realpath(candidate)
-    return os.path.dirname(real_candidate) == real_folder
+    def __init__(self):
+        self.root = _RuleNode()
 
+    def add(self, order, item, value):
+        item = item.rstrip('/')
+        anchored = '/' in item
+        segments = [s for s in item.split('/') if s]
+        if not segments:
+            return
+        if not anchored and GLOB_CHARS.intersection(item):
+            segments.insert(0, '**')
 
-# -----------------------------------------
+        node = self.root
+        for i, seg in enumerate(segments):
+            if seg != '**':
+                seg = re.sub(r'\*{2,}', '*', seg)
+            elif i == len(segments) - 1:
+                # "a/**" = mọi thứ bên trong a = "a/*" (cây con đã được bao)
+                seg = '*'
+            elif node.loop:
+                continue
+            if seg == '**':
+                if node.deep is None:
+                    node.deep = _RuleNode(loop=True)
+                node = node.deep
+            elif GLOB_CHARS.intersection(seg):
+                if node.globs is None:
+                    node.globs = _GlobSet()
+                node = node.globs.node_for(seg)
+            else:
+                node = node.children.setdefault(seg, _RuleNode())
+        node.rule = _later(node.rule, (order, value))
 
-@app.route("/", methods=["GET", "POST"])
-def login():
-    if request.method == "POST":
-        pw = request.form.get("pw", "")
-        if check_password_hash(PASSWORD_HASH, pw):
-            session["logged_in"] = True
-            return redirect(url_for("list_root"))
-        else:
-            return render_template_string(LOGIN_HTML, error="Incorrect password. Please try again.")
+    def compile(self):
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            stack.extend(node.children.values())
+            if node.deep is not None:
+                node.closure = (node, node.deep)
+                stack.append(node.deep)
+            if node.globs is not None:
+                node.globs.compile()
+                stack.extend(node.globs.nodes.values())
+        return self
 
-    if session.get("logged_in"):
-        return redirect(url_for("list_root"))
-    return render_template_string(LOGIN_HTML, error=None)
+    def match(self, path):
+        best = None
+        active = self.root.closure
+        for seg in path.replace('\\', '/').split('/'):
+            if not seg:
+                continue
+            reached = []
+            for node in active:
+                child = node.children.get(seg)
+                if child is not None:
+                    reached.append(child)
+                if node.globs is not None:
+                    reached.extend(node.globs.match(seg))
+                if node.loop:
+                    reached.append(node)
+            if not reached:
+                break
+            if len(reached) > 1:
+                reached = dict.fromkeys(reached)
+            active = []
+            for node in reached:
+                # Rule khớp một folder cha cũng áp dụng cho mọi thứ bên dưới
+                rule = node.rule
+                if rule is not None and (best is None or rule[0] > best[0]):
+                    best = rule
+                active += node.closure
+        return None if best is None else best[1]
 
 
-@app.route("/logout")
-def logout():
-    session.pop("logged_in", None)
-    return redirect(url_for("login"))
+class CompiledRules:
+    """
+    Snapshot bất biến của allowed_files.txt: một PathMatcher cho quyền truy
+    cập, một cho các directive "@cache-control <pattern> <giá trị>" và một
+    cho "@upload [!]<pattern>" (quyền ghi, mặc định không có).
+    Rule đứng sau luôn thắng rule đứng trước, giống gitignore.
+    """
 
+    def __init__(self, items, version=0, config_exists=False, protected=()):
+        self.items = tuple(items)
+        self.version = version
+        self.config_exists = config_exists
+        self.count = 0
+        self.access = PathMatcher()
+        self.cache_control = PathMatcher()
+        self.upload = PathMatcher()
 
-@app.route("/list")
-def list_root():
-    if (r := require_login()) is not None:
-        return r
-    entries = []
-    for name in sorted(os.listdir(BASE_DIR)):
-        # Bỏ qua file cấu hình
-        if name == "allowed_files.txt":
-            continue
-        path = os.path.join(BASE_DIR, name)
-        entries.append({
-            "name": name,
-            "type": "File" if os.path.isfile(path) else "Folder" if os.path.isdir(path) else "Other"
-        })
+        for order, item in enumerate(items):
+            if item.startswith('@'):
+                self._add_directive(order, item)
+                continue
+            self.count += 1
+            allow = not item.startswith('!')
+            self.access.add(order, item if allow else item[1:], allow)
 
-    # Lọc chỉ hiển thị items được phép
-    entries = filter_allowed_items(entries)
+        # Những đường dẫn luôn bị chặn (ví dụ chính file cấu hình)
+        for path in protected:
+            self.access.add(float('inf'), path, False)
 
-    config_exists = os.path.exists(ALLOWED_FILES_CONFIG)
-    return render_template_string(LIST_HTML, items=entries, base_dir=BASE_DIR, config_exists=config_exists)
+        self.access.compile()
+        self.cache_control.compile()
+        self.upload.compile()
 
+    def _add_directive(self, order, item):
+        parts = item.split(None, 2)
+        if parts[0] == "@cache-control" and len(parts) == 3:
+            self.cache_control.add(order, parts[1], parts[2])
+        elif parts[0] == "@upload" and len(parts) == 2:
+            allow = not parts[1].startswith('!')
+            self.upload.add(order, parts[1] if allow else parts[1][1:], allow)
+        else:
+            print(f"WARNING: bỏ qua directive không hợp lệ: {item}")
 
-@app.route("/list/<name>")
-def list_sub(name):
-    if (r := require_login()) is not None:
-        return r
-    if "/" in name or "\\" in name:
-        abort(400)
+    def allows(self, path):
+        # Nếu file config không tồn tại hoặc rỗng, chặn tất cả
+        if not self.count:
+            return False
+        return self.access.match(path) is True
 
-    # Kiểm tra quyền truy cập folder
-    if not is_allowed(name) and not is_allowed(name + '/'):
-        abort(403)
+    def allows_upload(self, path):
+        """Upload vào path cần cả quyền đọc lẫn một directive @upload khớp."""
+        return self.allows(path) and self.upload.match(path) is True
 
-    folder_path = os.path.join(BASE_DIR, name)
-    if not is_direct_child(folder_path) or not os.path.isdir(folder_path):
-        abort(404)
+    def cache_policy(self, path):
+        """Giá trị Cache-Control cho path theo directive @cache-control, hoặc None."""
+        return self.cache_control.match(path)
 
-    entries = []
-    for child in sorted(os.listdir(folder_path)):
-        child_path = os.path.join(folder_path, child)
-        entries.append({
-            "name": child,
-            "type": "File" if os.path.isfile(child_path) else "Folder" if os.path.isdir(child_path) else "Other"
-        })
 
-    # Lọc chỉ hiển thị items được phép
-    entries = filter_allowed_items(entries, parent_path=name)
+class WatchedConfig:
+    """
+    An immutable snapshot built from a config file, rebuilt only when the
+    file changes (dev/inode/mtime/size). The file is stat()ed at most once
+    every ``check_interval`` seconds and a new snapshot is swapped in
+    atomically, so readers never take the lock. Subclasses implement
+    ``_build(previous, signature)``; every snapshot has a ``version``,
+    which is 0 only before the first load.
+    """
 
-    return render_template_string(DIR_LIST_HTML, items=entries, dirname=name)
+    def __init__(self, path, initial, check_interval=ACL_CHECK_INTERVAL):
+        self.path = path
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._signature = None
+        self._checked_at = None
+        self._snapshot = initial
 
+    def _stat_signature(self):
+        try:
+            count_fs("stat")
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return (st.st_dev, st.st_ino, st.st_mtime_ns, st.st_size)
 
-@app.route("/view/<filename>")
-def view_file(filename):
-    if (r := require_login()) is not None:
-        return r
-    if "/" in filename or "\\" in filename:
-        abort(400)
+    def current(self):
+        """The current snapshot, reloaded first if the file has changed."""
+        now = time.monotonic()
+        checked_at = self._checked_at
+        if checked_at is None or now - checked_at >= self.check_interval:
+            self.reload(now=now)
+        return self._snapshot
 
-    # Kiểm tra quyền truy cập
-    if not is_allowed(filename):
-        abort(403)
+    def reload(self, force=False, now=None):
+        with self._lock:
+            self._checked_at = time.monotonic() if now is None else now
+            signature = self._stat_signature()
+            if not force and signature == self._signature and self._snapshot.version:
+                return self._snapshot
+            self._snapshot = self._build(self._snapshot, signature)
+            self._signature = signature
+            return self._snapshot
 
-    file_path = os.path.join(BASE_DIR, filename)
-    if not is_direct_child(file_path) or not os.path.isfile(file_path):
-        abort(404)
-    mime, _ = mimetypes.guess_type(file_path)
+    def _build(self, previous, signature):
+        raise NotImplementedError
 
-    if mime and mime.startswith("text"):
-        try:
-            with open(file_path, "r", encoding="utf-8", errors="replace") as f:
-                content = f.read()
-        except Exception as e:
-            content = f"Unable to read file: {e}"
-        return render_template_string(TEXT_VIEW_HTML, filename=filename, content=content)
-    elif mime and mime.startswith("image"):
-        return send_from_directory(BASE_DIR, filename, as_attachment=False)
-    else:
-        return render_template_string(NO_PREVIEW_HTML,
-                                      filename=filename,
-                                      download_url=url_for('download_file', filename=filename))
 
+class AccessIndex(WatchedConfig):
+    """
+    Giữ CompiledRules trong bộ nhớ và chỉ biên dịch lại khi allowed_files.txt
+    thay đổi (xem WatchedConfig).
+    """
 
-@app.route("/download/<filename>")
-def download_file(filename):
-    if (r := require_login()) is not None:
-        return r
-    if "/" in filename or "\\" in filename:
-        abort(400)
+    def __init__(self, config_path, check_interval=ACL_CHECK_INTERVAL, protected=()):
+        super().__init__(config_path, CompiledRules(()), check_interval)
+        self.protected = tuple(protected)
 
-    # Kiểm tra quyền truy cập
-    if not is_allowed(filename):
-        abort(403)
+    def _build(self, previous, signature):
+        with phase("acl_load"):
+            return CompiledRules(load_allowed_items(),
+                                 version=previous.version + 1,
+                                 config_exists=signature is not None,
+                                 protected=self.protected)
 
-    file_path = os.path.join(BASE_DIR, filename)
-    if not is_direct_child(file_path) or not os.path.isfile(file_path):
-        abort(404)
-    return send_from_directory(BASE_DIR, filename, as_attachment=True)
 
+PROTECTED_PATHS = ["allowed_files.txt", UPLOAD_PART_PREFIX + "*"]
+if USERS_FILE and os.path.realpath(USERS_FILE).startswith(BASE_DIR + os.sep):
+    # Không bao giờ cho tải users file nếu nó nằm trong thư mục chia sẻ
+    PROTECTED_PATHS.append(os.path.relpath(os.path.realpath(USERS_FILE), BASE_DIR).replace(os.sep, "/"))
+ACCESS_INDEX = AccessIndex(ALLOWED_FILES_CONFIG, protected=PROTECTED_PATHS)
 
-@app.route("/view/<folder>/<filename>")
-def view_sub_file(folder, filename):
-    if (r := require_login()) is not None:
-        return r
-    if "/" in folder or "\\" in folder or "/" in filename or "\\" in filename:
-        abort(400)
 
-    # Kiểm tra quyền truy cập
-    file_path_relative = f"{folder}/{filename}"
-    if not is_allowed(file_path_relative):
-        abort(403)
+def is_allowed(path, rules=None):
+    """
+    Kiểm tra xem một đường dẫn có được phép truy cập không.
+    path: đường dẫn tương đối, ví dụ: "file.txt" hoặc "folder/file.txt"
+    rules: mặc định là rule của user trong request hiện tại (current_rules())
+    """
+    return (current_rules() if rules is None else rules).allows(path)
 
-    if not is_child_under(folder, filename):
-        abort(404)
-    folder_path = os.path.join(BASE_DIR, folder)
-    file_path = os.path.join(folder_path, filename)
-    mime, _ = mimetypes.guess_type(file_path)
 
-    if mime and mime.startswith("text"):
+def filter_allowed_items(entries, parent_path="", rules=None):
+    """
+    Lọc danh sách entries chỉ giữ lại những items được phép.
+    entries: list các dict {'name': ..., 'type': ...}
+    parent_path: đường dẫn folder cha (nếu có)
+    rules: mặc định là current_rules()
+    """
+    if rules is None:
+        rules = current_rules()
+    filtered = []
+    for entry in entries:
+        if parent_path:
+            path = f"{parent_path}/{entry['name']}"
+        else:
+            path = entry['name']
+
+        if rules.allows(path):
+            filtered.append(entry)
+
+    return filtered
+
+
+# ------------------------------------------------
+
+# ---------------- Authentication ----------------
+def hash_password(password, method=PASSWORD_METHOD):
+    if method.split(":", 1)[0] == "argon2":
+        if argon2 is None:
+            raise RuntimeError("argon2 hashing requires the argon2-cffi package")
+        costs = dict(zip(("time_cost", "memory_cost", "parallelism"),
+                         (int(v) for v in method.split(":")[1:])))
+        return argon2.PasswordHasher(**costs).hash(password)
+    return generate_password_hash(password, method=method)
+
+
+def check_password(password_hash, password):
+    if password_hash.startswith("$argon2"):
+        if argon2 is None:
+            print("WARNING: SHARE_PW_HASH is an argon2 hash but argon2-cffi is not installed")
+            return False
+        try:
+            return argon2.PasswordHasher().verify(password_hash, password)
+        except (argon2.exceptions.VerificationError, argon2.exceptions.InvalidHashError):
+            return False
+    return check_password_hash(password_hash, password)
+
+
+class PasswordVerifier:
+    """
+    Checks login passwords against the configured hash. The KDF only runs
+    for passwords that have not been verified yet: after a successful
+    check an HMAC of the password under a per-process random key is kept,
+    and later logins with the same password are compared against it in
+    constant time. Wrong passwords always pay the full KDF cost.
+    """
+
+    def __init__(self, password_hash):
+        self.password_hash = password_hash
+        self._key = secrets.token_bytes(32)
+        self._verified = None
+
+    def _digest(self, password):
+        return hmac.new(self._key, password.encode("utf-8"), hashlib.sha256).digest()
+
+    def verify(self, password):
+        digest = self._digest(password)
+        verified = self._verified
+        if verified is not None and hmac.compare_digest(digest, verified):
+            return True
+        if not check_password(self.password_hash, password):
+            return False
+        self._verified = digest
+        return True
+
+
+class TokenTable:
+    """
+    Bearer tokens for scripted access. Tokens are kept by SHA-256 digest
+    only, so a lookup is one hash of the presented token and a dict probe;
+    nothing about a stored token leaks through comparison timing. Entries
+    come from SHARE_API_TOKENS (comma separated) and SHARE_API_TOKENS_FILE,
+    one ``name token`` or ``name sha256:<hex digest>`` per line.
+    """
+
+    def __init__(self):
+        self._tokens = {}
+
+    @staticmethod
+    def digest(token):
+        return hashlib.sha256(token.encode("utf-8")).digest()
+
+    def load(self, inline="", path=""):
+        tokens = {}
+        for token in inline.split(","):
+            if token.strip():
+                tokens[self.digest(token.strip())] = "env"
+        if path:
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    lines = f.read().splitlines()
+            except OSError as e:
+                print(f"WARNING: cannot read API tokens from {path}: {e}")
+                lines = []
+            for lineno, line in enumerate(lines, 1):
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                name, _, token = line.partition(" ")
+                token = token.strip()
+                if not token:
+                    print(f"WARNING: {path}:{lineno}: expected 'name token'")
+                    continue
+                if token.startswith("sha256:"):
+                    try:
+                        digest = bytes.fromhex(token[len("sha256:"):])
+                    except ValueError:
+                        digest = b""
+                    if len(digest) != hashlib.sha256().digest_size:
+                        print(f"WARNING: {path}:{lineno}: malformed sha256 digest")
+                        continue
+                    tokens[digest] = name
+                else:
+                    tokens[self.digest(token)] = name
+        self._tokens = tokens
+        return len(tokens)
+
+    def lookup(self, token):
+        """Return the token's name, or None."""
+        return self._tokens.get(self.digest(token))
+
+    def __len__(self):
+        return len(self._tokens)
+
+
+if not PASSWORD_HASH:
+    PASSWORD_HASH = hash_password(PASSWORD)
+PASSWORD_VERIFIER = PasswordVerifier(PASSWORD_HASH)
+API_TOKEN_TABLE = TokenTable()
+if API_TOKEN_TABLE.load(API_TOKENS, API_TOKENS_FILE):
+    print(f"Loaded {len(API_TOKEN_TABLE)} API tokens")
+
+
+def bearer_token_name():
+    """Name of the valid bearer token sent with the request, if any."""
+    scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not token.strip():
+        return None
+    return API_TOKEN_TABLE.lookup(token.strip())
+
+
+def is_authenticated():
+    if session.get("logged_in"):
+        # Xóa user khỏi users file là thu hồi luôn các phiên đăng nhập của user đó
+        user = session.get("user")
+        return user is None or (USER_DIRECTORY is not None and USER_DIRECTORY.exists(user))
+    return bearer_token_name() is not None
+
+
+# ---------------- Sessions ----------------
+class SqliteConnections:
+    """
+    One autocommit connection to a SQLite file per thread and process
+    (connections are neither thread-safe nor usable after fork()), in WAL
+    mode with a 30 s busy timeout and ``schema`` applied on connect.
+    Calling the object returns the current thread's connection.
+    """
+
+    def __init__(self, db_path, schema):
+        self.db_path = db_path
+        self.schema = schema
+        self._local = threading.local()
+
+    def __call__(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(self.schema)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+
+class ServerSession(CallbackDict, SessionMixin):
+    """Session data kept server-side; the cookie only carries a random id."""
+
+    def __init__(self, initial=None, sid=None, expires=None):
+        def on_update(self):
+            self.modified = True
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.expires = expires
+        self.revoked_sid = None
+        self.modified = False
+
+    def rotate(self):
+        """Move the session to a fresh id at the next save, revoking the old one (on login)."""
+        if self.sid is not None:
+            self.revoked_sid = self.sid
+            self.sid = None
+        self.modified = True
+
+
+class MemorySessionStore:
+    """
+    Sessions in a dict private to this process. Every write moves the entry
+    to the end, and all entries share one TTL, so the dict is also in expiry
+    order and expired sessions are evicted from the front. Only suitable
+    for a single process (the dev server, ASGI with one worker).
+    """
+
+    shared = False
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (data, expires)
+
+    def get(self, key, now):
+        """(data, expires) of a live session, or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None or entry[1] <= now:
+            return None
+        return entry
+
+    def put(self, key, data, expires, now):
+        with self._lock:
+            self._entries[key] = (data, expires)
+            self._entries.move_to_end(key)
+            while self._entries:
+                key, (_, oldest) = next(iter(self._entries.items()))
+                if oldest > now:
+                    break
+                del self._entries[key]
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            count = len(self._entries)
+            self._entries.clear()
+        return count
+
+
+class SqliteSessionStore:
+    """
+    Sessions in a local SQLite file in WAL mode, shared by every worker
+    process on the host; a lookup is one primary-key probe served from the
+    page cache. Expired rows are deleted at most every SESSION_SWEEP_INTERVAL
+    seconds per process.
+    """
+
+    shared = True
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS sessions (
+            id TEXT PRIMARY KEY,
+            data TEXT NOT NULL,
+            expires REAL NOT NULL
+        ) WITHOUT ROWID;
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._db = SqliteConnections(db_path, self.SCHEMA)
+        self._next_sweep = 0.0
+
+    def get(self, key, now):
+        row = self._db().execute("SELECT data, expires FROM sessions WHERE id = ? AND expires > ?",
+                                 (key, now)).fetchone()
+        return None if row is None else (json.loads(row[0]), row[1])
+
+    def put(self, key, data, expires, now):
+        db = self._db()
+        db.execute("INSERT OR REPLACE INTO sessions VALUES (?, ?, ?)",
+                   (key, json.dumps(data, separators=(",", ":")), expires))
+        if now >= self._next_sweep:
+            self._next_sweep = now + SESSION_SWEEP_INTERVAL
+            db.execute("DELETE FROM sessions WHERE expires <= ?", (now,))
+
+    def delete(self, key):
+        self._db().execute("DELETE FROM sessions WHERE id = ?", (key,))
+
+    def clear(self):
+        return self._db().execute("DELETE FROM sessions").rowcount
+
+
+class ServerSessionInterface(SessionInterface):
+    """
+    Flask session interface backed by a session store. The cookie holds a
+    256-bit random id; the store is keyed by its SHA-256, so the database
+    alone does not yield usable cookies. Sessions expire SESSION_TTL
+    seconds after last use; the expiry is only rewritten once half of it
+    has passed, so most requests cost a single read. Emptying the session
+    (logout) deletes it server-side, which revokes the cookie everywhere.
+    """
+
+    def __init__(self, store, ttl=SESSION_TTL):
+        self.store = store
+        self.ttl = ttl
+
+    @staticmethod
+    def key(sid):
+        return hashlib.sha256(sid.encode("ascii")).hexdigest()
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid and len(sid) == 43 and sid.isascii():
+            try:
+                entry = self.store.get(self.key(sid), time.time())
+            except sqlite3.Error as e:
+                print(f"WARNING: session store unavailable: {e}")
+                entry = None
+            if entry is not None:
+                return ServerSession(entry[0], sid=sid, expires=entry[1])
+        return ServerSession()
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        if session.revoked_sid is not None:
+            self.store.delete(self.key(session.revoked_sid))
+        if not session:
+            if session.sid is not None:
+                self.store.delete(self.key(session.sid))
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        now = time.time()
+        refresh = session.expires is not None and session.expires - now < self.ttl / 2
+        if not (session.modified or refresh or session.sid is None):
+            return
+        if session.sid is None:
+            session.sid = secrets.token_urlsafe(32)
+        session.expires = now + self.ttl
+        self.store.put(self.key(session.sid), dict(session), session.expires, now)
+        response.vary.add("Cookie")
+        response.set_cookie(name, session.sid,
+                            max_age=int(self.ttl) if session.permanent else None,
+                            domain=domain, path=path,
+                            secure=self.get_cookie_secure(app),
+                            httponly=self.get_cookie_httponly(app),
+                            samesite=self.get_cookie_samesite(app) or "Lax")
+
+
+def make_session_store(backend=SESSION_BACKEND):
+    if backend == "memory":
+        return MemorySessionStore()
+    if backend != "sqlite":
+        print(f"WARNING: SHARE_SESSION_BACKEND={backend!r} is not 'sqlite' or 'memory', using 'sqlite'")
+    return SqliteSessionStore(SESSION_DB)
+
+
+SESSION_STORE = make_session_store()
+app.session_interface = ServerSessionInterface(SESSION_STORE)
+
+
+# ------------------------------------------------
+
+# ---------------- Users ----------------
+class _UserTable:
+    """One parsed snapshot of the users file."""
+    __slots__ = ("users", "groups", "version")
+
+    def __init__(self, users, groups, version):
+        self.users = users  # name -> {"password": hash, "groups": [...], "rules": [...]}
+        self.groups = groups  # name -> [rules]
+        self.version = version
+
+
+class RuleUnion:
+    """Allows what any of several rule sets allows; used by the indexers, which serve every user."""
+
+    def __init__(self, rule_sets, version):
+        self.rule_sets = rule_sets
+        self.version = version
+
+    def allows(self, path):
+        return any(rules.allows(path) for rules in self.rule_sets)
+
+
+class UserDirectory(WatchedConfig):
+    """
+    Accounts and groups from SHARE_USERS_FILE, an INI file:
+
+        [group:ops]
+        rules =
+            logs/
+            !logs/private/
+
+        [user:alice]
+        password = scrypt:32768:8:1$...   (see `main.py hash-password`)
+        groups = ops
+        rules =
+            home/alice/
+            @upload home/alice/
+
+    A user's rules are allowed_files.txt followed by the rules of each of
+    their groups and then their own, with the usual "later rule wins"
+    precedence. That list is compiled once into a CompiledRules shared by
+    every user with the same list, so however many users there are, a
+    request costs one dict lookup and one matcher walk. Compiled rules
+    only live as long as the (allowed_files.txt, users file) versions
+    they were built from. The file is re-read when it changes (see
+    WatchedConfig); a user removed from it is logged out.
+    """
+
+    def __init__(self, path, check_interval=ACL_CHECK_INTERVAL):
+        super().__init__(path, _UserTable({}, {}, 0), check_interval)
+        self._verifiers = {}
+        self._versions = None  # versions the two caches below were built from
+        self._by_user = {}  # name -> (versions, CompiledRules)
+        self._by_items = {}  # rule list -> CompiledRules
+        self._union = None
+
+    def _build(self, previous, signature):
+        users, groups = self._load()
+        self._verifiers = {}
+        self._union = None
+        return _UserTable(users, groups, previous.version + 1)
+
+    def _load(self):
+        parser = configparser.ConfigParser(interpolation=None)
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                parser.read_file(f)
+        except (OSError, configparser.Error) as e:
+            print(f"WARNING: cannot read users from {self.path}: {e}")
+            return {}, {}
+
+        def rule_list(section):
+            lines = (line.strip().replace("\\", "/") for line in section.get("rules", "").splitlines())
+            return [line for line in lines if line and not line.startswith("#")]
+
+        users, groups = {}, {}
+        for name in parser.sections():
+            kind, _, ident = name.partition(":")
+            section = parser[name]
+            if kind == "group" and ident:
+                groups[ident] = rule_list(section)
+            elif kind == "user" and ident and section.get("password"):
+                users[ident] = {"password": section["password"].strip(),
+                                "groups": section.get("groups", "").replace(",", " ").split(),
+                                "rules": rule_list(section)}
+            else:
+                print(f"WARNING: {self.path}: ignoring section [{name}]")
+        for ident, user in users.items():
+            for group in user["groups"]:
+                if group not in groups:
+                    print(f"WARNING: {self.path}: user {ident} is in unknown group {group}")
+        print(f"Loaded {len(users)} users and {len(groups)} groups from {self.path}")
+        return users, groups
+
+    def exists(self, name):
+        return name in self.current().users
+
+    def verify(self, name, password):
+        """Check a user's password; unknown users pay the same KDF cost as wrong passwords."""
+        user = self.current().users.get(name)
+        if user is None:
+            check_password(PASSWORD_HASH, "\0" + password)
+            return False
+        verifier = self._verifiers.get(name)
+        if verifier is None or verifier.password_hash != user["password"]:
+            verifier = self._verifiers[name] = PasswordVerifier(user["password"])
+        return verifier.verify(password)
+
+    def rules_for(self, name):
+        """CompiledRules for a user; unknown users are denied everything."""
+        base = ACCESS_INDEX.current()
+        table = self.current()
+        versions = (base.version, table.version)
+        cached = self._by_user.get(name)
+        if cached is not None and cached[0] == versions:
+            return cached[1]
+
+        user = table.users.get(name)
+        items = list(base.items)
+        if user is not None:
+            for group in user["groups"]:
+                items.extend(table.groups.get(group, ()))
+            items.extend(user["rules"])
+        items = tuple(items) if user is not None else ()
+        with self._lock:
+            if self._versions != versions:
+                # Either file changed: drop everything compiled from the old versions
+                self._versions = versions
+                self._by_user = {}
+                self._by_items = {}
+            rules = self._by_items.get(items)
+            if rules is None:
+                rules = CompiledRules(items, version=("user", *versions, len(self._by_items)),
+                                      config_exists=base.config_exists, protected=ACCESS_INDEX.protected)
+                self._by_items[items] = rules
+            self._by_user[name] = (versions, rules)
+        return rules
+
+    def union(self):
+        """Rules allowing anything the shared password or any user may see."""
+        base = ACCESS_INDEX.current()
+        table = self.current()
+        versions = ("union", base.version, table.version)
+        union = self._union
+        if union is not None and union.version == versions:
+            return union
+        distinct = {id(base): base}
+        for name in table.users:
+            rules = self.rules_for(name)
+            distinct[id(rules)] = rules
+        union = self._union = RuleUnion(list(distinct.values()), versions)
+        return union
+
+
+USER_DIRECTORY = UserDirectory(USERS_FILE) if USERS_FILE else None
+if USER_DIRECTORY is not None:
+    USER_DIRECTORY.reload(force=True)
+
+
+def current_user():
+    """Name of the signed-in user (session, or a bearer token named after a user); None otherwise."""
+    name = session.get("user")
+    if name is None and USER_DIRECTORY is not None:
+        token_name = bearer_token_name()
+        if token_name is not None and USER_DIRECTORY.exists(token_name):
+            name = token_name
+    return name
+
+
+def current_rules():
+    """
+    Snapshot quy tắc cho request hiện tại: rule đã biên dịch của user đang
+    đăng nhập nếu có users file, ngược lại (mật khẩu chung, token không gắn
+    user, hoặc ngoài request) là allowed_files.txt. Kết quả được giữ trong
+    ``g`` nên mỗi request chỉ tra cứu một lần.
+    """
+    if USER_DIRECTORY is None or not has_request_context():
+        return ACCESS_INDEX.current()
+    rules = g.get("pfss_rules")
+    if rules is None:
+        name = current_user()
+        rules = g.pfss_rules = ACCESS_INDEX.current() if name is None else USER_DIRECTORY.rules_for(name)
+    return rules
+
+
+def indexing_rules():
+    """Rules for the background indexers: everything some user (or the shared password) may see."""
+    if USER_DIRECTORY is None:
+        return ACCESS_INDEX.current()
+    return USER_DIRECTORY.union()
+
+
+# ------------------------------------------------
+
+# ---------------- Rate Limiting ----------------
+def parse_rate(value):
+    """``"10/60"`` -> (10, 60.0); ``"0"`` or empty -> None (unlimited)."""
+    count, _, window = value.partition("/")
+    if not count.strip() or int(count) <= 0:
+        return None
+    return int(count), float(window or 1)
+
+
+class SlidingWindowLimiter:
+    """
+    Sliding-window counter per key (client IP, or "*" for a global limit).
+    Each key costs one small list: the start of its current fixed window
+    and the counts of that window and the previous one. The previous
+    window's count is weighted by how much of it still overlaps the
+    sliding window, which approximates a true sliding log in O(1) memory.
+    Keys idle for two windows are swept out at most once per window.
+    The state is per process; with N workers the effective limit is N
+    times the configured one.
+    """
+
+    def __init__(self, limit, window):
+        self.limit = limit
+        self.window = window
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._next_sweep = 0.0
+
+    def hit(self, key, now=None):
+        """Count one event; return 0 if allowed, else seconds until retry."""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            if now >= self._next_sweep:
+                self._sweep(now)
+            start = now - now % self.window
+            counter = self._counters.get(key)
+            if counter is None:
+                counter = self._counters[key] = [start, 0, 0]
+            elif counter[0] != start:
+                counter[1] = counter[2] if start - counter[0] == self.window else 0
+                counter[0], counter[2] = start, 0
+            weight = 1.0 - (now - start) / self.window
+            if counter[1] * weight + counter[2] >= self.limit:
+                return start + self.window - now
+            counter[2] += 1
+            return 0
+
+    def _sweep(self, now):
+        horizon = now - 2 * self.window
+        self._counters = {k: c for k, c in self._counters.items() if c[0] > horizon}
+        self._next_sweep = now + self.window
+
+    def __len__(self):
+        return len(self._counters)
+
+
+class BandwidthLimiter:
+    """
+    Token bucket per client: ``rate`` bytes/second refill, up to ``burst``
+    bytes banked. consume() may drive a bucket negative; the returned delay
+    is how long the caller has to wait before sending what it just took.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self._next_sweep = 0.0
+
+    def consume(self, key, amount, now=None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            if now >= self._next_sweep:
+                # A bucket idle long enough to be full again carries no state
+                horizon = now - self.burst / self.rate
+                self._buckets = {k: b for k, b in self._buckets.items() if b[1] > horizon}
+                self._next_sweep = now + 60.0
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [float(self.burst), now]
+            tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate) - amount
+            bucket[0], bucket[1] = tokens, now
+        return -tokens / self.rate if tokens < 0 else 0.0
+
+
+_login_rate = parse_rate(LOGIN_RATE)
+_login_global_rate = parse_rate(LOGIN_GLOBAL_RATE)
+LOGIN_LIMITER = SlidingWindowLimiter(*_login_rate) if _login_rate else None
+LOGIN_GLOBAL_LIMITER = SlidingWindowLimiter(*_login_global_rate) if _login_global_rate else None
+DOWNLOAD_LIMITER = BandwidthLimiter(DOWNLOAD_RATE, DOWNLOAD_BURST) if DOWNLOAD_RATE > 0 else None
+
+
+def login_retry_after():
+    """Count a login attempt; seconds to wait if the client or the server is over its limit."""
+    if LOGIN_LIMITER is not None:
+        wait = LOGIN_LIMITER.hit(request.remote_addr or "-")
+        if wait:
+            return wait
+    if LOGIN_GLOBAL_LIMITER is not None:
+        return LOGIN_GLOBAL_LIMITER.hit("*")
+    return 0
+
+
+def iter_throttled(body, key):
+    try:
+        for chunk in body:
+            delay = DOWNLOAD_LIMITER.consume(key, len(chunk))
+            if delay:
+                time.sleep(delay)
+            yield chunk
+    finally:
+        if hasattr(body, "close"):
+            body.close()
+
+
+def throttle_download(response):
+    """Pace a download response to the client's SHARE_DOWNLOAD_RATE."""
+    if DOWNLOAD_LIMITER is None or response.status_code not in (200, 206):
+        return response
+    response.response = iter_throttled(response.response, request.remote_addr or "-")
+    return response
+
+
+# ------------------------------------------------
+
+# ---------------- Helpers ----------------
+def require_login():
+    if not is_authenticated():
+        if "Authorization" in request.headers:
+            abort(401)
+        return redirect(url_for("login"))
+    return None
+
+
+def split_share_path(path):
+    """Segments of a share-relative URL path, or None if it is malformed."""
+    path = path.rstrip("/")
+    if not path or "\\" in path or "\0" in path:
+        return None
+    parts = path.split("/")
+    if any(part in ("", ".", "..") for part in parts):
+        return None
+    return parts
+
+
+class PathResolver:
+    """
+    Maps share-relative paths to real paths under BASE_DIR. Every component
+    has to resolve to an entry of its own parent folder: a symlink may rename
+    something, never move it out of the folder it sits in (the rule the
+    old two-level routes enforced, now applied at every depth). Resolved
+    folders are kept ``ttl`` seconds in a bounded LRU, so ``a/b/c/d/file``
+    costs a cache hit for ``a/b/c/d`` plus one lstat of ``file`` instead of
+    a realpath walk of every ancestor.
+    """
+
+    def __init__(self, base_dir, max_depth=MAX_DEPTH, max_entries=4096, ttl=LISTING_CACHE_TTL):
+        self.base_dir = base_dir
+        self.max_depth = max_depth
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._dirs = OrderedDict()  # tuple(parts) -> (real path, expires)
+
+    @staticmethod
+    def _child(real_dir, name):
+        path = os.path.join(real_dir, name)
+        try:
+            st = os.lstat(path)
+        except OSError:
+            return None
+        if not stat.S_ISLNK(st.st_mode):
+            return path
+        real = os.path.realpath(path)
+        return real if os.path.dirname(real) == real_dir else None
+
+    def folder(self, parts):
+        """Real path of the folder ``parts`` (a tuple of segments), or None."""
+        if not parts:
+            return self.base_dir
+        now = time.monotonic()
+        with self._lock:
+            cached = self._dirs.get(parts)
+            if cached is not None and cached[1] > now:
+                self._dirs.move_to_end(parts)
+                return cached[0]
+        parent = self.folder(parts[:-1])
+        if parent is None:
+            return None
+        real = self._child(parent, parts[-1])
+        if real is None or not os.path.isdir(real):
+            return None
+        with self._lock:
+            self._dirs[parts] = (real, now + self.ttl)
+            self._dirs.move_to_end(parts)
+            while len(self._dirs) > self.max_entries:
+                self._dirs.popitem(last=False)
+        return real
+
+    def resolve(self, parts):
+        """Real path of the file or folder ``parts``, or None."""
+        if not parts or len(parts) > self.max_depth:
+            return None
+        parent = self.folder(tuple(parts[:-1]))
+        if parent is None:
+            return None
+        return self._child(parent, parts[-1])
+
+    def invalidate(self, path=None):
+        """
+        Forget the folders inside the real folder ``path``, whose entries
+        have changed (or every folder, when ``path`` is None).
+        """
+        with self._lock:
+            if path is None:
+                self._dirs.clear()
+                return
+            prefix = path.rstrip(os.sep) + os.sep
+            for parts in [parts for parts, (real, _) in self._dirs.items() if real.startswith(prefix)]:
+                del self._dirs[parts]
+
+
+PATH_RESOLVER = PathResolver(BASE_DIR)
+
+
+def resolve_request_path(path, kind):
+    """
+    Check a share-relative path taken from the URL and resolve it: 400 if
+    malformed, 403 if the allow-list denies it, 404 unless it is a ``kind``
+    ("file", "folder" or None for either) inside the share. Returns the
+    normalized relative path and the real path.
+    """
+    parts = split_share_path(path)
+    if parts is None:
+        abort(400)
+    rel_path = "/".join(parts)
+
+    # Kiểm tra quyền truy cập (folder có thể được cho phép bằng "name/")
+    if kind == "file":
+        allowed = is_allowed(rel_path)
+    else:
+        allowed = is_allowed(rel_path) or is_allowed(rel_path + "/")
+    if not allowed:
+        abort(403)
+
+    real = PATH_RESOLVER.resolve(parts)
+    if real is None:
+        abort(404)
+    if kind == "file" and not os.path.isfile(real):
+        abort(404)
+    if kind == "folder" and not os.path.isdir(real):
+        abort(404)
+    return rel_path, real
+
+
+def entry_type(dirent):
+    """Classify a DirEntry like os.path.isfile/isdir, using d_type when available."""
+    try:
+        if dirent.is_file():
+            return "File"
+        if dirent.is_dir():
+            return "Folder"
+    except OSError:
+        pass
+    return "Other"
+
+
+def scan_directory(path, parent_path="", skip=(), rules=None):
+    """
+    List a directory with a single os.scandir() pass, sorted by name and
+    filtered by the allow-list. Types come from the directory read itself;
+    size and mtime come from one cached DirEntry.stat() and are only fetched
+    for entries that survive the filter.
+    """
+    with phase("scan"):
+        dirents = {}
+        entries = []
+        with os.scandir(path) as it:
+            for dirent in it:
+                if dirent.name in skip:
+                    continue
+                dirents[dirent.name] = dirent
+                entries.append({"name": dirent.name, "type": entry_type(dirent)})
+        entries.sort(key=lambda e: e["name"])
+
+        entries = filter_allowed_items(entries, parent_path=parent_path, rules=rules)
+
+        for entry in entries:
+            try:
+                st = dirents[entry["name"]].stat()
+            except OSError:
+                entry["size"] = entry["mtime"] = entry["etag"] = None
+                continue
+            entry["size"] = st.st_size if entry["type"] == "File" else None
+            entry["mtime"] = st.st_mtime
+            entry["etag"] = make_etag(st)
+        count_fs("scandir")
+        count_fs("stat", len(entries))
+    return entries
+
+
+def make_etag(st):
+    """Strong validator for a file version, derived from inode, size and mtime."""
+    return f"{st.st_ino:x}-{st.st_size:x}-{st.st_mtime_ns:x}"
+
+
+@app.template_test("thumbnailable")
+def is_thumbnailable(name):
+    return has_derivatives(mimetypes.guess_type(name)[0])
+
+
+@app.template_filter("mtime")
+def format_mtime(value):
+    if value is None:
+        return "-"
+    return time.strftime("%Y-%m-%d %H:%M", time.localtime(value))
+
+
+# -----------------------------------------
+
+# ---------------- MIME Detection ----------------
+SNIFF_BYTES = 4096
+# (offset, signature, type); checked in order, first match wins
+MAGIC_NUMBERS = (
+    (0, b"\x89PNG\r\n\x1a\n", "image/png"),
+    (0, b"\xff\xd8\xff", "image/jpeg"),
+    (0, b"GIF87a", "image/gif"),
+    (0, b"GIF89a", "image/gif"),
+    (8, b"WEBP", "image/webp"),
+    (0, b"II*\x00", "image/tiff"),
+    (0, b"MM\x00*", "image/tiff"),
+    (0, b"%PDF-", "application/pdf"),
+    (0, b"PK\x03\x04", "application/zip"),
+    (0, b"\x1f\x8b", "application/gzip"),
+    (0, b"(\xb5/\xfd", "application/zstd"),
+    (0, b"BZh", "application/x-bzip2"),
+    (0, b"\xfd7zXZ\x00", "application/x-xz"),
+    (0, b"7z\xbc\xaf\x27\x1c", "application/x-7z-compressed"),
+    (257, b"ustar", "application/x-tar"),
+    (0, b"SQLite format 3\x00", "application/vnd.sqlite3"),
+    (0, b"\x7fELF", "application/x-executable"),
+    (4, b"ftyp", "video/mp4"),
+    (0, b"\x1aE\xdf\xa3", "video/webm"),
+    (0, b"OggS", "audio/ogg"),
+    (0, b"fLaC", "audio/flac"),
+    (0, b"ID3", "audio/mpeg"),
+    (8, b"WAVE", "audio/wav"),
+)
+# Extension-derived types that say nothing about the content
+GENERIC_TYPES = (None, "application/octet-stream")
+
+
+def sniff_mime(head):
+    """
+    Content type from the first bytes of a file: a known magic number,
+    else text/plain for UTF-8 (or UTF-16 with BOM) text without NUL bytes,
+    else application/octet-stream. Never guesses HTML, so sniffed files
+    are always safe to show inline.
+    """
+    for offset, signature, mime in MAGIC_NUMBERS:
+        if head.startswith(signature, offset):
+            return mime
+    if head.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        return "text/plain"
+    if b"\x00" in head:
+        return "application/octet-stream"
+    try:
+        # A multi-byte character cut off by the read limit is fine
+        codecs.getincrementaldecoder("utf-8")().decode(head, final=len(head) < SNIFF_BYTES)
+    except UnicodeDecodeError:
+        return "application/octet-stream"
+    return "text/plain"
+
+
+class MimeCache:
+    """
+    Content type per file version: the extension's type where it has one,
+    otherwise the sniffed type of the first SNIFF_BYTES. Results are kept
+    in a bounded LRU keyed by the file's etag (inode, size, mtime), so each
+    version is read at most once and a rewrite in place is sniffed again.
+    """
+
+    def __init__(self, max_entries=MIME_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def lookup(self, path, st=None, f=None):
+        """
+        Type of the file at ``path``. Pass its stat result and, if it is
+        already open, the file object (read with pread, so its position is
+        untouched); an unreadable file is application/octet-stream.
+        """
+        mime = mimetypes.guess_type(path)[0]
+        if mime not in GENERIC_TYPES:
+            return mime
+        try:
+            if st is None:
+                st = os.stat(path)
+        except OSError:
+            return "application/octet-stream"
+        key = make_etag(st)
+        with self._lock:
+            mime = self._entries.get(key)
+            if mime is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return mime
+            self.misses += 1
+
+        try:
+            if f is not None:
+                head = os.pread(f.fileno(), SNIFF_BYTES, 0)
+            else:
+                count_fs("open")
+                with open(path, "rb") as src:
+                    head = src.read(SNIFF_BYTES)
+        except OSError:
+            return "application/octet-stream"
+        mime = sniff_mime(head)
+        with self._lock:
+            self._entries[key] = mime
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return mime
+
+    def known(self, name, etag):
+        """
+        Type of a listed file without any I/O: the extension's type, or the
+        type sniffed earlier for this etag; None if it still needs sniffing.
+        """
+        mime = mimetypes.guess_type(name)[0]
+        if mime not in GENERIC_TYPES:
+            return mime
+        with self._lock:
+            return self._entries.get(etag)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._entries)}
+
+
+MIME_CACHE = MimeCache()
+
+
+def detect_mime(path, st=None, f=None):
+    return MIME_CACHE.lookup(path, st, f)
+
+
+# -----------------------------------------
+
+# ---------------- Templates ----------------
+# Compiled once at import time (after the custom filters are registered)
+LOGIN_TEMPLATE = app.jinja_env.from_string(LOGIN_HTML)
+LIST_TEMPLATE = app.jinja_env.from_string(LIST_HTML)
+DIR_LIST_TEMPLATE = app.jinja_env.from_string(DIR_LIST_HTML)
+TEXT_VIEW_TEMPLATE = app.jinja_env.from_string(TEXT_VIEW_HTML)
+NO_PREVIEW_TEMPLATE = app.jinja_env.from_string(NO_PREVIEW_HTML)
+SEARCH_TEMPLATE = app.jinja_env.from_string(SEARCH_HTML)
+
+STYLE_BYTES = COMMON_STYLE.encode("utf-8")
+STYLE_DIGEST = hashlib.sha256(STYLE_BYTES).hexdigest()[:16]
+
+
+@app.context_processor
+def inject_style_url():
+    return {"style_url": url_for("stylesheet", digest=STYLE_DIGEST)}
+
+
+@app.route("/assets/style-<digest>.css")
+def stylesheet(digest):
+    # The URL changes whenever the CSS does, so clients may cache it forever
+    if digest != STYLE_DIGEST:
+        abort(404)
+    response = Response(STYLE_BYTES, mimetype="text/css")
+    response.set_etag(STYLE_DIGEST)
+    response.cache_control.public = True
+    response.cache_control.max_age = 31536000
+    response.cache_control.immutable = True
+    return response.make_conditional(request)
+
+
+def stream_page(template, **context):
+    """
+    Render a compiled template incrementally so the first bytes of a large
+    listing go out before the whole table is built.
+    """
+    app.update_template_context(context)
+    stream = template.stream(context)
+    stream.enable_buffering(STREAM_BUFFER_EVENTS)
+    if METRICS is not None:
+        stream = timed_stream(stream, "render")
+    return Response(stream_with_context(stream), mimetype="text/html")
+
+
+def timed_stream(chunks, name):
+    """Attribute the time spent producing each chunk (not sending it) to a phase."""
+    spent = 0.0
+    iterator = iter(chunks)
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                chunk = next(iterator)
+            except StopIteration:
+                break
+            finally:
+                spent += time.perf_counter() - start
+            yield chunk
+    finally:
+        METRICS.observe_phase(name, spent)
+
+
+# -------------------------------------------
+
+# ---------------- Listing Cache ----------------
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+_INOTIFY_EVENT = struct.Struct("iIII")
+
+
+class Inotify:
+    """
+    Minimal ctypes binding for Linux inotify. A daemon thread reads events and
+    calls ``callback(path)`` with the watched directory that changed
+    (``callback(None)`` when the kernel queue overflowed). ``available`` is
+    False on platforms without inotify, in which case callers fall back to
+    polling.
+    """
+
+    MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+            | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+
+    def __init__(self, callback):
+        self.callback = callback
+        self.available = False
+        self._lock = threading.Lock()
+        self._wds = {}
+        self._paths = {}
+        try:
+            self._libc = ctypes.CDLL(ctypes.util.find_library("c") or None, use_errno=True)
+            self._fd = self._libc.inotify_init1(os.O_CLOEXEC)
+        except (OSError, AttributeError):
+            return
+        if self._fd < 0:
+            return
+        self.available = True
+        threading.Thread(target=self._run, name="inotify", daemon=True).start()
+
+    def add_watch(self, path):
+        with self._lock:
+            if path in self._wds:
+                return True
+            wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), self.MASK)
+            if wd < 0:
+                return False
+            self._wds[path] = wd
+            self._paths[wd] = path
+            return True
+
+    def remove_watch(self, path):
+        with self._lock:
+            wd = self._wds.pop(path, None)
+            if wd is None:
+                return
+            self._paths.pop(wd, None)
+            self._libc.inotify_rm_watch(self._fd, wd)
+
+    def is_watched(self, path):
+        return path in self._wds
+
+    def clear(self):
+        for path in list(self._wds):
+            self.remove_watch(path)
+
+    def _run(self):
+        while True:
+            try:
+                buf = os.read(self._fd, 64 * 1024)
+            except InterruptedError:
+                continue
+            except OSError:
+                return
+            offset = 0
+            while offset < len(buf):
+                wd, mask, _cookie, length = _INOTIFY_EVENT.unpack_from(buf, offset)
+                offset += _INOTIFY_EVENT.size + length
+                if mask & IN_Q_OVERFLOW:
+                    self.callback(None)
+                    continue
+                with self._lock:
+                    path = self._paths.get(wd)
+                    if mask & IN_IGNORED and path is not None:
+                        self._paths.pop(wd, None)
+                        self._wds.pop(path, None)
+                if path is not None:
+                    self.callback(path)
+
+
+class _CachedListing:
+    __slots__ = ("acl_version", "signature", "loaded_at", "entries")
+
+    def __init__(self, acl_version, signature, loaded_at, entries):
+        self.acl_version = acl_version
+        self.signature = signature
+        self.loaded_at = loaded_at
+        self.entries = entries
+
+
+class ListingCache:
+    """
+    LRU cache of filtered directory listings, keyed by directory and
+    allow-list version (each distinct per-user rule set has its own
+    version). Directories are invalidated by inotify events; when a
+    watch cannot be set up the cached listing is revalidated by the
+    directory's mtime/inode and expires after ``ttl`` seconds.
+    Cached entries are shared between requests and must not be mutated.
+    """
+
+    def __init__(self, max_entries=LISTING_CACHE_SIZE, ttl=LISTING_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # (path, acl version) -> _CachedListing
+        self._paths = {}  # path -> number of cached versions
+        self._pending = {}
+        self._inotify = None
+        self._pid = None
+
+    def _watcher(self):
+        # Threads do not survive fork(), so every worker process gets its own watcher
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._inotify = Inotify(self.invalidate)
+        return self._inotify
+
+    @staticmethod
+    def _signature(path):
+        try:
+            count_fs("stat")
+            st = os.stat(path)
+        except OSError:
+            return None
+        return (st.st_ino, st.st_mtime_ns)
+
+    def get(self, path, acl_version, loader):
+        """Return the cached listing of ``path`` or build it with ``loader()``."""
+        if self.max_entries <= 0:
+            return loader()
+        watcher = self._watcher()
+        watched = watcher.available and watcher.is_watched(path)
+        now = time.monotonic()
+        signature = None if watched else self._signature(path)
+
+        key = (path, acl_version)
+        with self._lock:
+            cached = self._entries.get(key)
+            if (cached is not None
+                    and (watched or (cached.signature == signature
+                                     and now - cached.loaded_at < self.ttl))):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return cached.entries
+            self.misses += 1
+            token = self._pending[key] = object()
+
+        # The watch goes in before the scan so no change can slip between them
+        if watcher.available and not watched:
+            watched = watcher.add_watch(path)
+        entries = loader()
+
+        with self._lock:
+            if self._pending.get(key) is not token:
+                return entries
+            del self._pending[key]
+            if key not in self._entries:
+                self._paths[path] = self._paths.get(path, 0) + 1
+            self._entries[key] = _CachedListing(acl_version, signature, now, entries)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                (evicted, _), _ = self._entries.popitem(last=False)
+                self.evictions += 1
+                self._paths[evicted] -= 1
+                if not self._paths[evicted]:
+                    del self._paths[evicted]
+                    if watcher.available:
+                        watcher.remove_watch(evicted)
+        return entries
+
+    def invalidate(self, path=None):
+        """Drop one directory (or everything, when ``path`` is None)."""
+        # A renamed or deleted subfolder must not stay resolvable either
+        PATH_RESOLVER.invalidate(path)
+        with self._lock:
+            self.invalidations += 1
+            if path is None:
+                self._entries.clear()
+                self._paths.clear()
+                self._pending.clear()
+            elif self._paths.pop(path, None) is not None or self._pending:
+                for key in [key for key in self._entries if key[0] == path]:
+                    del self._entries[key]
+                for key in [key for key in self._pending if key[0] == path]:
+                    del self._pending[key]
+
+    def stats(self):
+        watcher = self._inotify
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "size": len(self._entries),
+            "max_entries": self.max_entries,
+            "inotify": bool(watcher and watcher.available),
+        }
+
+
+LISTING_CACHE = ListingCache()
+
+# Sort keys always end with the name, so every key is unique inside a directory
+SORT_KEYS = {
+    "name": lambda e: (e["name"],),
+    "size": lambda e: (-1 if e["size"] is None else e["size"], e["name"]),
+    "mtime": lambda e: (0.0 if e["mtime"] is None else float(e["mtime"]), e["name"]),
+}
+SORT_KEY_TYPES = {
+    "name": (str,),
+    "size": (int, str),
+    "mtime": (float, str),
+}
+
+
+class ListingIndex:
+    """
+    A directory listing together with lazily built sort orders. Each order is
+    kept as a sorted list plus its key list, so a page is located with one
+    bisect on the cursor key and costs O(log n + page size).
+    """
+
+    def __init__(self, entries, parent_path=""):
+        self.entries = entries
+        self.parent_path = parent_path
+        self._orders = {"name": (entries, [SORT_KEYS["name"](e) for e in entries])}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _order(self, sort):
+        order = self._orders.get(sort)
+        if order is None:
+            key = SORT_KEYS[sort]
+            ordered = sorted(self.entries, key=key)
+            order = self._orders[sort] = (ordered, [key(e) for e in ordered])
+        return order
+
+    def page(self, sort="name", order="asc", limit=None, cursor=None):
+        """
+        Return ``(items, next_cursor)``. ``cursor`` is the sort key of the last
+        item of the previous page; ``next_cursor`` is None on the last page.
+        """
+        ordered, keys = self._order(sort)
+        if order == "asc":
+            start = 0 if cursor is None else bisect_right(keys, cursor)
+            stop = len(ordered) if limit is None else min(len(ordered), start + limit)
+            items = ordered[start:stop]
+            more = stop < len(ordered)
+            last = stop - 1
+        else:
+            stop = len(ordered) if cursor is None else bisect_left(keys, cursor)
+            start = 0 if limit is None else max(0, stop - limit)
+            items = ordered[start:stop][::-1]
+            more = start > 0
+            last = start
+        return items, (keys[last] if more and items else None)
+
+
+def encode_cursor(key):
+    raw = json.dumps(list(key), separators=(",", ":"), ensure_ascii=False)
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor, sort):
+    """Decode a cursor produced by encode_cursor(); None if it is malformed."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        key = json.loads(raw.decode("utf-8"))
+    except (ValueError, UnicodeDecodeError):
+        return None
+    types = SORT_KEY_TYPES[sort]
+    if not isinstance(key, list) or len(key) != len(types):
+        return None
+    key = tuple(float(v) if t is float and isinstance(v, int) and not isinstance(v, bool) else v
+                for v, t in zip(key, types))
+    if not all(type(v) is t for v, t in zip(key, types)):
+        return None
+    return key
+
+
+def cached_listing(path, parent_path="", skip=()):
+    """scan_directory() served through LISTING_CACHE, as a ListingIndex."""
+    rules = current_rules()
+    return LISTING_CACHE.get(
+        path, rules.version,
+        lambda: ListingIndex(scan_directory(path, parent_path=parent_path, skip=skip, rules=rules),
+                             parent_path))
+
+
+def parse_listing_args(default_limit=LISTING_PAGE_SIZE):
+    """Validate ``?sort=&order=&limit=&cursor=``; aborts with 400 on bad input."""
+    sort = request.args.get("sort", "name")
+    order = request.args.get("order", "asc")
+    if sort not in SORT_KEYS or order not in ("asc", "desc"):
+        abort(400)
+    limit = request.args.get("limit")
+    if limit is None:
+        limit = default_limit
+    else:
+        try:
+            limit = int(limit)
+        except ValueError:
+            abort(400)
+        if limit <= 0:
+            abort(400)
+    if limit is not None:
+        limit = min(limit, LISTING_MAX_PAGE_SIZE)
+    cursor = request.args.get("cursor")
+    cursor_key = None
+    if cursor:
+        cursor_key = decode_cursor(cursor, sort)
+        if cursor_key is None:
+            abort(400)
+    return sort, order, limit, cursor_key
+
+
+def listing_page(listing):
+    """
+    Apply ``?limit=&cursor=&sort=name|size|mtime&order=asc|desc`` to a
+    ListingIndex. Returns the page items and a dict describing the pager.
+    """
+    sort, order, limit, cursor_key = parse_listing_args()
+    cursor = request.args.get("cursor")
+    items, next_key = listing.page(sort, order, limit, cursor_key)
+    items = annotate_digests(items, listing.parent_path)
+
+    def link(**changes):
+        args = dict(request.view_args or {})
+        args.update(sort=sort, order=order,
+                    limit=limit if limit != LISTING_PAGE_SIZE else None)
+        args.update(changes)
+        if args["sort"] == "name" and args["order"] == "asc":
+            args["sort"] = args["order"] = None
+        return url_for(request.endpoint, **{k: v for k, v in args.items() if v is not None})
+
+    pager = {
+        "sort": sort,
+        "order": order,
+        "limit": limit,
+        "total": len(listing),
+        "next_cursor": encode_cursor(next_key) if next_key is not None else None,
+        "next_url": link(cursor=encode_cursor(next_key)) if next_key is not None else None,
+        "first_url": link() if cursor else None,
+        "sort_urls": {
+            key: link(sort=key, order="desc" if key == sort and order == "asc" else "asc")
+            for key in SORT_KEYS
+        },
+    }
+    return items, pager
+
+
+# -----------------------------------------------
+
+# ---------------- Text Preview ----------------
+def preview_window(size):
+    """
+    Work out the byte window for ``?offset=&length=&tail=1``, capped at
+    PREVIEW_MAX_BYTES. Aborts with 400 on malformed values.
+    """
+    try:
+        offset = int(request.args.get("offset", 0))
+        length = int(request.args.get("length", PREVIEW_MAX_BYTES))
+    except ValueError:
+        abort(400)
+    if offset < 0 or length <= 0:
+        abort(400)
+    length = min(length, PREVIEW_MAX_BYTES)
+    tail = request.args.get("tail") not in (None, "", "0")
+    if tail:
+        offset = max(0, size - length)
+    offset = min(offset, size)
+    return offset, min(length, size - offset), tail
+
+
+def iter_text_chunks(f, offset, length, skip_partial_line=False):
+    """
+    Yield ``length`` bytes of ``f`` starting at ``offset`` as decoded text,
+    PREVIEW_CHUNK_SIZE at a time through an mmap, so memory stays bounded
+    regardless of file size. Closes ``f`` when done.
+    """
+    try:
+        if length <= 0:
+            return
+        count_fs("fstat")
+        if os.fstat(f.fileno()).st_size == 0:
+            # Truncated since the caller's stat: mmap() refuses empty files,
+            # and an empty file has an empty preview
+            return
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            start, end = offset, min(offset + length, len(mm))
+            if skip_partial_line and start > 0:
+                newline = mm.find(b"\n", start, end)
+                if newline != -1:
+                    start = newline + 1
+            # Never start decoding in the middle of a UTF-8 sequence
+            while start < end and 0x80 <= mm[start] < 0xC0:
+                start += 1
+            for pos in range(start, end, PREVIEW_CHUNK_SIZE):
+                yield decoder.decode(mm[pos:min(pos + PREVIEW_CHUNK_SIZE, end)])
+            yield decoder.decode(b"", final=True)
+    finally:
+        f.close()
+
+
+def render_text_preview(file_path, display_name, download_url):
+    """Stream a bounded window of a text file into TEXT_VIEW_TEMPLATE."""
+    try:
+        count_fs("open")
+        f = open(file_path, "rb")
+        count_fs("fstat")
+        size = os.fstat(f.fileno()).st_size
+    except OSError as e:
+        return stream_page(TEXT_VIEW_TEMPLATE, filename=display_name, window=None,
+                           content=[f"Unable to read file: {e}"], download_url=download_url)
+
+    offset, length, tail = preview_window(size)
+
+    def link(**args):
+        return url_for(request.endpoint, **(request.view_args or {}), **args)
+
+    window = {
+        "start": offset,
+        "end": offset + length,
+        "size": size,
+        "partial": offset > 0 or offset + length < size,
+        "prev_url": link(offset=max(0, offset - PREVIEW_MAX_BYTES), length=PREVIEW_MAX_BYTES)
+        if offset > 0 else None,
+        "next_url": link(offset=offset + length, length=PREVIEW_MAX_BYTES)
+        if offset + length < size else None,
+        "tail_url": link(tail=1),
+    }
+    content = iter_text_chunks(f, offset, length, skip_partial_line=tail)
+    return stream_page(TEXT_VIEW_TEMPLATE, filename=display_name, window=window,
+                       content=content, download_url=download_url)
+
+
+# -----------------------------------------------
+
+# ---------------- File Transfer ----------------
+DOWNLOAD_MODES = ("python", "sendfile", "x-accel-redirect", "x-sendfile")
+if DOWNLOAD_MODE not in DOWNLOAD_MODES:
+    print(f"WARNING: SHARE_DOWNLOAD_MODE={DOWNLOAD_MODE!r} is not one of {DOWNLOAD_MODES}, using 'python'")
+    DOWNLOAD_MODE = "python"
+
+
+def content_disposition(headers, filename, as_attachment):
+    """Set Content-Disposition the way werkzeug's send_file does (RFC 6266)."""
+    kind = "attachment" if as_attachment else "inline"
+    try:
+        filename.encode("ascii")
+        headers.set("Content-Disposition", kind, filename=filename)
+    except UnicodeEncodeError:
+        simple = unicodedata.normalize("NFKD", filename).encode("ascii", "ignore").decode("ascii")
+        quoted = quote(filename, safe="!#$&+-.^_`|~")
+        headers.set("Content-Disposition", kind, filename=simple,
+                    **{"filename*": f"UTF-8''{quoted}"})
+
+
+def iter_file(f, start, stop, chunk_size=TRANSFER_CHUNK_SIZE):
+    """Yield bytes [start, stop) of an open file, then close it."""
+    try:
+        f.seek(start)
+        remaining = stop - start
+        while remaining > 0:
+            data = f.read(min(chunk_size, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+    finally:
+        f.close()
+
+
+def iter_byteranges(f, parts, chunk_size=TRANSFER_CHUNK_SIZE):
+    """Yield a multipart/byteranges body; ``parts`` is [(preamble, start, stop)] plus a trailer."""
+    try:
+        for preamble, start, stop in parts:
+            yield preamble
+            if start is None:
+                continue
+            f.seek(start)
+            remaining = stop - start
+            while remaining > 0:
+                data = f.read(min(chunk_size, remaining))
+                if not data:
+                    break
+                remaining -= len(data)
+                yield data
+    finally:
+        f.close()
+
+
+def file_body(f, start, stop):
+    """
+    Response body for bytes [start, stop) of ``f``. In sendfile mode a
+    server-provided wsgi.file_wrapper (gunicorn, the built-in launcher) gets
+    the file positioned at ``start`` and pushes it to the socket with
+    os.sendfile(). Wrappers with a ``length`` attribute (SendfileWrapper,
+    AsgiFileWrapper) are bounded to the range; any other wrapper is only
+    used when the range runs to end of file. Otherwise the bytes are read
+    through the worker in TRANSFER_CHUNK_SIZE pieces.
+    """
+    if request.method == "HEAD":
+        f.close()
+        return []
+    wrapper = request.environ.get("wsgi.file_wrapper")
+    # Paced downloads have to pass through the worker, so no zero-copy then
+    if DOWNLOAD_MODE == "sendfile" and wrapper is not None and DOWNLOAD_LIMITER is None:
+        f.seek(start)
+        body = wrapper(f, TRANSFER_CHUNK_SIZE)
+        if hasattr(body, "length"):
+            body.length = stop - start
+            return body
+        # Other wrappers may read on to end of file, past the range
+        if stop == os.fstat(f.fileno()).st_size:
+            return body
+    return iter_file(f, start, stop)
+
+
+def offload_response(file_path, rel_path, mime, as_attachment):
+    """
+    Hand the transfer to the front proxy: nginx (X-Accel-Redirect, mapped
+    under SHARE_ACCEL_PREFIX to an internal location) or Apache/lighttpd
+    (X-Sendfile). The proxy then takes care of ranges and validators.
+    """
+    response = Response(mimetype=mime)
+    response.headers["Cache-Control"] = (current_rules().cache_policy(rel_path)
+                                         or DEFAULT_CACHE_CONTROL)
+    content_disposition(response.headers, os.path.basename(file_path), as_attachment)
+    if DOWNLOAD_MODE == "x-accel-redirect":
+        response.headers["X-Accel-Redirect"] = ACCEL_REDIRECT_PREFIX.rstrip("/") + "/" + quote(rel_path)
+    else:
+        response.headers["X-Sendfile"] = os.path.realpath(file_path)
+    return response
+
+
+def satisfiable_ranges(parsed_range, size):
+    """
+    Normalize a parsed Range header into sorted, merged (start, stop) pairs
+    that lie inside a file of ``size`` bytes.
+    """
+    ranges = []
+    for begin, end in parsed_range.ranges:
+        if begin < 0:
+            start, stop = max(0, size + begin), size
+        else:
+            start, stop = begin, size if end is None else min(end, size)
+        if start < stop:
+            ranges.append((start, stop))
+    ranges.sort()
+    merged = []
+    for start, stop in ranges:
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], stop))
+        else:
+            merged.append((start, stop))
+    return merged
+
+
+def check_preconditions(etag, mtime):
+    """
+    Evaluate If-Match / If-Unmodified-Since / If-None-Match /
+    If-Modified-Since in RFC 9110 order. Returns 412, 304 or None.
+    """
+    if request.if_match:
+        if not (request.if_match.star_tag or request.if_match.contains(etag)):
+            return 412
+    elif request.if_unmodified_since and mtime > request.if_unmodified_since.timestamp():
+        return 412
+
+    if request.if_none_match:
+        if request.if_none_match.star_tag or request.if_none_match.contains_weak(etag):
+            return 304
+    elif request.if_modified_since and mtime <= request.if_modified_since.timestamp():
+        return 304
+    return None
+
+
+def range_applies(etag, mtime):
+    """If-Range: only honour Range when the client's validator is still current."""
+    if_range = request.if_range
+    if if_range.etag is not None:
+        return if_range.etag == etag
+    if if_range.date is not None:
+        return mtime == int(if_range.date.timestamp())
+    return True
+
+
+def send_shared_file(file_path, rel_path, as_attachment):
+    """
+    Send a file that already passed is_allowed() and the containment checks,
+    with strong ETag / Last-Modified validators, conditional GET (304/412),
+    single and multiple byte ranges (206/416) and the Cache-Control policy of
+    the matching "@cache-control" rule.
+    """
+    if DOWNLOAD_MODE in ("x-accel-redirect", "x-sendfile"):
+        mime = detect_mime(file_path)
+        return offload_response(file_path, rel_path, mime, as_attachment)
+
+    try:
+        count_fs("open")
+        f = open(file_path, "rb")
+        count_fs("fstat")
+        st = os.fstat(f.fileno())
+    except OSError:
+        abort(404)
+
+    size = st.st_size
+    mtime = int(st.st_mtime)
+    etag = make_etag(st)
+    mime = detect_mime(file_path, st, f)
+
+    response = Response(mimetype=mime, direct_passthrough=True)
+    response.last_modified = mtime
+    response.headers["Cache-Control"] = (current_rules().cache_policy(rel_path)
+                                         or DEFAULT_CACHE_CONTROL)
+    response.headers["Accept-Ranges"] = "bytes"
+    content_disposition(response.headers, os.path.basename(file_path), as_attachment)
+
+    # Compressible files get a cached compressed copy, unless a byte range was asked for
+    encoding = None
+    if (request.range is None and is_compressible(mime)
+            and COMPRESS_MIN_SIZE <= size <= COMPRESS_MAX_FILE_SIZE):
+        response.vary.add("Accept-Encoding")
+        encoding = negotiate_encoding()
+
+    representation_etag = etag if encoding is None else f"{etag}-{encoding}"
+    response.set_etag(representation_etag)
+    status = check_preconditions(representation_etag, mtime)
+    if status is not None:
+        f.close()
+        response.status_code = status
+        if status == 412:
+            response.headers.pop("Content-Disposition")
+        return response
+
+    if encoding is not None:
+        artifact = compressed_artifact(f, etag, encoding)
+        try:
+            compressed = open(artifact, "rb") if artifact is not None else None
+        except OSError:
+            compressed = None
+        if compressed is not None:
+            f.close()
+            response.content_encoding = encoding
+            response.content_length = os.fstat(compressed.fileno()).st_size
+            response.response = file_body(compressed, 0, response.content_length)
+            return response
+        response.set_etag(etag)
+
+    if METADATA_INDEX is not None:
+        digest = METADATA_INDEX.digest(rel_path, etag)
+        if digest is not None:
+            response.headers["Repr-Digest"] = f"sha-256=:{base64.b64encode(bytes.fromhex(digest)).decode()}:"
+
+    ranges = None
+    if request.range is not None and request.range.units == "bytes" and range_applies(etag, mtime):
+        ranges = satisfiable_ranges(request.range, size)
+        if not ranges:
+            f.close()
+            response.status_code = 416
+            response.headers["Content-Range"] = f"bytes */{size}"
+            response.headers.pop("Content-Disposition")
+            return response
+        if len(ranges) > MAX_RANGES:
+            ranges = None
+
+    if not ranges:
+        response.response = file_body(f, 0, size)
+        response.content_length = size
+        return response
+
+    response.status_code = 206
+    if len(ranges) == 1:
+        start, stop = ranges[0]
+        response.headers["Content-Range"] = f"bytes {start}-{stop - 1}/{size}"
+        response.response = file_body(f, start, stop)
+        response.content_length = stop - start
+        return response
+
+    boundary = secrets.token_hex(16)
+    parts = []
+    for i, (start, stop) in enumerate(ranges):
+        preamble = (f"--{boundary}\r\n"
+                    f"Content-Type: {mime}\r\n"
+                    f"Content-Range: bytes {start}-{stop - 1}/{size}\r\n\r\n").encode("latin-1")
+        parts.append(((b"\r\n" if i else b"") + preamble, start, stop))
+    parts.append((f"\r\n--{boundary}--\r\n".encode("latin-1"), None, None))
+    response.mimetype = "multipart/byteranges"
+    response.headers["Content-Type"] = f"multipart/byteranges; boundary={boundary}"
+    if request.method == "HEAD":
+        f.close()
+        response.response = []
+    else:
+        response.response = iter_byteranges(f, parts)
+    response.content_length = sum(len(p) + (0 if s is None else e - s) for p, s, e in parts)
+    return response
+
+
+# -----------------------------------------------
+
+# ---------------- Compression ----------------
+# Preference order when the client accepts several encodings equally
+CONTENT_ENCODINGS = tuple(enc for enc, available in (("zstd", zstandard is not None),
+                                                     ("br", brotli is not None),
+                                                     ("gzip", True)) if available)
+COMPRESSIBLE_TYPES = frozenset({
+    "application/json", "application/x-ndjson", "application/javascript",
+    "application/xml", "image/svg+xml",
+})
+
+
+class StreamCompressor:
+    """Incremental gzip / brotli / zstd compressor with a common interface."""
+
+    def __init__(self, encoding):
+        self.encoding = encoding
+        if encoding == "gzip":
+            self._obj = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, 31)
+        elif encoding == "br":
+            self._obj = brotli.Compressor(quality=min(COMPRESS_LEVEL, 11))
+        elif encoding == "zstd":
+            self._obj = zstandard.ZstdCompressor(level=COMPRESS_LEVEL).compressobj()
+        else:
+            raise ValueError(f"unsupported encoding: {encoding}")
+
+    def compress(self, data):
+        if self.encoding == "br":
+            return self._obj.process(data)
+        return self._obj.compress(data)
+
+    def flush(self):
+        """Emit everything buffered so far without ending the stream."""
+        if self.encoding == "gzip":
+            return self._obj.flush(zlib.Z_SYNC_FLUSH)
+        if self.encoding == "br":
+            return self._obj.flush()
+        return self._obj.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self):
+        if self.encoding == "br":
+            return self._obj.finish()
+        return self._obj.flush()
+
+
+def is_compressible(mime):
+    return bool(mime) and (mime.startswith("text/") or mime in COMPRESSIBLE_TYPES
+                           or mime.endswith(("+json", "+xml")))
+
+
+def negotiate_encoding():
+    """Best content-coding both sides support, or None for identity."""
+    if not COMPRESSION_ENABLED:
+        return None
+    return request.accept_encodings.best_match(CONTENT_ENCODINGS)
+
+
+class DiskCache:
+    """
+    Directory of derived files (compressed copies, thumbnails) keyed by
+    string, bounded to ``max_bytes`` with least-recently-used eviction based
+    on file mtime, which is bumped on every hit. Entries are written to a
+    temp file and renamed into place, so concurrent workers never read a
+    partial entry.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._size = None
+        self._lock = threading.Lock()
+
+    def path_for(self, key):
+        return os.path.join(self.directory, hashlib.sha256(key.encode("utf-8")).hexdigest())
+
+    def get(self, key):
+        path = self.path_for(key)
+        try:
+            os.utime(path)
+        except OSError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return path
+
+    def put(self, key, produce):
+        """Create the entry by calling ``produce(fileobj)``; returns its path."""
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as out:
+                produce(out)
+                size = out.tell()
+            path = self.path_for(key)
+            os.replace(tmp, path)
+        except BaseException:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            raise
+        with self._lock:
+            if self._size is not None:
+                self._size += size
+            if self._size is None or self._size > self.max_bytes:
+                self.prune()
+        return path
+
+    def _scan(self):
+        """[(mtime, size, path)] of the entries and their total size."""
+        entries = []
+        total = 0
+        try:
+            with os.scandir(self.directory) as it:
+                for dirent in it:
+                    if dirent.name.startswith(".tmp-"):
+                        continue
+                    try:
+                        st = dirent.stat()
+                    except OSError:
+                        continue
+                    entries.append((st.st_mtime, st.st_size, dirent.path))
+                    total += st.st_size
+        except OSError:
+            pass
+        return entries, total
+
+    def prune(self):
+        """Delete least recently used entries until the cache is at 90% of its budget."""
+        entries, total = self._scan()
+        if total > self.max_bytes:
+            entries.sort()
+            target = self.max_bytes * 0.9
+            for _, size, path in entries:
+                if total <= target:
+                    break
+                try:
+                    os.unlink(path)
+                except OSError:
+                    continue
+                total -= size
+        self._size = total
+
+    def size(self):
+        """Bytes on disk; measured once if nothing has been written by this process yet."""
+        with self._lock:
+            if self._size is None:
+                self._size = self._scan()[1]
+            return self._size
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "bytes": self.size(), "max_bytes": self.max_bytes}
+
+
+COMPRESSED_CACHE = DiskCache(os.path.join(CACHE_DIR, "compressed"), COMPRESS_CACHE_MAX_BYTES)
+
+
+def compressed_artifact(f, etag, encoding):
+    """Path of the ``encoding`` copy of an open file version, compressing it on first use."""
+    key = f"{etag}.{encoding}"
+    path = COMPRESSED_CACHE.get(key)
+    if path is not None:
+        return path
+
+    def produce(out):
+        compressor = StreamCompressor(encoding)
+        f.seek(0)
+        while True:
+            data = f.read(TRANSFER_CHUNK_SIZE)
+            if not data:
+                break
+            out.write(compressor.compress(data))
+        out.write(compressor.finish())
+
+    try:
+        with phase("compress"):
+            return COMPRESSED_CACHE.put(key, produce)
+    except OSError as e:
+        print(f"WARNING: could not cache {encoding} copy: {e}")
+        return None
+
+
+def iter_compressed(chunks, compressor, close=None):
+    """Compress a streamed body, flushing after every chunk so it stays progressive."""
+    try:
+        for chunk in chunks:
+            if chunk:
+                data = compressor.compress(chunk) + compressor.flush()
+                if data:
+                    yield data
+        yield compressor.finish()
+    finally:
+        if close is not None:
+            close()
+
+
+@app.after_request
+def compress_response(response):
+    """
+    Negotiate gzip/br/zstd for compressible generated pages (listings, text
+    previews, JSON). File downloads are handled by send_shared_file(), which
+    serves cached compressed copies instead.
+    """
+    if (response.direct_passthrough or response.status_code != 200
+            or request.method == "HEAD"
+            or "Content-Encoding" in response.headers
+            or "ETag" in response.headers
+            or not is_compressible(response.mimetype)):
+        return response
+    if not response.is_streamed and len(response.get_data()) < COMPRESS_MIN_SIZE:
+        return response
+
+    response.vary.add("Accept-Encoding")
+    encoding = negotiate_encoding()
+    if encoding is None:
+        return response
+
+    compressor = StreamCompressor(encoding)
+    if response.is_streamed:
+        response.response = iter_compressed(response.iter_encoded(), compressor,
+                                            getattr(response.response, "close", None))
+        response.headers.pop("Content-Length", None)
+    else:
+        response.set_data(compressor.compress(response.get_data()) + compressor.finish())
+    response.content_encoding = encoding
+    return response
+
+
+# ---------------- Image Derivatives ----------------
+# Formats Pillow decodes that are worth shrinking (SVG is already small and scalable)
+DERIVATIVE_TYPES = frozenset({"image/jpeg", "image/png", "image/gif", "image/webp",
+                              "image/bmp", "image/tiff"})
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+def render_derivative(path, box):
+    """
+    Decode the image at ``path`` and return it scaled to fit a ``box`` px
+    square, as JPEG bytes (PNG when it has transparency). Runs in the
+    thumbnail process pool.
+    """
+    with Image.open(path) as im:
+        # JPEG decodes straight at 1/2, 1/4 or 1/8 scale when that is still >= box
+        im.draft("RGB", (box, box))
+        im = ImageOps.exif_transpose(im)
+        im.thumbnail((box, box), Image.Resampling.LANCZOS)
+        out = io.BytesIO()
+        if im.mode in ("RGBA", "LA", "PA") or (im.mode == "P" and "transparency" in im.info):
+            im.save(out, "PNG", optimize=True)
+        else:
+            im.convert("RGB").save(out, "JPEG", quality=82, optimize=True, progressive=True)
+    return out.getvalue()
+
+
+PR_SET_PDEATHSIG = 1
+
+
+def init_derivative_worker():
+    """Pool processes follow the worker that owns them and ignore the launcher's signals."""
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    try:
+        ctypes.CDLL(ctypes.util.find_library("c") or None).prctl(PR_SET_PDEATHSIG, signal.SIGTERM)
+    except (OSError, AttributeError):
+        pass
+
+
+class Thumbnailer:
+    """
+    Renders image derivatives in a process pool (decoding and resampling
+    hold the GIL) and keeps them in a DiskCache keyed by source etag and
+    box size, so a file version is decoded once per size across all
+    workers. Concurrent requests for the same derivative wait on one
+    render.
+    """
+
+    def __init__(self, cache, workers=THUMB_WORKERS):
+        self.cache = cache
+        self.workers = workers
+        self.rendered = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+        self._pool = None
+        self._pid = None
+        self._inflight = {}
+
+    def start(self):
+        """
+        Create the pool (once per process). Called before a worker starts
+        serving, so the pool processes fork from a process with no busy
+        request threads.
+        """
+        with self._lock:
+            if self._pid == os.getpid() and self._pool is not None:
+                return self._pool
+            self._pid = os.getpid()
+            self._pool = ProcessPoolExecutor(self.workers, initializer=init_derivative_worker)
+            # fork() every pool process now rather than on the first request
+            self._pool.submit(os.getpid).result()
+            return self._pool
+
+    def stop(self):
+        with self._lock:
+            if self._pool is not None and self._pid == os.getpid():
+                self._pool.shutdown(wait=True, cancel_futures=True)
+            self._pool = None
+
+    def get(self, file_path, etag, box):
+        """Path of the cached ``box`` px derivative of a file version, or None if it cannot be made."""
+        key = f"{etag}-{box}"
+        path = self.cache.get(key)
+        if path is not None:
+            return path
+        with self._lock:
+            pending = self._inflight.get(key)
+            owner = pending is None
+            if owner:
+                pending = self._inflight[key] = Future()
+        if not owner:
+            return pending.result()
+
+        path = None
+        try:
+            with phase("thumbnail"):
+                data = self.start().submit(render_derivative, file_path, box).result()
+            path = self.cache.put(key, lambda out: out.write(data))
+            self.rendered += 1
+        except BrokenProcessPool:
+            print("WARNING: thumbnail worker died; restarting the pool")
+            self.failed += 1
+            with self._lock:
+                self._pool = None
+        except Exception as e:
+            # Corrupt or unsupported images fall back to the original
+            print(f"WARNING: could not render {file_path} at {box}px: {e}")
+            self.failed += 1
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            pending.set_result(path)
+        return path
+
+    def stats(self):
+        return {"rendered": self.rendered, "failed": self.failed, **self.cache.stats()}
+
+
+THUMBNAILER = (Thumbnailer(DiskCache(os.path.join(CACHE_DIR, "thumbnails"), THUMB_CACHE_MAX_BYTES))
+               if THUMBNAILS_ENABLED and Image is not None else None)
+
+
+def has_derivatives(mime):
+    return THUMBNAILER is not None and mime in DERIVATIVE_TYPES
+
+
+def send_derivative(file_path, rel_path, box):
+    """
+    Serve the ``box`` px rendition of an allowed image with its own ETag
+    (source etag + box) and the source's Cache-Control policy; None if it
+    cannot be rendered.
+    """
+    try:
+        st = os.stat(file_path)
+    except OSError:
+        abort(404)
+    etag = make_etag(st)
+    mtime = int(st.st_mtime)
+    response = Response(direct_passthrough=True)
+    response.set_etag(f"{etag}-{box}")
+    response.last_modified = mtime
+    response.headers["Cache-Control"] = (current_rules().cache_policy(rel_path)
+                                         or DEFAULT_CACHE_CONTROL)
+    status = check_preconditions(f"{etag}-{box}", mtime)
+    if status is not None:
+        response.status_code = status
+        return response
+
+    path = THUMBNAILER.get(file_path, etag, box)
+    try:
+        f = open(path, "rb") if path is not None else None
+    except OSError:
+        f = None
+    if f is None:
+        return None
+    response.mimetype = "image/png" if f.read(len(PNG_SIGNATURE)) == PNG_SIGNATURE else "image/jpeg"
+    response.content_length = os.fstat(f.fileno()).st_size
+    response.response = file_body(f, 0, response.content_length)
+    return response
+
+
+# -----------------------------------------------
+
+# ---------------- Folder Archives ----------------
+ARCHIVE_FORMATS = {
+    "zip": "application/zip",
+    "tar.gz": "application/gzip",
+}
+if zstandard is not None:
+    ARCHIVE_FORMATS["tar.zst"] = "application/zstd"
+
+
+class _ChunkSink:
+    """Write-only file object that collects output until the generator drains it."""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        if data:
+            self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def walk_allowed_files(folder_path, rel_folder, rules=None):
+    """
+    Yield (absolute path, archive path, stat) for every file under
+    ``folder_path`` that filter_allowed_items() lets through, descending only
+    into allowed folders, at most MAX_DEPTH levels deep, and following links
+    only under the same rule as PathResolver.
+    """
+    seen = set()
+    stack = [(folder_path, rel_folder)]
+    while stack:
+        real, rel = stack.pop()
+        try:
+            st = os.stat(real)
+            entries = scan_directory(real, parent_path=rel, rules=rules)
+        except OSError:
+            continue
+        if (st.st_dev, st.st_ino) in seen:
+            continue
+        seen.add((st.st_dev, st.st_ino))
+
+        for entry in reversed(entries):
+            child_real = PathResolver._child(real, entry["name"])
+            if child_real is None:
+                continue
+            child_rel = f"{rel}/{entry['name']}" if rel else entry["name"]
+            if entry["type"] == "Folder":
+                if child_rel.count("/") + 1 < MAX_DEPTH:
+                    stack.append((child_real, child_rel))
+            elif entry["type"] == "File":
+                try:
+                    yield child_real, child_rel, os.stat(child_real)
+                except OSError:
+                    continue
+
+
+def iter_file_exact(path, size):
+    """Yield exactly ``size`` bytes of a file, zero-padding if it shrank meanwhile."""
+    remaining = size
+    try:
+        with open(path, "rb") as f:
+            while remaining > 0:
+                data = f.read(min(TRANSFER_CHUNK_SIZE, remaining))
+                if not data:
+                    break
+                remaining -= len(data)
+                yield data
+    except OSError:
+        pass
+    while remaining > 0:
+        pad = min(TRANSFER_CHUNK_SIZE, remaining)
+        remaining -= pad
+        yield bytes(pad)
+
+
+def iter_zip(files):
+    sink = _ChunkSink()
+    with zipfile.ZipFile(sink, mode="w", allowZip64=True) as zf:
+        for path, arcname, st in files:
+            info = zipfile.ZipInfo(arcname, time.localtime(st.st_mtime)[:6])
+            info.external_attr = (st.st_mode & 0xFFFF) << 16
+            mime = detect_mime(path, st)
+            info.compress_type = zipfile.ZIP_DEFLATED if is_compressible(mime) else zipfile.ZIP_STORED
+            info.file_size = st.st_size
+            with zf.open(info, mode="w", force_zip64=st.st_size > 0x7FFFFFFF) as dest:
+                for data in iter_file_exact(path, st.st_size):
+                    dest.write(data)
+                    yield sink.drain()
+            yield sink.drain()
+    yield sink.drain()
+
+
+def iter_tar(files, compressor):
+    # The tar stream is assembled by hand so a large member never has to be
+    # buffered: tarfile.addfile() copies a whole member before returning.
+    for path, arcname, st in files:
+        info = tarfile.TarInfo(arcname)
+        info.size = st.st_size
+        info.mtime = int(st.st_mtime)
+        info.mode = stat.S_IMODE(st.st_mode)
+        yield compressor.compress(info.tobuf(tarfile.PAX_FORMAT, "utf-8", "surrogateescape"))
+        for data in iter_file_exact(path, st.st_size):
+            yield compressor.compress(data)
+        remainder = st.st_size % tarfile.BLOCKSIZE
+        if remainder:
+            yield compressor.compress(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+        yield compressor.flush()
+    yield compressor.compress(tarfile.NUL * (tarfile.BLOCKSIZE * 2))
+    yield compressor.finish()
+
+
+def archive_response(folder_path, rel_folder):
+    """Stream an allowed folder as zip / tar.gz / tar.zst without buffering it."""
+    fmt = request.args.get("format", "zip")
+    if fmt not in ARCHIVE_FORMATS:
+        abort(400)
+    files = walk_allowed_files(folder_path, rel_folder)
+    if fmt == "zip":
+        body = iter_zip(files)
+    else:
+        body = iter_tar(files, StreamCompressor("gzip" if fmt == "tar.gz" else "zstd"))
+    response = Response(stream_with_context(chunk for chunk in body if chunk),
+                        mimetype=ARCHIVE_FORMATS[fmt], direct_passthrough=True)
+    content_disposition(response.headers, f"{os.path.basename(rel_folder)}.{fmt}", True)
+    response.headers["Cache-Control"] = "private, no-store"
+    return response
+
+
+# -----------------------------------------------
+
+# ---------------- Search ----------------
+class _SearchTable:
+    """Paths, their trigram postings and the folder -> children map of one index generation."""
+
+    def __init__(self):
+        self.paths = []  # id -> relative path, None once removed
+        self.kinds = []  # id -> "File" | "Folder"
+        self.keys = []  # id -> lowercase path
+        self.ids = {}  # relative path -> id
+        self.children = {}  # relative folder -> set of child paths
+        self.folders = {}  # real path of an indexed folder -> relative path
+        self.postings = {}  # trigram -> array of ids, ascending
+        self.dead = 0
+
+    def add(self, rel_path, kind):
+        key = rel_path.lower()
+        doc = len(self.paths)
+        self.paths.append(rel_path)
+        self.kinds.append(kind)
+        self.keys.append(key)
+        self.ids[rel_path] = doc
+        self.children.setdefault(rel_path.rpartition("/")[0], set()).add(rel_path)
+        for gram in {key[i:i + 3] for i in range(len(key) - 2)}:
+            posting = self.postings.get(gram)
+            if posting is None:
+                posting = self.postings[gram] = array("I")
+            posting.append(doc)
+
+    def remove(self, rel_path):
+        doc = self.ids.pop(rel_path, None)
+        if doc is None:
+            return
+        self.paths[doc] = None
+        self.dead += 1
+        self.children.get(rel_path.rpartition("/")[0], set()).discard(rel_path)
+        for child in self.children.pop(rel_path, ()):
+            self.remove(child)
+
+    def apply(self, batch):
+        """Apply a _SearchBatch: its removals first, then its additions."""
+        for rel_path in batch.removed:
+            self.remove(rel_path)
+        for real, rel in batch.folders:
+            self.folders[real] = rel
+            self.children.setdefault(rel, set())
+        for rel_path, kind in batch.added:
+            self.add(rel_path, kind)
+
+
+class _SearchBatch:
+    """Changes found by scanning the disk, collected without holding the index lock."""
+
+    __slots__ = ("removed", "added", "folders")
+
+    def __init__(self):
+        self.removed = []  # relative paths
+        self.added = []  # (relative path, kind)
+        self.folders = []  # (real path, relative path) of scanned folders
+
+
+class SearchIndex:
+    """
+    In-memory trigram index of every allowed file and folder path. A query
+    takes the smallest posting list among the trigrams of its terms and
+    verifies each candidate with a substring test, so it only touches the
+    paths that can match. Terms shorter than three characters fall back to
+    a linear scan of the lowercased paths.
+
+    The index is built by a background thread and kept current through
+    inotify: a changed folder is rescanned and diffed against the paths
+    indexed under it. Removed paths stay as tombstones until the next full
+    rebuild, which happens when a third of the ids are dead, when the
+    allow-list changes, on inotify overflow, and every ``refresh`` seconds
+    where inotify is unavailable. Results are filtered by the current
+    allow-list in any case.
+    """
+
+    def __init__(self, refresh=SEARCH_REFRESH, debounce=0.5):
+        self.refresh = refresh
+        self.debounce = debounce
+        self.table = _SearchTable()
+        self.acl_version = None
+        self.built_at = None
+        self.polling = True
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._dirty = set()
+        self._rebuild = True
+        self._watcher = None
+        self._pid = None
+
+    @property
+    def ready(self):
+        return self.built_at is not None
+
+    def start(self):
+        """Start (once per process) the thread that builds and maintains the index."""
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._watcher = Inotify(self._on_change)
+            self._rebuild = True
+        self._wake.set()
+        threading.Thread(target=self._run, name="search-index", daemon=True).start()
+
+    def _on_change(self, path):
+        with self._lock:
+            if path is None:
+                self._rebuild = True
+            else:
+                self._dirty.add(path)
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            woke = self._wake.wait(self.refresh)
+            if woke:
+                time.sleep(self.debounce)
+            self._wake.clear()
+            with self._lock:
+                rebuild = self._rebuild or (not woke and self.polling)
+                dirty, self._dirty = self._dirty, set()
+                self._rebuild = False
+            try:
+                if rebuild or indexing_rules().version != self.acl_version:
+                    self.build()
+                else:
+                    for path in dirty:
+                        # Only this thread changes the table, so it can be read
+                        # while scanning; the lock is only needed to change it
+                        batch = self._rescan(path)
+                        if batch is not None:
+                            with self._lock:
+                                self.table.apply(batch)
+                    if self.table.dead * 3 > len(self.table.paths):
+                        with self._lock:
+                            self._rebuild = True
+                        self._wake.set()
+            except Exception:
+                traceback.print_exc()
+
+    def _watch(self, real):
+        if not self.polling and not self._watcher.add_watch(real):
+            self.polling = True
+
+    def _add_tree(self, batch, real, rel, rules):
+        """Collect the contents of one folder that ``rules`` allows, recursively."""
+        stack = [(real, rel)]
+        while stack:
+            real, rel = stack.pop()
+            self._watch(real)
+            try:
+                entries = scan_directory(real, parent_path=rel, rules=rules,
+                                         skip=() if rel else ("allowed_files.txt",))
+            except OSError:
+                continue
+            batch.folders.append((real, rel))
+            for entry in entries:
+                child_real = PathResolver._child(real, entry["name"])
+                if child_real is None:
+                    continue
+                child_rel = f"{rel}/{entry['name']}" if rel else entry["name"]
+                batch.added.append((child_rel, entry["type"]))
+                if entry["type"] == "Folder" and child_rel.count("/") + 1 < MAX_DEPTH:
+                    stack.append((child_real, child_rel))
+
+    def build(self):
+        rules = indexing_rules()
+        self._watcher.clear()
+        self.polling = not self._watcher.available
+        batch = _SearchBatch()
+        self._add_tree(batch, BASE_DIR, "", rules)
+        table = _SearchTable()
+        table.apply(batch)
+        with self._lock:
+            self.table = table
+            self.acl_version = rules.version
+            self.built_at = time.time()
+
+    def _rescan(self, real):
+        """
+        Diff the direct children of one changed folder against the index.
+        Returns a _SearchBatch to apply, or None if the folder is not indexed.
+        """
+        table = self.table
+        rel = table.folders.get(real)
+        if rel is None:
+            return None
+        rules = indexing_rules()
+        try:
+            entries = scan_directory(real, parent_path=rel, rules=rules,
+                                     skip=() if rel else ("allowed_files.txt",))
+        except OSError:
+            entries = []
+        current = {}
+        for entry in entries:
+            child_real = PathResolver._child(real, entry["name"])
+            if child_real is not None:
+                current[f"{rel}/{entry['name']}" if rel else entry["name"]] = (entry["type"], child_real)
+        indexed = {p: table.kinds[table.ids[p]] for p in table.children.get(rel, ()) if p in table.ids}
+        batch = _SearchBatch()
+        for path, kind in indexed.items():
+            if path not in current or current[path][0] != kind:
+                batch.removed.append(path)
+        for path, (kind, child_real) in current.items():
+            if indexed.get(path) != kind:
+                batch.added.append((path, kind))
+                if kind == "Folder" and path.count("/") + 1 < MAX_DEPTH:
+                    self._add_tree(batch, child_real, path, rules)
+        return batch
+
+    def search(self, query, limit=SEARCH_LIMIT):
+        """
+        Paths containing every whitespace-separated term of ``query``
+        (case-insensitive), best first: basename prefix matches, then
+        basename substring matches, then shorter paths. Returns
+        (total matches, [(path, kind), ...]).
+        """
+        terms = query.lower().split()
+        if not terms:
+            return 0, []
+        rules = current_rules()
+        if self.ready and indexing_rules().version != self.acl_version:
+            self._on_change(None)
+        with self._lock:
+            table = self.table
+            candidates = None
+            for term in terms:
+                for i in range(len(term) - 2):
+                    posting = table.postings.get(term[i:i + 3], ())
+                    if candidates is None or len(posting) < len(candidates):
+                        candidates = posting
+            if candidates is None:
+                candidates = range(len(table.paths))
+            matches = []
+            for doc in candidates:
+                path = table.paths[doc]
+                if path is not None and all(term in table.keys[doc] for term in terms):
+                    matches.append((path, table.kinds[doc]))
+
+        def allowed(item):
+            return rules.allows(item[0])
+
+        def rank(item):
+            base = item[0].rpartition("/")[2].lower()
+            first = terms[0]
+            return (0 if base.startswith(first) else 1 if first in base else 2, len(item[0]), item[0])
+
+        matches = [item for item in matches if allowed(item)]
+        return len(matches), heapq.nsmallest(limit, matches, key=rank)
+
+    def stats(self):
+        with self._lock:
+            return {"paths": len(self.table.ids), "dead": self.table.dead,
+                    "trigrams": len(self.table.postings), "inotify": not self.polling,
+                    "built_at": self.built_at}
+
+
+SEARCH_INDEX = SearchIndex() if SEARCH_ENABLED else None
+
+
+def search_request():
+    """Run ``?q=&limit=`` against SEARCH_INDEX; aborts with 400/404 on bad input."""
+    if SEARCH_INDEX is None:
+        abort(404)
+    SEARCH_INDEX.start()
+    query = request.args.get("q", "").strip()
+    try:
+        limit = int(request.args.get("limit", SEARCH_LIMIT))
+    except ValueError:
+        abort(400)
+    if limit <= 0:
+        abort(400)
+    started = time.perf_counter()
+    total, results = SEARCH_INDEX.search(query, min(limit, SEARCH_MAX_LIMIT))
+    return query, total, results, time.perf_counter() - started
+
+
+@app.route("/search")
+def search():
+    if (r := require_login()) is not None:
+        return r
+    query, total, results, elapsed = search_request()
+    return render_template(SEARCH_TEMPLATE, query=query, total=total, results=results,
+                           elapsed_ms=elapsed * 1000, ready=SEARCH_INDEX.ready)
+
+
+@app.route("/api/search")
+def api_search():
+    if (r := require_api_login()) is not None:
+        return r
+    query, total, results, elapsed = search_request()
+    return jsonify(query=query, total=total, ready=SEARCH_INDEX.ready,
+                   items=[{"path": path, "type": kind} for path, kind in results])
+
+
+# -----------------------------------------------
+
+# ---------------- Metadata Index ----------------
+class MetadataIndex:
+    """
+    Persistent size / mtime / MIME / SHA-256 index of allowed files, kept in
+    SQLite. A crawler walks the allowed tree every SHARE_INDEX_INTERVAL
+    seconds and hands files whose etag (inode, size, mtime) differs from the
+    stored row to a pool of SHARE_HASH_WORKERS threads, so an unchanged file
+    costs one stat per pass. A row is only written when the file kept the
+    same etag for the whole hash, and readers only trust a digest whose etag
+    matches the file they are about to describe.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS files (
+            path TEXT PRIMARY KEY,
+            etag TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            mtime REAL NOT NULL,
+            mime TEXT,
+            sha256 TEXT NOT NULL,
+            hashed_at REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS files_sha256 ON files (sha256);
+    """
+    LOOKUP_BATCH = 500
+
+    def __init__(self, db_path, workers=2, interval=60.0):
+        self.db_path = db_path
+        self.workers = workers
+        self.interval = interval
+        self._db = SqliteConnections(db_path, self.SCHEMA)
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._pool = None
+        self._thread = None
+        self._stop = threading.Event()
+        self._warned = False
+
+    def _query(self, sql, params=()):
+        """Read rows; an unusable database degrades to "nothing indexed"."""
+        try:
+            return self._db().execute(sql, params).fetchall()
+        except (sqlite3.Error, OSError) as e:
+            if not self._warned:
+                self._warned = True
+                print(f"WARNING: metadata index {self.db_path} unavailable: {e}")
+            return []
+
+    # -- lookups --
+    def digest(self, rel_path, etag):
+        rows = self._query("SELECT sha256 FROM files WHERE path = ? AND etag = ?", (rel_path, etag))
+        return rows[0][0] if rows else None
+
+    def annotate(self, entries, parent_path=""):
+        """
+        Copies of listing entries with a ``sha256`` key (None until hashed),
+        and ``mime`` where the index has it for the entry's current version.
+        """
+        prefix = f"{parent_path}/" if parent_path else ""
+        known = {}
+        files = [e for e in entries if e["type"] == "File"]
+        for i in range(0, len(files), self.LOOKUP_BATCH):
+            batch = files[i:i + self.LOOKUP_BATCH]
+            marks = ",".join("?" * len(batch))
+            rows = self._query(f"SELECT path, etag, sha256, mime FROM files WHERE path IN ({marks})",
+                               [prefix + e["name"] for e in batch])
+            known.update((path, (etag, digest, mime)) for path, etag, digest, mime in rows)
+        annotated = []
+        for entry in entries:
+            row = known.get(prefix + entry["name"])
+            if row and row[0] == entry["etag"]:
+                annotated.append(dict(entry, sha256=row[1], mime=row[2]))
+            else:
+                annotated.append(dict(entry, sha256=None))
+        return annotated
+
+    def find(self, sha256):
+        rows = self._query("SELECT path, etag, size, mtime, mime FROM files WHERE sha256 = ? ORDER BY path",
+                           (sha256,))
+        return [dict(zip(("path", "etag", "size", "mtime", "mime"), row)) for row in rows]
+
+    # -- indexing --
+    def crawl(self):
+        """One pass over the allowed tree; returns how many files were queued for hashing."""
+        known = dict(self._query("SELECT path, etag FROM files"))
+        seen = set()
+        queued = 0
+        for full_path, rel_path, st in walk_allowed_files(BASE_DIR, "", rules=indexing_rules()):
+            seen.add(rel_path)
+            if known.get(rel_path) != make_etag(st) and self.submit(full_path, rel_path):
+                queued += 1
+        gone = [(path,) for path in known if path not in seen]
+        if gone:
+            try:
+                self._db().executemany("DELETE FROM files WHERE path = ?", gone)
+            except sqlite3.Error as e:
+                print(f"WARNING: metadata index cleanup failed: {e}")
+        return queued
+
+    def submit(self, full_path, rel_path):
+        """Queue a file for hashing unless it already is, or no pool is running."""
+        with self._lock:
+            if self._pool is None or rel_path in self._pending:
+                return False
+            self._pending.add(rel_path)
+            self._pool.submit(self._hash, full_path, rel_path)
+            return True
+
+    def _hash(self, full_path, rel_path):
         try:
-            with open(file_path, "r", encoding="utf-8", errors="replace") as f:
-                content = f.read()
-        except Exception as e:
-            content = f"Unable to read file: {e}"
-        return render_template_string(TEXT_VIEW_HTML, filename=f"{folder}/{filename}", content=content)
+            with open(full_path, "rb") as f:
+                before = os.fstat(f.fileno())
+                h = hashlib.sha256()
+                while True:
+                    data = f.read(TRANSFER_CHUNK_SIZE)
+                    if not data:
+                        break
+                    h.update(data)
+                after = os.fstat(f.fileno())
+            etag = make_etag(after)
+            if etag != make_etag(before):
+                return  # modified while hashing; the next pass picks it up
+            self._db().execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (rel_path, etag, after.st_size, after.st_mtime,
+                 detect_mime(full_path, after), h.hexdigest(), time.time()))
+        except (OSError, sqlite3.Error) as e:
+            print(f"WARNING: cannot index {rel_path}: {e}")
+        finally:
+            with self._lock:
+                self._pending.discard(rel_path)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.crawl()
+            except Exception:
+                traceback.print_exc()
+            self._stop.wait(self.interval)
+
+    def start(self):
+        """Start the crawler thread and hashing pool in this process."""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="hash")
+            self._thread = threading.Thread(target=self._run, name="metadata-crawler", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=True, cancel_futures=True)
+
+    def run_forever(self):
+        self.start()
+        self._thread.join()
+
+
+METADATA_INDEX = (MetadataIndex(INDEX_DB, workers=HASH_WORKERS, interval=INDEX_INTERVAL)
+                  if INDEX_ENABLED else None)
+
+
+def annotate_digests(items, parent_path):
+    if METADATA_INDEX is None:
+        return items
+    return METADATA_INDEX.annotate(items, parent_path)
+
+
+# -----------------------------------------------
+
+@app.route("/", methods=["GET", "POST"])
+def login():
+    if request.method == "POST":
+        wait = login_retry_after()
+        if wait:
+            retry_after = str(int(wait) + 1)
+            return render_template(
+                LOGIN_TEMPLATE,
+                error=f"Too many login attempts. Please try again in {retry_after} seconds.",
+                users_enabled=USER_DIRECTORY is not None,
+            ), 429, {"Retry-After": retry_after}
+        pw = request.form.get("pw", "")
+        # Để trống username = mật khẩu chung (rule của allowed_files.txt)
+        username = request.form.get("user", "").strip() if USER_DIRECTORY is not None else ""
+        if USER_DIRECTORY.verify(username, pw) if username else PASSWORD_VERIFIER.verify(pw):
+            session.clear()
+            session.rotate()
+            session["logged_in"] = True
+            if username:
+                session["user"] = username
+            return redirect(url_for("list_root"))
+        else:
+            return render_template(LOGIN_TEMPLATE, error="Incorrect password. Please try again.",
+                                   users_enabled=USER_DIRECTORY is not None)
+
+    if is_authenticated():
+        return redirect(url_for("list_root"))
+    return render_template(LOGIN_TEMPLATE, error=None, users_enabled=USER_DIRECTORY is not None)
+
+
+@app.route("/logout")
+def logout():
+    # Emptying the session deletes it from the store, so the cookie stops working everywhere
+    session.clear()
+    return redirect(url_for("login"))
+
+
+@app.route("/list")
+def list_root():
+    if (r := require_login()) is not None:
+        return r
+    # Bỏ qua file cấu hình, lọc chỉ hiển thị items được phép
+    entries, pager = listing_page(cached_listing(BASE_DIR, skip=("allowed_files.txt",)))
+
+    config_exists = ACCESS_INDEX.current().config_exists
+    return stream_page(LIST_TEMPLATE, items=entries, pager=pager, base_dir=BASE_DIR,
+                       config_exists=config_exists, search_enabled=SEARCH_INDEX is not None)
+
+
+@app.route("/list/<path:name>")
+def list_sub(name):
+    if (r := require_login()) is not None:
+        return r
+    name, folder_path = resolve_request_path(name, "folder")
+
+    # Lọc chỉ hiển thị items được phép
+    entries, pager = listing_page(cached_listing(folder_path, parent_path=name))
+
+    parts = name.split("/")
+    breadcrumbs = [{"name": part, "path": "/".join(parts[:i + 1])} for i, part in enumerate(parts)]
+    return stream_page(DIR_LIST_TEMPLATE, items=entries, pager=pager, dirname=name,
+                       breadcrumbs=breadcrumbs, archive_formats=list(ARCHIVE_FORMATS))
+
+
+@app.route("/view/<path:filename>")
+def view_file(filename):
+    if (r := require_login()) is not None:
+        return r
+    filename, file_path = resolve_request_path(filename, "file")
+    mime = detect_mime(file_path)
+
+    if mime and mime.startswith("text"):
+        return render_text_preview(file_path, filename,
+                                   url_for('download_file', filename=filename))
     elif mime and mime.startswith("image"):
-        return send_from_directory(folder_path, filename, as_attachment=False)
+        # Large photos get a screen-sized rendition unless ?original=1
+        if (has_derivatives(mime) and not request.args.get("original")
+                and os.path.getsize(file_path) > PREVIEW_IMAGE_MIN_BYTES):
+            response = send_derivative(file_path, filename, PREVIEW_IMAGE_SIZE)
+            if response is not None:
+                return response
+        return send_shared_file(file_path, filename, as_attachment=False)
     else:
-        return render_template_string(NO_PREVIEW_HTML,
-                                      filename=f"{folder}/{filename}",
-                                      download_url=url_for('download_sub_file', folder=folder, filename=filename))
+        return render_template(NO_PREVIEW_TEMPLATE,
+                               filename=filename,
+                               download_url=url_for('download_file', filename=filename))
+
+
+@app.route("/thumb/<path:filename>")
+def thumbnail(filename):
+    if (r := require_login()) is not None:
+        return r
+    filename, file_path = resolve_request_path(filename, "file")
+    if not has_derivatives(detect_mime(file_path)):
+        abort(404)
+    response = send_derivative(file_path, filename, THUMB_SIZE)
+    if response is None:
+        abort(404)
+    return response
 
 
-@app.route("/download/<folder>/<filename>")
-def download_sub_file(folder, filename):
+@app.route("/download/<path:filename>")
+def download_file(filename):
+    if (r := require_login()) is not None:
+        return r
+    filename, file_path = resolve_request_path(filename, "file")
+    return throttle_download(send_shared_file(file_path, filename, as_attachment=True))
+
+
+@app.route("/archive/<path:name>")
+def download_folder(name):
     if (r := require_login()) is not None:
         return r
-    if "/" in folder or "\\" in folder or "/" in filename or "\\" in filename:
+    name, folder_path = resolve_request_path(name, "folder")
+    return throttle_download(archive_response(folder_path, name))
+
+
+# ---------------- JSON API ----------------
+def require_api_login():
+    if not is_authenticated():
+        return jsonify(error="authentication required"), 401
+    return None
+
+
+def entry_json(entry):
+    return {
+        "name": entry["name"],
+        "type": entry["type"],
+        "size": entry["size"],
+        "mtime": entry["mtime"],
+        "mime": (entry.get("mime") or MIME_CACHE.known(entry["name"], entry["etag"])) if entry["type"] == "File" else None,
+        "etag": entry["etag"],
+        "sha256": entry.get("sha256"),
+    }
+
+
+def wants_json_lines():
+    if request.args.get("format") == "jsonl":
+        return True
+    best = request.accept_mimetypes.best_match(["application/json", "application/x-ndjson"])
+    return best == "application/x-ndjson"
+
+
+def api_listing(listing, path):
+    """
+    Serve a ListingIndex as one JSON page, or as JSON lines when asked for
+    with ``?format=jsonl`` / ``Accept: application/x-ndjson``. JSON lines
+    stream the whole (sorted) directory one entry at a time unless a limit
+    is given.
+
+    A listing does not read file contents, so an entry's "mime" is the same
+    type /api/stat reports as far as it is already known (from the
+    extension, the MIME cache or the metadata index) and null when the file
+    would still have to be sniffed.
+    """
+    if wants_json_lines():
+        sort, order, limit, cursor_key = parse_listing_args(default_limit=None)
+        items, _ = listing.page(sort, order, limit, cursor_key)
+
+        def generate():
+            for i in range(0, len(items), LISTING_PAGE_SIZE):
+                for entry in annotate_digests(items[i:i + LISTING_PAGE_SIZE], listing.parent_path):
+                    yield json.dumps(entry_json(entry), separators=(",", ":")) + "\n"
+
+        return Response(generate(), mimetype="application/x-ndjson")
+
+    items, pager = listing_page(listing)
+    return jsonify(path=path,
+                   total=pager["total"],
+                   next_cursor=pager["next_cursor"],
+                   items=[entry_json(entry) for entry in items])
+
+
+@app.route("/api/list")
+def api_list_root():
+    if (r := require_api_login()) is not None:
+        return r
+    return api_listing(cached_listing(BASE_DIR, skip=("allowed_files.txt",)), "")
+
+
+@app.route("/api/list/<path:name>")
+def api_list_sub(name):
+    if (r := require_api_login()) is not None:
+        return r
+    name, folder_path = resolve_request_path(name, "folder")
+    return api_listing(cached_listing(folder_path, parent_path=name), name)
+
+
+@app.route("/api/stat/<path:path>")
+def api_stat(path):
+    if (r := require_api_login()) is not None:
+        return r
+    path, full_path = resolve_request_path(path, None)
+
+    try:
+        st = os.stat(full_path)
+    except OSError:
+        abort(404)
+    kind = "File" if stat.S_ISREG(st.st_mode) else "Folder" if stat.S_ISDIR(st.st_mode) else "Other"
+    entry = {
+        "name": path.rsplit("/", 1)[-1],
+        "type": kind,
+        "size": st.st_size if kind == "File" else None,
+        "mtime": st.st_mtime,
+        "etag": make_etag(st),
+        "mime": detect_mime(full_path, st) if kind == "File" else None,
+    }
+    if kind == "File" and METADATA_INDEX is not None:
+        entry["sha256"] = METADATA_INDEX.digest(path, entry["etag"])
+        if entry["sha256"] is None:
+            METADATA_INDEX.submit(full_path, path)
+    return jsonify(path=path, **entry_json(entry))
+
+
+@app.route("/api/sha256/<digest>")
+def api_find_digest(digest):
+    """Allowed files whose current content has this SHA-256."""
+    if (r := require_api_login()) is not None:
+        return r
+    if not re.fullmatch(r"[0-9a-fA-F]{64}", digest):
         abort(400)
+    if METADATA_INDEX is None:
+        abort(404)
+    matches = []
+    for row in METADATA_INDEX.find(digest.lower()):
+        if not is_allowed(row["path"]):
+            continue
+        try:
+            st = os.stat(os.path.join(BASE_DIR, row["path"]))
+        except OSError:
+            continue
+        if make_etag(st) == row["etag"]:
+            matches.append(row)
+    return jsonify(sha256=digest.lower(), files=matches)
 
-    # Kiểm tra quyền truy cập
-    file_path_relative = f"{folder}/{filename}"
-    if not is_allowed(file_path_relative):
-        abort(403)
 
-    if not is_child_under(folder, filename):
+# ---------------- Uploads ----------------
+UPLOAD_ID_RE = re.compile(r"[0-9a-f]{32}")
+CONTENT_DIGEST_RE = re.compile(r"(?:^|,)\s*sha-256=:([A-Za-z0-9+/]+=*):")
+
+
+class UploadStore:
+    """
+    Resumable uploads made of independently sent, checksummed chunks. All
+    state is on disk, so chunks of one upload can be PUT in parallel and to
+    any worker process:
+
+        <root>/<id>/upload.json    target, size, chunk size, optional SHA-256
+        <root>/<id>/<n>            SHA-256 of chunk n, written once it is on disk
+
+    Data goes into ``.pfss-upload-<id>.part`` next to the target, allocated
+    at its final size up front, so every chunk is a pwrite() at its own
+    offset and completion is a rename within one filesystem. A chunk holds
+    a shared flock on upload.json while it writes; completion and
+    cancellation take it exclusively.
+    """
+
+    def __init__(self, root, ttl=UPLOAD_TTL):
+        self.root = root
+        self.ttl = ttl
+
+    def _dir(self, upload_id):
+        return os.path.join(self.root, upload_id)
+
+    @staticmethod
+    def part_path(meta):
+        return os.path.join(meta["folder"], f"{UPLOAD_PART_PREFIX}{meta['id']}.part")
+
+    @staticmethod
+    def chunk_span(meta, index):
+        """(offset, length) of chunk ``index``."""
+        offset = index * meta["chunk_size"]
+        return offset, min(meta["chunk_size"], meta["size"] - offset)
+
+    @staticmethod
+    def chunk_count(meta):
+        return -(-meta["size"] // meta["chunk_size"])
+
+    def create(self, rel_path, folder, size, chunk_size, sha256=None, overwrite=False):
+        """Register an upload and preallocate its part file; returns its metadata."""
+        self.sweep()
+        meta = {"id": secrets.token_hex(16), "path": rel_path, "folder": folder,
+                "name": rel_path.rsplit("/", 1)[-1], "size": size, "chunk_size": chunk_size,
+                "sha256": sha256, "overwrite": overwrite, "created": time.time()}
+        state = self._dir(meta["id"])
+        os.makedirs(state, mode=0o700)
+        fd = os.open(self.part_path(meta), os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_CLOEXEC, 0o644)
+        try:
+            if size:
+                try:
+                    os.posix_fallocate(fd, 0, size)
+                except OSError as e:
+                    if e.errno not in (errno.EOPNOTSUPP, errno.EINVAL):
+                        raise
+                    os.ftruncate(fd, size)
+        except OSError:
+            os.close(fd)
+            self._remove(meta)
+            raise
+        os.close(fd)
+        with open(os.path.join(state, "upload.json"), "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        return meta
+
+    def load(self, upload_id):
+        if not UPLOAD_ID_RE.fullmatch(upload_id):
+            return None
+        try:
+            with open(os.path.join(self._dir(upload_id), "upload.json"), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    @contextlib.contextmanager
+    def locked(self, meta, exclusive=False):
+        """flock upload.json; yields False if the upload disappeared meanwhile."""
+        try:
+            f = open(os.path.join(self._dir(meta["id"]), "upload.json"), "rb")
+        except FileNotFoundError:
+            yield False
+            return
+        with f:
+            fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            # Completion or cancellation may have won the race for the lock
+            yield os.path.exists(f.name)
+
+    def received(self, meta):
+        try:
+            names = os.listdir(self._dir(meta["id"]))
+        except FileNotFoundError:
+            return []
+        return sorted(int(name) for name in names if name.isdigit())
+
+    def write_chunk(self, meta, index, stream, digest):
+        """
+        Stream chunk ``index`` from ``stream`` into the part file. Returns
+        None on success, or an error message if the body was short or its
+        SHA-256 is not ``digest`` (raw bytes); the chunk is then simply not
+        marked and can be sent again.
+        """
+        offset, length = self.chunk_span(meta, index)
+        h = hashlib.sha256()
+        written = 0
+        fd = os.open(self.part_path(meta), os.O_WRONLY | os.O_CLOEXEC)
+        try:
+            while written < length:
+                data = stream.read(min(TRANSFER_CHUNK_SIZE, length - written))
+                if not data:
+                    break
+                h.update(data)
+                view = memoryview(data)
+                while view:
+                    n = os.pwrite(fd, view, offset + written)
+                    view = view[n:]
+                    written += n
+            if written != length:
+                return f"expected {length} bytes, got {written}"
+            if not hmac.compare_digest(h.digest(), digest):
+                return "chunk does not match its Content-Digest"
+            os.fdatasync(fd)
+        finally:
+            os.close(fd)
+        state = self._dir(meta["id"])
+        marker = os.path.join(state, str(index))
+        with open(f"{marker}.tmp-{os.getpid()}-{threading.get_ident()}", "w") as f:
+            f.write(h.hexdigest())
+        os.replace(f.name, marker)
+        # Activity keeps the upload away from sweep()
+        os.utime(os.path.join(state, "upload.json"))
+        return None
+
+    def complete(self, meta, target):
+        """
+        Move the finished part file to ``target``. Returns None on success or
+        an error message (with the part file left in place) on conflict.
+        """
+        part = self.part_path(meta)
+        if meta["sha256"] is not None:
+            h = hashlib.sha256()
+            with open(part, "rb") as f:
+                while data := f.read(TRANSFER_CHUNK_SIZE):
+                    h.update(data)
+            if h.hexdigest() != meta["sha256"]:
+                return "file does not match its sha256"
+        fd = os.open(part, os.O_RDONLY | os.O_CLOEXEC)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        if meta["overwrite"]:
+            os.replace(part, target)
+        else:
+            try:
+                # link() fails instead of replacing a file created meanwhile
+                os.link(part, target)
+            except FileExistsError:
+                return "target already exists"
+            os.unlink(part)
+        fd = os.open(meta["folder"], os.O_RDONLY | os.O_DIRECTORY | os.O_CLOEXEC)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        self._remove(meta)
+        return None
+
+    def discard(self, meta):
+        try:
+            os.unlink(self.part_path(meta))
+        except FileNotFoundError:
+            pass
+        self._remove(meta)
+
+    def _remove(self, meta):
+        shutil.rmtree(self._dir(meta["id"]), ignore_errors=True)
+
+    def sweep(self, now=None):
+        """Discard uploads that saw no chunk for ``ttl`` seconds."""
+        now = time.time() if now is None else now
+        try:
+            names = os.listdir(self.root)
+        except FileNotFoundError:
+            return
+        for name in names:
+            path = os.path.join(self.root, name, "upload.json")
+            try:
+                if os.stat(path).st_mtime + self.ttl > now:
+                    continue
+            except OSError:
+                continue
+            meta = self.load(name)
+            if meta is not None:
+                with self.locked(meta, exclusive=True) as alive:
+                    if alive:
+                        self.discard(meta)
+
+
+UPLOAD_STORE = UploadStore(UPLOAD_DIR) if UPLOADS_ENABLED else None
+
+
+def upload_json(meta, received=None):
+    received = UPLOAD_STORE.received(meta) if received is None else received
+    return {"id": meta["id"], "path": meta["path"], "size": meta["size"],
+            "chunk_size": meta["chunk_size"], "chunks": UploadStore.chunk_count(meta),
+            "received": received, "sha256": meta["sha256"]}
+
+
+def upload_target(meta):
+    """
+    Real path the upload will be renamed to, re-checked against the current
+    upload rules and the current folder tree; None if either no longer allows it.
+    """
+    parts = meta["path"].split("/")
+    if not current_rules().allows_upload(meta["path"]) or PATH_RESOLVER.folder(tuple(parts[:-1])) != meta["folder"]:
+        return None
+    return os.path.join(meta["folder"], meta["name"])
+
+
+def load_upload(upload_id):
+    if UPLOAD_STORE is None:
+        abort(404)
+    meta = UPLOAD_STORE.load(upload_id)
+    if meta is None:
         abort(404)
-    folder_path = os.path.join(BASE_DIR, folder)
-    return send_from_directory(folder_path, filename, as_attachment=True)
+    return meta
 
 
-if __name__ == "__main__":
+@app.route("/api/uploads", methods=["POST"])
+def api_create_upload():
+    """
+    Start an upload: JSON {"path", "size", "chunk_size"?, "sha256"?,
+    "overwrite"?}. The path needs an "@upload" rule, and "overwrite" is
+    refused unless SHARE_UPLOAD_OVERWRITE=1. Requiring a JSON body also
+    keeps cross-site forms out.
+    """
+    if (r := require_api_login()) is not None:
+        return r
+    if UPLOAD_STORE is None:
+        abort(404)
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        return jsonify(error="expected a JSON object"), 400
+    parts = split_share_path(body.get("path") or "")
+    if parts is None or len(parts) > MAX_DEPTH:
+        return jsonify(error="invalid path"), 400
+    rel_path = "/".join(parts)
+    size = body.get("size")
+    chunk_size = body.get("chunk_size", UPLOAD_CHUNK_SIZE)
+    sha256 = body.get("sha256")
+    if (not isinstance(size, int) or isinstance(size, bool) or size < 0
+            or not isinstance(chunk_size, int) or isinstance(chunk_size, bool)
+            or not 0 < chunk_size <= UPLOAD_MAX_CHUNK_SIZE):
+        return jsonify(error="invalid size or chunk_size"), 400
+    if sha256 is not None and not (isinstance(sha256, str) and re.fullmatch(r"[0-9a-fA-F]{64}", sha256)):
+        return jsonify(error="invalid sha256"), 400
+    if UPLOAD_MAX_SIZE and size > UPLOAD_MAX_SIZE:
+        return jsonify(error="file too large"), 413
+
+    # Kiểm tra quyền: ghi cần directive @upload, không chỉ quyền đọc
+    if not current_rules().allows_upload(rel_path):
+        return jsonify(error="upload not allowed"), 403
+    overwrite = body.get("overwrite") is True
+    if overwrite and not UPLOAD_OVERWRITE:
+        return jsonify(error="overwriting is disabled"), 403
+    folder = PATH_RESOLVER.folder(tuple(parts[:-1]))
+    if folder is None:
+        return jsonify(error="parent folder does not exist"), 404
+    target = os.path.join(folder, parts[-1])
+    if os.path.lexists(target) and (not overwrite or not os.path.isfile(target) or os.path.islink(target)):
+        return jsonify(error="target already exists"), 409
+
+    try:
+        meta = UPLOAD_STORE.create(rel_path, folder, size, chunk_size,
+                                   sha256.lower() if sha256 else None, overwrite)
+    except OSError as e:
+        if e.errno in (errno.ENOSPC, errno.EDQUOT):
+            return jsonify(error="not enough space"), 507
+        raise
+    response = jsonify(upload_json(meta, received=[]))
+    response.status_code = 201
+    response.headers["Location"] = url_for("api_upload_status", upload_id=meta["id"])
+    return response
+
+
+@app.route("/api/uploads/<upload_id>")
+def api_upload_status(upload_id):
+    if (r := require_api_login()) is not None:
+        return r
+    return jsonify(upload_json(load_upload(upload_id)))
+
+
+@app.route("/api/uploads/<upload_id>/<int:index>", methods=["PUT"])
+def api_upload_chunk(upload_id, index):
+    """
+    Store one chunk. The body must be exactly the chunk's bytes and carry
+    ``Content-Digest: sha-256=:<base64>:``; chunks may be sent in any order,
+    in parallel, and again after a failure.
+    """
+    if (r := require_api_login()) is not None:
+        return r
+    meta = load_upload(upload_id)
+    if not current_rules().allows_upload(meta["path"]):
+        return jsonify(error="upload not allowed"), 403
+    if index >= UploadStore.chunk_count(meta):
+        return jsonify(error="chunk index out of range"), 400
+    _offset, length = UploadStore.chunk_span(meta, index)
+    if request.content_length is None:
+        return jsonify(error="Content-Length required"), 411
+    if request.content_length != length:
+        return jsonify(error=f"chunk {index} must be {length} bytes"), 400
+    m = CONTENT_DIGEST_RE.search(request.headers.get("Content-Digest", ""))
+    try:
+        digest = base64.b64decode(m.group(1), validate=True) if m else b""
+    except ValueError:
+        digest = b""
+    if len(digest) != 32:
+        return jsonify(error="Content-Digest with sha-256 required"), 400
+
+    with UPLOAD_STORE.locked(meta) as alive:
+        if not alive:
+            abort(404)
+        error = UPLOAD_STORE.write_chunk(meta, index, request.stream, digest)
+    if error is not None:
+        return jsonify(error=error), 400
+    return jsonify(index=index, sha256=digest.hex())
+
+
+@app.route("/api/uploads/<upload_id>/complete", methods=["POST"])
+def api_complete_upload(upload_id):
+    if (r := require_api_login()) is not None:
+        return r
+    meta = load_upload(upload_id)
+    with UPLOAD_STORE.locked(meta, exclusive=True) as alive:
+        if not alive:
+            abort(404)
+        received = UPLOAD_STORE.received(meta)
+        if len(received) != UploadStore.chunk_count(meta):
+            missing = sorted(set(range(UploadStore.chunk_count(meta))) - set(received))
+            return jsonify(error="chunks missing", missing=missing), 409
+        target = upload_target(meta)
+        if target is None:
+            return jsonify(error="upload not allowed"), 403
+        if meta["overwrite"] and not UPLOAD_OVERWRITE:
+            # Created before overwriting was switched off
+            meta = dict(meta, overwrite=False)
+        error = UPLOAD_STORE.complete(meta, target)
+    if error is not None:
+        return jsonify(error=error), 409
+
+    LISTING_CACHE.invalidate(meta["folder"])
+    if METADATA_INDEX is not None:
+        METADATA_INDEX.submit(target, meta["path"])
+    st = os.stat(target)
+    entry = {"name": meta["name"], "type": "File", "size": st.st_size,
+             "mtime": st.st_mtime, "etag": make_etag(st), "sha256": meta["sha256"]}
+    return jsonify(path=meta["path"], **entry_json(entry)), 201
+
+
+@app.route("/api/uploads/<upload_id>", methods=["DELETE"])
+def api_cancel_upload(upload_id):
+    if (r := require_api_login()) is not None:
+        return r
+    meta = load_upload(upload_id)
+    with UPLOAD_STORE.locked(meta, exclusive=True) as alive:
+        if alive:
+            UPLOAD_STORE.discard(meta)
+    return "", 204
+
+
+# ---------------- ASGI ----------------
+class AsgiFileWrapper:
+    """
+    wsgi.file_wrapper for the ASGI bridge: a plain block iterator over the
+    file. ``length`` (set by file_body() for ranges) bounds the transfer;
+    None means up to end of file.
+    """
+
+    def __init__(self, filelike, block_size=TRANSFER_CHUNK_SIZE):
+        self.filelike = filelike
+        self.block_size = block_size
+        self.length = None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        size = self.block_size if self.length is None else min(self.block_size, self.length)
+        data = self.filelike.read(size) if size > 0 else b""
+        if not data:
+            raise StopIteration
+        if self.length is not None:
+            self.length -= len(data)
+        return data
+
+    def close(self):
+        self.filelike.close()
+
+
+class AsgiApp:
+    """
+    ASGI entry point for the Flask app (``uvicorn main:asgi_app``).
+
+    Every route is served by the same Flask view, but the event loop owns
+    the connection: the request body is received asynchronously, the view
+    runs on a bounded thread pool, and the response is pulled from the WSGI
+    iterable one chunk at a time on that pool and sent with ``await``. A
+    thread is therefore only busy while producing a chunk (a filesystem
+    read, a template slice), never while a slow client drains the socket,
+    so thousands of slow downloads do not exhaust the workers.
+    """
+
+    def __init__(self, wsgi_app, max_threads=ASGI_THREADS):
+        self.wsgi_app = wsgi_app
+        self.max_threads = max_threads
+        self._executor = None
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_threads,
+                                                thread_name_prefix="asgi-io")
+        return self._executor
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http":
+            await self.handle_http(scope, receive, send)
+        elif scope["type"] == "lifespan":
+            await self.handle_lifespan(receive, send)
+
+    async def handle_lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                if METADATA_INDEX is not None:
+                    METADATA_INDEX.start()
+                if SEARCH_INDEX is not None:
+                    SEARCH_INDEX.start()
+                if THUMBNAILER is not None:
+                    THUMBNAILER.start()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                if METADATA_INDEX is not None:
+                    METADATA_INDEX.stop()
+                if THUMBNAILER is not None:
+                    THUMBNAILER.stop()
+                if self._executor is not None:
+                    self._executor.shutdown(wait=False)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def read_body(self, receive):
+        """Receive the request body into a spooled temp file (RAM up to 1 MiB)."""
+        spool_size = 1024 * 1024
+        body = tempfile.SpooledTemporaryFile(max_size=spool_size)
+        loop = asyncio.get_running_loop()
+        received = 0
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                body.close()
+                return None
+            chunk = message.get("body", b"")
+            if chunk:
+                received += len(chunk)
+                if received > spool_size:
+                    # Past the spool size the body lives on disk
+                    await loop.run_in_executor(self.executor, body.write, chunk)
+                else:
+                    body.write(chunk)
+            if not message.get("more_body", False):
+                break
+        body.seek(0)
+        return body
+
+    @staticmethod
+    def build_environ(scope, body):
+        server = scope.get("server") or ("localhost", 80)
+        client = scope.get("client") or ("", 0)
+        environ = {
+            "REQUEST_METHOD": scope["method"],
+            "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+            "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+            "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+            "SERVER_NAME": str(server[0]),
+            "SERVER_PORT": str(server[1] or 80),
+            "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+            "REMOTE_ADDR": client[0],
+            "REMOTE_PORT": str(client[1]),
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": scope.get("scheme", "http"),
+            "wsgi.input": body,
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": True,
+            "wsgi.run_once": False,
+            "wsgi.file_wrapper": AsgiFileWrapper,
+        }
+        for raw_name, raw_value in scope.get("headers", []):
+            name = raw_name.decode("latin-1").upper().replace("-", "_")
+            value = raw_value.decode("latin-1")
+            if name in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+                key = name
+            else:
+                key = "HTTP_" + name
+            if key in environ:
+                value = environ[key] + "," + value
+            environ[key] = value
+        return environ
+
+    async def handle_http(self, scope, receive, send):
+        body = await self.read_body(receive)
+        if body is None:
+            return
+        loop = asyncio.get_running_loop()
+        # One context per request: Flask keeps its request context in
+        # contextvars, and the chunks below may run on different threads.
+        context = contextvars.copy_context()
+        environ = self.build_environ(scope, body)
+        started = {}
+        written = []
+
+        def start_response(status, headers, exc_info=None):
+            started["status"] = int(status.split(" ", 1)[0])
+            started["headers"] = [(k.lower().encode("latin-1"), v.encode("latin-1"))
+                                  for k, v in headers]
+            return written.append
+
+        def call_app():
+            return iter(self.wsgi_app(environ, start_response))
+
+        def next_chunk(iterator):
+            return next(iterator, None)
+
+        result = None
+        try:
+            result = await loop.run_in_executor(self.executor, context.run, call_app)
+            iterator = iter(result)
+            chunk = b"".join(written)
+            if not chunk:
+                chunk = await loop.run_in_executor(self.executor, context.run, next_chunk, iterator)
+            await send({"type": "http.response.start",
+                        "status": started["status"],
+                        "headers": started["headers"]})
+            while chunk is not None:
+                if chunk:
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+                chunk = await loop.run_in_executor(self.executor, context.run, next_chunk, iterator)
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+        finally:
+            if result is not None and hasattr(result, "close"):
+                await loop.run_in_executor(self.executor, context.run, result.close)
+            body.close()
+
+
+asgi_app = AsgiApp(app.wsgi_app)
+
+
+# ---------------- Launcher ----------------
+class SendfileWrapper:
+    """
+    wsgi.file_wrapper of the built-in server. Iterating it first yields an
+    empty chunk, which makes werkzeug flush the status line and headers,
+    then pushes the body straight from the file to the client socket with
+    socket.sendfile(). ``length`` (set by file_body() for ranges) bounds the
+    transfer; None means up to end of file.
+    """
+
+    def __init__(self, filelike, block_size=TRANSFER_CHUNK_SIZE, sock=None):
+        self.filelike = filelike
+        self.block_size = block_size
+        self.sock = sock
+        self.length = None
+
+    def __iter__(self):
+        yield b""
+        # socket.sendfile() waits for the socket to drain (up to its timeout)
+        # instead of failing with EAGAIN, and copies through userspace on
+        # filesystems without sendfile support
+        self.sock.sendfile(self.filelike, self.filelike.tell(), self.length)
+
+    def close(self):
+        self.filelike.close()
+
+
+class LauncherRequestHandler(WSGIRequestHandler):
+    """
+    Request handler for the pre-fork server. werkzeug's own handler closes
+    every connection; this one keeps HTTP/1.1 connections open between
+    requests (framing bodies with Content-Length or chunked encoding and
+    draining unread request bodies) and plugs in SendfileWrapper.
+
+    A connection keeps its pool thread while it waits for the next request,
+    so every idle keep-alive client holds one of the worker's ``--threads``
+    for up to ``--keepalive`` seconds. Size --threads for the expected
+    number of open browser connections, or lower --keepalive.
+    """
+
+    timeout = 5.0  # idle keep-alive timeout, applied between requests
+    io_timeout = 60.0  # while a request is being read or answered
+    access_log = False
+
+    def handle_one_request(self):
+        self.connection.settimeout(self.timeout)
+        try:
+            self.raw_requestline = self.rfile.readline(65537)
+        except (TimeoutError, ConnectionError):
+            self.close_connection = True
+            return
+        if not self.raw_requestline:
+            self.close_connection = True
+            return
+        if len(self.raw_requestline) > 65536:
+            self.requestline = self.request_version = self.command = ""
+            self.send_error(414)
+            return
+        if not self.parse_request():
+            return
+        self.connection.settimeout(self.io_timeout)
+        if self.command not in ("GET", "HEAD", "POST", "PUT", "DELETE", "PATCH", "OPTIONS"):
+            self.send_error(501)
+            return
+        self.run_wsgi()
+
+    def make_environ(self):
+        environ = super().make_environ()
+        sock = self.connection
+        environ["wsgi.file_wrapper"] = (
+            lambda filelike, block_size=TRANSFER_CHUNK_SIZE: SendfileWrapper(filelike, block_size, sock))
+        if not environ.get("wsgi.input_terminated"):
+            try:
+                length = max(int(environ.get("CONTENT_LENGTH") or 0), 0)
+            except ValueError:
+                length = 0
+            environ["wsgi.input"] = LimitedStream(self.rfile, length)
+        return environ
+
+    def wants_keep_alive(self, environ):
+        if getattr(self.server, "draining", False) or environ.get("wsgi.input_terminated"):
+            return False
+        tokens = {t.strip().lower() for t in self.headers.get("Connection", "").split(",")}
+        if self.request_version == "HTTP/1.1":
+            return "close" not in tokens
+        return "keep-alive" in tokens
+
+    def run_wsgi(self):
+        if self.headers.get("Expect", "").lower().strip() == "100-continue":
+            self.wfile.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+        self.environ = environ = self.make_environ()
+        state = {"status": None, "headers": None, "sent": False, "chunked": False,
+                 "keep_alive": self.wants_keep_alive(environ)}
+
+        def write(data):
+            if not state["sent"]:
+                state["sent"] = True
+                code, _, reason = state["status"].partition(" ")
+                code = int(code)
+                self.send_response(code, reason)
+                keys = set()
+                for key, value in state["headers"]:
+                    if key.lower() != "connection":
+                        self.send_header(key, value)
+                        keys.add(key.lower())
+                bodyless = environ["REQUEST_METHOD"] == "HEAD" or code < 200 or code in (204, 304)
+                if not bodyless and "content-length" not in keys:
+                    if self.request_version == "HTTP/1.1":
+                        state["chunked"] = True
+                        self.send_header("Transfer-Encoding", "chunked")
+                    else:
+                        state["keep_alive"] = False
+                # Sets self.close_connection, which drives the keep-alive loop
+                self.send_header("Connection", "keep-alive" if state["keep_alive"] else "close")
+                self.end_headers()
+            if data:
+                if state["chunked"]:
+                    self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+                else:
+                    self.wfile.write(data)
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info is not None and state["sent"]:
+                raise exc_info[1].with_traceback(exc_info[2])
+            state["status"], state["headers"] = status, headers
+            return write
+
+        try:
+            body = self.server.app(environ, start_response)
+            try:
+                for data in body:
+                    write(data)
+                if not state["sent"]:
+                    write(b"")
+                if state["chunked"]:
+                    self.wfile.write(b"0\r\n\r\n")
+            finally:
+                if hasattr(body, "close"):
+                    body.close()
+        except (ConnectionError, TimeoutError):
+            self.close_connection = True
+            return
+        except Exception:
+            self.close_connection = True
+            self.log_error("Error on request %r:\n%s", self.requestline, traceback.format_exc())
+            if not state["sent"]:
+                message = b"Internal Server Error"
+                state["keep_alive"] = False
+                start_response("500 INTERNAL SERVER ERROR", [
+                    ("Content-Type", "text/plain"), ("Content-Length", str(len(message)))])
+                write(message)
+            return
+        if not self.close_connection and not environ["wsgi.input"].is_exhausted:
+            environ["wsgi.input"].exhaust()
+
+    def log_request(self, code="-", size="-"):
+        if self.access_log:
+            super().log_request(code, size)
+
+
+class PooledWSGIServer(BaseWSGIServer):
+    """werkzeug server that runs connections on a fixed-size thread pool."""
+
+    multithread = True
+    draining = False
+
+    def __init__(self, host, port, app, threads, fd=None):
+        super().__init__(host, port, app, handler=LauncherRequestHandler, fd=fd)
+        self.pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="http")
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self._process_request, request, client_address)
+
+    def _process_request(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+
+def bind_listener(host, port, backlog, reuse_port, listen=True):
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((host, port))
+        if listen:
+            sock.listen(backlog)
+    except BaseException:
+        sock.close()
+        raise
+    return sock
+
+
+def run_worker(args, listener):
+    """Body of one forked worker; never returns."""
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if listener is None:
+        listener = bind_listener(args.host, args.port, args.backlog, reuse_port=True)
+    LauncherRequestHandler.timeout = args.keepalive
+    LauncherRequestHandler.io_timeout = args.timeout
+    LauncherRequestHandler.access_log = args.access_log
+    server = PooledWSGIServer(args.host, args.port, app, args.threads, fd=listener.fileno())
+    listener.close()
+    if SEARCH_INDEX is not None:
+        SEARCH_INDEX.start()
+    if THUMBNAILER is not None:
+        THUMBNAILER.start()
+
+    def stop(signum, frame):
+        server.draining = True
+        # serve_forever() has to be stopped from another thread
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    status = 0
+    try:
+        server.serve_forever()
+    except Exception:
+        traceback.print_exc()
+        status = 1
+    finally:
+        server.server_close()
+        # Let in-flight requests finish; idle keep-alive sockets time out on their own
+        server.pool.shutdown(wait=True)
+        if THUMBNAILER is not None:
+            THUMBNAILER.stop()
+    os._exit(status)
+
+
+def run_prefork(args):
+    """
+    Pre-fork master: keeps ``--workers`` processes running, each with its
+    own SO_REUSEPORT listener (or a shared inherited socket where
+    SO_REUSEPORT is missing) and a ``--threads`` request pool.
+    SIGHUP reloads allowed_files.txt and replaces the workers gracefully;
+    SIGTERM/SIGINT drain and stop them. The address is bound once before
+    forking, so a bad one fails at startup, and children that keep dying
+    right after starting are respawned with exponential backoff.
+    """
+    if args.workers > 1 and not SESSION_STORE.shared:
+        print("WARNING: SHARE_SESSION_BACKEND=memory keeps sessions per worker; "
+              "logins will not carry over between workers")
+    reuse_port = hasattr(socket, "SO_REUSEPORT")
+    shared = reserved = None
+    try:
+        if reuse_port:
+            # Bound but not listening: a bad address fails here, once, and the
+            # port stays held while connections only reach the workers' listeners
+            reserved = bind_listener(args.host, args.port, args.backlog, True, listen=False)
+        else:
+            shared = bind_listener(args.host, args.port, args.backlog, False)
+    except OSError as e:
+        print(f"ERROR: cannot listen on {args.host}:{args.port}: {e}")
+        return 1
+    workers = {}
+    started = {}
+    respawns = []  # (due time, role) of children waiting out their backoff
+    backoff = {}
+    generation = 0
+    events = []
+
+    def fork_child(role, body):
+        pid = os.fork()
+        if pid == 0:
+            # Whatever happens, the child must never return into the master loop
+            try:
+                if reserved is not None:
+                    reserved.close()
+                body()
+            except BaseException:
+                traceback.print_exc()
+            finally:
+                os._exit(1)
+        workers[pid] = role
+        started[pid] = time.monotonic()
+
+    def spawn():
+        fork_child(generation, lambda: run_worker(args, shared))
+
+    def run_indexer():
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, lambda signum, frame: os._exit(0))
+        METADATA_INDEX.run_forever()
+        os._exit(0)
+
+    def spawn_indexer():
+        fork_child("indexer", run_indexer)
+
+    def schedule_respawn(pid, role, status, lifetime):
+        # Children that die right after starting are respawned with a growing
+        # delay instead of in a tight crash loop
+        key = "indexer" if role == "indexer" else "worker"
+        if lifetime < RESPAWN_FAST_EXIT:
+            backoff[key] = min(backoff.get(key, RESPAWN_MIN_DELAY / 2) * 2, RESPAWN_MAX_DELAY)
+        else:
+            backoff[key] = RESPAWN_MIN_DELAY
+        name = "Indexer" if key == "indexer" else "Worker"
+        print(f"{name} {pid} exited unexpectedly ({status}), restarting in {backoff[key]:.1f}s")
+        respawns.append((time.monotonic() + backoff[key], role))
+
+    signal.signal(signal.SIGHUP, lambda signum, frame: events.append("reload"))
+    signal.signal(signal.SIGTERM, lambda signum, frame: events.append("stop"))
+    signal.signal(signal.SIGINT, lambda signum, frame: events.append("stop"))
+
+    ACCESS_INDEX.reload(force=True)
+    for _ in range(args.workers):
+        spawn()
+    if METADATA_INDEX is not None:
+        # Hashing runs in its own process so request workers never compete with it
+        spawn_indexer()
+    print(f"Master {os.getpid()}: {args.workers} workers x {args.threads} threads "
+          f"on http://{args.host}:{args.port}")
+
+    stopping = False
+    while workers or (respawns and not stopping):
+        while events:
+            event = events.pop(0)
+            if event == "stop" and not stopping:
+                stopping = True
+                for pid in workers:
+                    os.kill(pid, signal.SIGTERM)
+            elif event == "reload" and not stopping:
+                print(f"Master {os.getpid()}: reloading")
+                ACCESS_INDEX.reload(force=True)
+                API_TOKEN_TABLE.load(API_TOKENS, API_TOKENS_FILE)
+                old = [pid for pid, role in workers.items() if role != "indexer"]
+                generation += 1
+                # A fresh generation replaces any worker still waiting to respawn
+                respawns[:] = [item for item in respawns if item[1] == "indexer"]
+                for _ in range(args.workers):
+                    spawn()
+                for pid in old:
+                    os.kill(pid, signal.SIGTERM)
+        now = time.monotonic()
+        for item in [item for item in respawns if item[0] <= now]:
+            respawns.remove(item)
+            if stopping:
+                continue
+            if item[1] == "indexer":
+                spawn_indexer()
+            elif item[1] == generation:
+                spawn()
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            if respawns and not stopping:
+                time.sleep(0.2)
+                continue
+            break
+        if pid == 0:
+            time.sleep(0.2)
+            continue
+        role = workers.pop(pid, None)
+        lifetime = time.monotonic() - started.pop(pid, 0)
+        if not stopping and (role == "indexer" or role == generation):
+            schedule_respawn(pid, role, status, lifetime)
+    for sock in (shared, reserved):
+        if sock is not None:
+            sock.close()
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Polydevs File Sharing System")
+    commands = parser.add_subparsers(dest="command")
+    serve = commands.add_parser("serve", help="run the pre-fork production server")
+    serve.add_argument("--host", default="0.0.0.0")
+    serve.add_argument("--port", type=int, default=80)
+    serve.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    serve.add_argument("--threads", type=int, default=16,
+                       help="request threads per worker")
+    serve.add_argument("--keepalive", type=float, default=5.0,
+                       help="idle keep-alive timeout in seconds; each idle connection "
+                            "holds a request thread until it expires")
+    serve.add_argument("--timeout", type=float, default=60.0,
+                       help="socket timeout while a request is in progress")
+    serve.add_argument("--backlog", type=int, default=2048)
+    serve.add_argument("--access-log", action="store_true")
+    hash_cmd = commands.add_parser("hash-password", help="print a hash for SHARE_PW_HASH")
+    hash_cmd.add_argument("--method", default=PASSWORD_METHOD)
+    token_cmd = commands.add_parser("new-token", help="generate a bearer token for scripts")
+    token_cmd.add_argument("name")
+    commands.add_parser("revoke-sessions", help="log out every browser session")
+    args = parser.parse_args(argv)
+
+    if args.command == "hash-password":
+        print(hash_password(getpass.getpass("Password: "), method=args.method))
+        return 0
+    if args.command == "new-token":
+        token = secrets.token_urlsafe(32)
+        print(f"Token: {token}")
+        print(f"SHARE_API_TOKENS_FILE line: {args.name} sha256:{TokenTable.digest(token).hex()}")
+        return 0
+    if args.command == "revoke-sessions":
+        if not SESSION_STORE.shared:
+            print("Sessions live in server memory with SHARE_SESSION_BACKEND=memory; restart the server instead")
+            return 1
+        print(f"Revoked {SESSION_STORE.clear()} sessions")
+        return 0
+
     print("Polydevs File Sharing System")
     print(f"Directory: {BASE_DIR}")
-    print(f"Password: {PASSWORD}")
+    print(f"Password: {'(SHARE_PW_HASH)' if os.environ.get('SHARE_PW_HASH') else PASSWORD}")
     print(f"Access Control: {ALLOWED_FILES_CONFIG}")
+    if args.command == "serve":
+        return run_prefork(args)
+
     print("Address: http://0.0.0.0:80")
     print("Note: Port 80 requires root/admin")
-    app.run(host="0.0.0.0", port=80, debug=False)
\ No newline at end of file
+    if METADATA_INDEX is not None:
+        METADATA_INDEX.start()
+    if SEARCH_INDEX is not None:
+        SEARCH_INDEX.start()
+    if THUMBNAILER is not None:
+        THUMBNAILER.start()
+    app.run(host="0.0.0.0", port=80, debug=False)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
\ No newline at end of file
@@ -0,0 +1,131 @@
+"""
+Table-driven tests for the allowed_files.txt matcher (PathMatcher through
+CompiledRules): every rule form, anchoring, negation with "later rule
+wins", rules on folders covering their subtree, and the paths that are
+always denied.
+
+    python -m pytest -q test_access.py
+"""
+
+import pytest
+
+import harness
+
+PASSWORD = "test"
+
+CASES = [
+    # literal rules are anchored at the root
+    (["a.txt"], "a.txt", True),
+    (["a.txt"], "sub/a.txt", False),
+    (["a.txt"], "a.txt.bak", False),
+    (["docs/a.txt"], "docs/a.txt", True),
+    (["docs/a.txt"], "docs/b.txt", False),
+    (["docs/a.txt"], "other/docs/a.txt", False),
+    # "*" within one segment; an unanchored glob matches at any depth
+    (["*.txt"], "a.txt", True),
+    (["*.txt"], "deep/down/a.txt", True),
+    (["*.txt"], ".txt", True),
+    (["*.txt"], "a.txt.bak", False),
+    (["*.txt"], "a.md", False),
+    (["docs/*.txt"], "docs/a.txt", True),
+    (["docs/*.txt"], "other/a.txt", False),
+    (["docs/*.txt"], "x/docs/a.txt", False),
+    (["report-*-final.pdf"], "report-2026-final.pdf", True),
+    (["report-*-final.pdf"], "report--final.pdf", True),
+    (["report-*-final.pdf"], "report-2026-draft.pdf", False),
+    # "?" is exactly one character
+    (["log?.txt"], "log1.txt", True),
+    (["log?.txt"], "log.txt", False),
+    (["log?.txt"], "log12.txt", False),
+    # character classes
+    (["data[0-9].csv"], "data7.csv", True),
+    (["data[0-9].csv"], "datax.csv", False),
+    (["data[!0-9].csv"], "datax.csv", True),
+    (["data[!0-9].csv"], "data7.csv", False),
+    (["[ab]/*.txt"], "b/n.txt", True),
+    (["[ab]/*.txt"], "c/n.txt", False),
+    # "**" spans any number of folders, including none
+    (["reports/**/*.csv"], "reports/q.csv", True),
+    (["reports/**/*.csv"], "reports/2026/01/q.csv", True),
+    (["reports/**/*.csv"], "reports/2026/q.txt", False),
+    (["reports/**/*.csv"], "other/q.csv", False),
+    (["**/build/*.log"], "build/x.log", True),
+    (["**/build/*.log"], "a/b/build/x.log", True),
+    (["**/build/*.log"], "a/b/build2/x.log", False),
+    (["logs/**"], "logs/a/b/c.log", True),
+    (["logs/**"], "logs", False),
+    # a rule on a folder covers its whole subtree, literal or glob
+    (["docs"], "docs/a/b/c.txt", True),
+    (["docs/"], "docs/a.txt", True),
+    (["docs/"], "docs", True),
+    (["docs/"], "docs2/a.txt", False),
+    (["docs/*"], "docs/sub/deep/file.bin", True),
+    (["projects/*/public/"], "projects/x/public/img/logo.png", True),
+    (["projects/*/public/"], "projects/x/private/key.pem", False),
+    (["*-shared"], "team-shared/notes/todo.txt", True),
+    # negation, with the later rule winning either way
+    (["docs/", "!docs/secret.txt"], "docs/secret.txt", False),
+    (["docs/", "!docs/secret.txt"], "docs/public.txt", True),
+    (["!docs/secret.txt", "docs/"], "docs/secret.txt", True),
+    (["docs/", "!docs/private/"], "docs/private/x/y.txt", False),
+    (["docs/", "!docs/private/", "docs/private/ok.txt"], "docs/private/ok.txt", True),
+    (["docs/", "!docs/private/", "docs/private/ok.txt"], "docs/private/no.txt", False),
+    (["*", "!*.key"], "certs/server.key", False),
+    (["*", "!*.key"], "certs/server.crt", True),
+    (["*", "!*.key", "certs/server.key"], "certs/server.key", True),
+    (["!*.key"], "a.key", False),
+    (["*.log", "!debug.log"], "debug.log", False),
+    (["*.log", "!debug.log"], "sub/debug.log", True),
+    # directives are not access rules
+    (["@cache-control *.iso public"], "a.iso", False),
+    (["@upload incoming/"], "incoming/a.txt", False),
+    # no rules at all denies everything
+    ([], "a.txt", False),
+    # always denied, whatever the rules say
+    (["*"], "allowed_files.txt", False),
+    (["allowed_files.txt"], "allowed_files.txt", False),
+    (["*"], "users.ini", False),
+    (["users.ini"], "users.ini", False),
+    (["*"], ".pfss-upload-0123.part", False),
+    (["incoming/"], "incoming/.pfss-upload-0123.part", False),
+    (["*.part"], "deep/.pfss-upload-0123.part", False),
+    (["*"], "sub/allowed_files.txt", True),
+    (["*"], "sub/users.ini", True),
+]
+
+
+@pytest.fixture(scope="module")
+def share(tmp_path_factory):
+    root = tmp_path_factory.mktemp("share")
+    (root / "users.ini").write_text("")
+    return harness.load_server(str(root), [], PASSWORD, SHARE_USERS_FILE=str(root / "users.ini"),
+                               SHARE_SEARCH="0", SHARE_INDEX="0")
+
+
+@pytest.mark.parametrize("rules, path, expected", CASES)
+def test_access(share, rules, path, expected):
+    compiled = share.CompiledRules(rules, protected=share.PROTECTED_PATHS)
+    assert compiled.allows(path) is expected
+
+
+@pytest.mark.parametrize("rules, path, expected", [
+    (["@cache-control *.iso public, max-age=86400"], "isos/x.iso", "public, max-age=86400"),
+    (["@cache-control *.iso public", "@cache-control big/ no-store"], "big/x.iso", "no-store"),
+    (["@cache-control big/ no-store", "@cache-control *.iso public"], "big/x.iso", "public"),
+    (["@cache-control *.iso public"], "x.img", None),
+])
+def test_cache_control(share, rules, path, expected):
+    assert share.CompiledRules(rules).cache_policy(path) == expected
+
+
+@pytest.mark.parametrize("rules, path, expected", [
+    (["*", "@upload incoming/"], "incoming/a/b.txt", True),
+    (["*", "@upload incoming/"], "a.txt", False),
+    (["*", "@upload incoming/", "@upload !incoming/*.exe"], "incoming/x.exe", False),
+    (["@upload incoming/"], "incoming/a.txt", False),
+    (["*", "!incoming/", "@upload incoming/"], "incoming/a.txt", False),
+    (["*", "@upload *"], ".pfss-upload-0123.part", False),
+])
+def test_upload(share, rules, path, expected):
+    compiled = share.CompiledRules(rules, protected=share.PROTECTED_PATHS)
+    assert compiled.allows_upload(path) is expected
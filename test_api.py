@@ -0,0 +1,41 @@
+"""
+Tests for the JSON API: /api/list and /api/stat describe a file the same
+way.
+
+    python -m pytest -q test_api.py
+"""
+
+import pytest
+
+import harness
+
+PASSWORD = "test"
+PNG = b"\x89PNG\r\n\x1a\n" + bytes(64)
+
+
+@pytest.fixture
+def client(tmp_path):
+    (tmp_path / "a.txt").write_text("hello\n")
+    (tmp_path / "picture").write_bytes(PNG)
+    (tmp_path / "blob.bin").write_bytes(PNG)
+    module = harness.load_server(str(tmp_path), ["a.txt", "picture", "blob.bin"], PASSWORD, SHARE_INDEX="0")
+    return harness.login(module, PASSWORD)
+
+
+def listed_mime(client):
+    return {item["name"]: item["mime"] for item in client.get("/api/list").get_json()["items"]}
+
+
+def test_list_mime_matches_stat(client):
+    # Listing reads no file contents: types that need sniffing are unknown at first
+    assert listed_mime(client) == {"a.txt": "text/plain", "picture": None, "blob.bin": None}
+    stats = {name: client.get(f"/api/stat/{name}").get_json()["mime"] for name in ("a.txt", "picture", "blob.bin")}
+    assert stats == {"a.txt": "text/plain", "picture": "image/png", "blob.bin": "image/png"}
+    assert listed_mime(client) == stats
+
+
+def test_rewritten_file_is_sniffed_again(client, tmp_path):
+    client.get("/api/stat/picture")
+    (tmp_path / "picture").write_bytes(b"%PDF-1.7\n" + bytes(64))
+    assert listed_mime(client)["picture"] is None
+    assert client.get("/api/stat/picture").get_json()["mime"] == "application/pdf"
@@ -0,0 +1,199 @@
+"""
+Tests for /download: byte ranges, conditional GET and If-Range, checked
+against the bytes of a local fixture file, plus a large sendfile transfer
+through the ``serve`` launcher.
+
+Each fixture loads a private copy of main.py pointed at a temporary share
+through harness.py, the same way bench.py does.
+
+    python -m pytest -q test_downloads.py
+"""
+
+import time
+import random
+import asyncio
+import urllib.parse
+import urllib.request
+from email.utils import formatdate
+
+import pytest
+from werkzeug.wsgi import FileWrapper
+
+import harness
+
+PASSWORD = "test"
+PAYLOAD = random.Random(9).randbytes(100_000)
+
+
+@pytest.fixture(scope="module")
+def share(tmp_path_factory):
+    root = tmp_path_factory.mktemp("share")
+    with open(root / "payload.bin", "wb") as f:
+        f.write(PAYLOAD)
+    return harness.load_server(str(root), ["payload.bin"], PASSWORD)
+
+
+@pytest.fixture(scope="module")
+def sendfile_share(tmp_path_factory):
+    root = tmp_path_factory.mktemp("sendfile")
+    with open(root / "payload.bin", "wb") as f:
+        f.write(PAYLOAD)
+    return harness.load_server(str(root), ["payload.bin"], PASSWORD,
+                               SHARE_DOWNLOAD_MODE="sendfile", SHARE_API_TOKENS="test-token")
+
+
+@pytest.fixture
+def client(share):
+    return harness.login(share, PASSWORD)
+
+
+def download(client, **headers):
+    response = client.get("/download/payload.bin", headers=headers, buffered=True)
+    response.close()
+    return response
+
+
+def test_full_download(client):
+    response = download(client)
+    assert response.status_code == 200
+    assert response.headers["Accept-Ranges"] == "bytes"
+    assert response.content_length == len(PAYLOAD)
+    assert response.get_data() == PAYLOAD
+    assert response.headers["ETag"].startswith('"')
+
+
+@pytest.mark.parametrize("spec, start, stop", [
+    ("bytes=0-0", 0, 1),
+    ("bytes=100-199", 100, 200),
+    ("bytes=99000-", 99000, len(PAYLOAD)),
+    ("bytes=-500", len(PAYLOAD) - 500, len(PAYLOAD)),
+    ("bytes=99990-200000", 99990, len(PAYLOAD)),
+])
+def test_single_range(client, spec, start, stop):
+    response = download(client, Range=spec)
+    assert response.status_code == 206
+    assert response.headers["Content-Range"] == f"bytes {start}-{stop - 1}/{len(PAYLOAD)}"
+    assert response.content_length == stop - start
+    assert response.get_data() == PAYLOAD[start:stop]
+
+
+def test_multipart_ranges(client):
+    response = download(client, Range="bytes=0-9,500-599,-16")
+    assert response.status_code == 206
+    assert response.mimetype == "multipart/byteranges"
+    body = response.get_data()
+    assert response.content_length == len(body)
+
+    boundary = response.mimetype_params["boundary"].encode()
+    parts = body.split(b"--" + boundary)
+    assert parts[0] == b"" and parts[-1] == b"--\r\n"
+    expected = [(0, 10), (500, 600), (len(PAYLOAD) - 16, len(PAYLOAD))]
+    assert len(parts[1:-1]) == len(expected)
+    for part, (start, stop) in zip(parts[1:-1], expected):
+        head, _, data = part.partition(b"\r\n\r\n")
+        assert f"Content-Range: bytes {start}-{stop - 1}/{len(PAYLOAD)}".encode() in head
+        assert data.removesuffix(b"\r\n") == PAYLOAD[start:stop]
+
+
+@pytest.mark.parametrize("spec", ["bytes=100000-", "bytes=200000-300000"])
+def test_unsatisfiable_range(client, spec):
+    response = download(client, Range=spec)
+    assert response.status_code == 416
+    assert response.headers["Content-Range"] == f"bytes */{len(PAYLOAD)}"
+
+
+def test_if_none_match(client):
+    etag = download(client).headers["ETag"]
+    response = download(client, **{"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.get_data() == b""
+    assert download(client, **{"If-None-Match": '"other"'}).status_code == 200
+
+
+def test_if_modified_since(client):
+    last_modified = download(client).headers["Last-Modified"]
+    assert download(client, **{"If-Modified-Since": last_modified}).status_code == 304
+    assert download(client, **{"If-Modified-Since": formatdate(0, usegmt=True)}).status_code == 200
+
+
+def test_if_match(client):
+    etag = download(client).headers["ETag"]
+    assert download(client, **{"If-Match": etag}).status_code == 200
+    assert download(client, **{"If-Match": '"stale"'}).status_code == 412
+
+
+def test_if_range(client):
+    first = download(client)
+    current = download(client, Range="bytes=0-99", **{"If-Range": first.headers["ETag"]})
+    assert current.status_code == 206
+    assert current.get_data() == PAYLOAD[:100]
+
+    # A stale validator means the client's copy is outdated: send the whole file
+    for stale in ('"stale"', formatdate(0, usegmt=True)):
+        response = download(client, Range="bytes=0-99", **{"If-Range": stale})
+        assert response.status_code == 200
+        assert response.get_data() == PAYLOAD
+
+
+def asgi_get(module, path, headers):
+    """Run one GET through module.asgi_app; returns (status, headers, body)."""
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    scope = {"type": "http", "method": "GET", "path": path, "query_string": b"",
+             "headers": [(k.lower().encode(), v.encode()) for k, v in headers.items()]}
+    asyncio.run(module.asgi_app(scope, receive, send))
+    start = messages[0]
+    body = b"".join(m.get("body", b"") for m in messages[1:])
+    return start["status"], {k.decode(): v.decode() for k, v in start["headers"]}, body
+
+
+@pytest.mark.parametrize("spec, start, stop", [
+    ("bytes=100-199", 100, 200),
+    ("bytes=-500", len(PAYLOAD) - 500, len(PAYLOAD)),
+])
+def test_sendfile_range_through_asgi(sendfile_share, spec, start, stop):
+    status, headers, body = asgi_get(sendfile_share, "/download/payload.bin",
+                                     {"Authorization": "Bearer test-token", "Range": spec})
+    assert status == 206
+    assert int(headers["content-length"]) == len(body) == stop - start
+    assert body == PAYLOAD[start:stop]
+
+
+def test_sendfile_range_with_unbounded_wrapper(sendfile_share):
+    # werkzeug's FileWrapper has no length bound and would read to end of file
+    client = sendfile_share.app.test_client()
+    response = client.get("/download/payload.bin", environ_base={"wsgi.file_wrapper": FileWrapper},
+                          headers={"Authorization": "Bearer test-token", "Range": "bytes=100-199"})
+    assert response.status_code == 206
+    assert response.get_data() == PAYLOAD[100:200]
+
+
+def test_sendfile_through_serve_launcher(tmp_path):
+    """
+    A multi-MB download through ``main.py serve`` in sendfile mode, read by
+    a slow client so the server's socket buffer fills up mid-transfer.
+    """
+    big = random.Random(13).randbytes(5_000_000)
+    (tmp_path / "big.bin").write_bytes(big)
+    harness.write_rules(str(tmp_path), ["big.bin"])
+    with harness.launcher(str(tmp_path), PASSWORD, "--workers", "1",
+                          SHARE_DOWNLOAD_MODE="sendfile") as (_, port):
+        base = f"http://127.0.0.1:{port}"
+        session = urllib.request.build_opener(urllib.request.HTTPCookieProcessor())
+        session.open(base + "/", data=urllib.parse.urlencode({"pw": PASSWORD}).encode()).close()
+        with session.open(base + "/download/big.bin") as response:
+            assert response.headers["Content-Length"] == str(len(big))
+            chunks = []
+            while True:
+                chunk = response.read(256 * 1024)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                time.sleep(0.02)
+        assert b"".join(chunks) == big
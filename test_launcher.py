@@ -0,0 +1,66 @@
+"""
+Tests for the ``serve`` pre-fork launcher: start-up failures and crash
+loops have to stay in the master instead of multiplying processes.
+
+    python -m pytest -q test_launcher.py
+"""
+
+import os
+import sys
+import time
+import socket
+import signal
+import subprocess
+
+import pytest
+
+import harness
+
+PASSWORD = "test"
+
+
+def run_serve(root, *args):
+    """Start ``main.py serve`` and return the process; output goes to a pipe."""
+    return subprocess.Popen(
+        [sys.executable, harness.MAIN_PATH, "serve", "--host", "127.0.0.1", *args],
+        env=dict(os.environ, **harness.server_env(root, PASSWORD, SHARE_SEARCH="0", SHARE_INDEX="0")),
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+
+
+@pytest.fixture
+def root(tmp_path):
+    harness.write_rules(str(tmp_path), ["*"])
+    return str(tmp_path)
+
+
+def test_port_in_use_fails_at_startup(root):
+    with socket.socket() as taken:
+        taken.bind(("127.0.0.1", 0))
+        taken.listen()
+        port = taken.getsockname()[1]
+        process = run_serve(root, "--port", str(port), "--workers", "2")
+        output, _ = process.communicate(timeout=30)
+    assert process.returncode == 1
+    assert "cannot listen on" in output
+    assert "Master" not in output
+
+
+def test_bad_host_fails_at_startup(root):
+    process = run_serve(root, "--host", "256.0.0.1", "--port", "8080")
+    output, _ = process.communicate(timeout=30)
+    assert process.returncode == 1
+    assert "cannot listen on" in output
+
+
+def test_crashing_worker_backs_off(root):
+    # A worker that cannot start (an empty thread pool raises) must be
+    # respawned by the one master, with a growing delay
+    process = run_serve(root, "--port", str(harness.free_port()), "--workers", "1", "--threads", "0")
+    time.sleep(4)
+    process.send_signal(signal.SIGTERM)
+    output, _ = process.communicate(timeout=30)
+    assert output.count("Master") == 1
+    delays = [float(line.rsplit(" ", 1)[1].rstrip("s"))
+              for line in output.splitlines() if "restarting in" in line]
+    assert 2 <= len(delays) <= 4
+    assert delays == sorted(delays) and delays[-1] > delays[0]
@@ -0,0 +1,62 @@
+"""
+Tests for /metrics: the page has to be valid Prometheus text exposition,
+including on a cold process where no cache has been written yet.
+
+    python -m pytest -q test_metrics.py
+"""
+
+import re
+
+import pytest
+
+import harness
+
+PASSWORD = "test"
+
+NAME = r"[a-zA-Z_:][a-zA-Z0-9_:]*"
+LABELS = rf'\{{(?:[a-zA-Z_][a-zA-Z0-9_]*="(?:[^"\\\n]|\\.)*",?)*\}}'
+VALUE = r"[-+]?(?:\d+(?:\.\d*)?(?:[eE][-+]?\d+)?|\.\d+|Inf|NaN)"
+SAMPLE = re.compile(rf"({NAME})(?:{LABELS})? ({VALUE})(?: -?\d+)?")
+COMMENT = re.compile(rf"# (?:HELP {NAME} .*|TYPE {NAME} (?:counter|gauge|histogram|summary|untyped))")
+
+
+def parse_exposition(text):
+    """Return {metric name: [values]}; fails on any line Prometheus would reject."""
+    samples = {}
+    for number, line in enumerate(text.splitlines(), 1):
+        if not line:
+            continue
+        if line.startswith("#"):
+            assert COMMENT.fullmatch(line), f"line {number}: {line!r}"
+            continue
+        match = SAMPLE.fullmatch(line)
+        assert match, f"line {number}: {line!r}"
+        samples.setdefault(match.group(1), []).append(float(match.group(2)))
+    return samples
+
+
+@pytest.fixture
+def share(tmp_path):
+    (tmp_path / "a.txt").write_text("hello\n")
+    return harness.load_server(str(tmp_path), ["a.txt"], PASSWORD, SHARE_METRICS="1")
+
+
+def test_requires_login(share):
+    assert share.app.test_client().get("/metrics").status_code == 401
+
+
+def test_cold_process_is_valid_exposition(share):
+    client = harness.login(share, PASSWORD)
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.mimetype == "text/plain"
+    samples = parse_exposition(response.get_data(as_text=True))
+    assert samples["pfss_compressed_cache_bytes"] == [0.0]
+
+
+def test_valid_after_traffic(share):
+    client = harness.login(share, PASSWORD)
+    for path in ("/list", "/download/a.txt", "/download/missing.txt", "/api/list"):
+        client.get(path, buffered=True)
+    samples = parse_exposition(client.get("/metrics").get_data(as_text=True))
+    assert sum(samples["pfss_requests_total"]) >= 4
@@ -0,0 +1,86 @@
+"""
+Tests for resolve_request_path() and PathResolver: malformed paths,
+symlinks leaving their folder, the depth cap, and folders that change
+after they were resolved.
+
+    python -m pytest -q test_paths.py
+"""
+
+import os
+
+import pytest
+from werkzeug.exceptions import HTTPException
+
+import harness
+
+PASSWORD = "test"
+
+
+@pytest.fixture
+def share(tmp_path):
+    root = tmp_path / "share"
+    (root / "docs" / "sub").mkdir(parents=True)
+    (root / "docs" / "a.txt").write_text("a")
+    (root / "docs" / "sub" / "b.txt").write_text("b")
+    (root / "other").mkdir()
+    (root / "other" / "c.txt").write_text("c")
+    (tmp_path / "outside.txt").write_text("outside")
+    (root / "docs" / "alias.txt").symlink_to("a.txt")
+    (root / "docs" / "escape.txt").symlink_to(tmp_path / "outside.txt")
+    (root / "docs" / "sideways.txt").symlink_to(root / "other" / "c.txt")
+    (root / "docs" / "link").symlink_to(root / "other")
+    deep = root / "deep"
+    for i in range(4):
+        deep = deep / f"d{i}"
+    deep.mkdir(parents=True)
+    (deep / "f.txt").write_text("deep")
+    return harness.load_server(str(root), ["docs/", "other/", "deep/"], PASSWORD,
+                               SHARE_MAX_DEPTH="4", SHARE_SEARCH="0", SHARE_INDEX="0")
+
+
+def status(module, path, kind=None):
+    with module.app.test_request_context():
+        try:
+            module.resolve_request_path(path, kind)
+        except HTTPException as e:
+            return e.code
+    return 200
+
+
+@pytest.mark.parametrize("path", ["docs/../other/c.txt", "..", "docs/./a.txt", "docs//a.txt",
+                                  "docs\\a.txt", "docs/a.txt\0", ""])
+def test_malformed_path_is_400(share, path):
+    assert status(share, path) == 400
+
+
+def test_allowed_paths_resolve(share):
+    assert status(share, "docs/a.txt", "file") == 200
+    assert status(share, "docs/sub", "folder") == 200
+    assert status(share, "docs/sub/", "folder") == 200
+    assert status(share, "docs/sub", "file") == 404
+    assert status(share, "docs/missing.txt") == 404
+
+
+def test_symlink_may_rename_but_not_move(share):
+    assert status(share, "docs/alias.txt", "file") == 200
+    assert status(share, "docs/escape.txt") == 404
+    assert status(share, "docs/sideways.txt") == 404
+    assert status(share, "docs/link/c.txt") == 404
+
+
+def test_depth_cap(share):
+    assert status(share, "deep/d0/d1/d2") == 200
+    assert status(share, "deep/d0/d1/d2/d3") == 404
+    assert status(share, "deep/d0/d1/d2/d3/f.txt") == 404
+
+
+def test_replaced_folder_is_resolved_again(share):
+    # A cached folder swapped for a symlink out of its parent must not
+    # keep resolving once the change has been seen
+    root = share.BASE_DIR
+    assert status(share, "docs/sub/b.txt", "file") == 200
+    os.rename(os.path.join(root, "docs", "sub"), os.path.join(root, "docs", "moved"))
+    os.symlink(os.path.join(root, "other"), os.path.join(root, "docs", "sub"))
+    share.LISTING_CACHE.invalidate(os.path.join(root, "docs"))
+    assert status(share, "docs/sub/c.txt") == 404
+    assert status(share, "docs/moved/b.txt", "file") == 200
@@ -0,0 +1,48 @@
+"""
+Tests for the streamed text preview (/view): the requested window, and a
+file truncated to nothing before its preview is rendered.
+
+    python -m pytest -q test_preview.py
+"""
+
+import pytest
+
+import harness
+
+PASSWORD = "test"
+LINES = "".join(f"line {i}\n" for i in range(1000))
+
+
+@pytest.fixture
+def share(tmp_path):
+    (tmp_path / "log.txt").write_text(LINES)
+    (tmp_path / "empty.txt").write_text("")
+    return harness.load_server(str(tmp_path), ["*.txt"], PASSWORD, SHARE_SEARCH="0", SHARE_INDEX="0")
+
+
+@pytest.fixture
+def client(share):
+    return harness.login(share, PASSWORD)
+
+
+def test_preview_window(client):
+    body = client.get("/view/log.txt?offset=7&length=14").get_data(as_text=True)
+    assert "line 1\nline 2\n" in body
+    assert "line 3\n" not in body
+
+
+def test_tail_starts_at_a_line(client):
+    body = client.get("/view/log.txt?tail=1&length=20").get_data(as_text=True)
+    assert ">line 998\nline 999\n<" in body
+
+
+def test_empty_file(client):
+    assert client.get("/view/empty.txt").status_code == 200
+
+
+def test_file_truncated_before_rendering(share, tmp_path):
+    # The body is rendered after the size was taken; mmap() refuses empty files
+    f = open(tmp_path / "log.txt", "rb")
+    (tmp_path / "log.txt").write_text("")
+    assert list(share.iter_text_chunks(f, 0, 100)) == []
+    assert f.closed
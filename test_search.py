@@ -0,0 +1,63 @@
+"""
+Tests for the search index: a full build, and folders rescanned after a
+change being applied to the live index.
+
+    python -m pytest -q test_search.py
+"""
+
+import os
+import shutil
+
+import pytest
+
+import harness
+
+PASSWORD = "test"
+
+
+@pytest.fixture
+def index(tmp_path):
+    for path in ("docs/report.txt", "docs/old/notes.txt", "secret/report.txt"):
+        (tmp_path / path).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / path).write_text(path)
+    module = harness.load_server(str(tmp_path), ["docs/"], PASSWORD)
+    index = module.SearchIndex()
+    index._watcher = module.Inotify(index._on_change)
+    index.build()
+    return index
+
+
+def found(index, query):
+    return sorted(path for path, _ in index.search(query)[1])
+
+
+def rescan(index, *folders):
+    for folder in folders:
+        batch = index._rescan(os.path.realpath(folder))
+        assert batch is not None
+        with index._lock:
+            index.table.apply(batch)
+
+
+def test_build_indexes_allowed_paths(index):
+    assert found(index, "report") == ["docs/report.txt"]
+    assert found(index, "notes") == ["docs/old/notes.txt"]
+
+
+def test_rescan_applies_changes(index, tmp_path):
+    (tmp_path / "docs" / "new").mkdir()
+    (tmp_path / "docs" / "new" / "plan.txt").write_text("plan")
+    (tmp_path / "docs" / "report.txt").rename(tmp_path / "docs" / "summary.txt")
+    shutil.rmtree(tmp_path / "docs" / "old")
+    rescan(index, tmp_path / "docs")
+
+    assert found(index, "docs/") == ["docs/new", "docs/new/plan.txt", "docs/summary.txt"]
+    assert index.table.dead == 3
+    # The new folder is tracked, so a change inside it is picked up too
+    (tmp_path / "docs" / "new" / "more.txt").write_text("more")
+    rescan(index, tmp_path / "docs" / "new")
+    assert "docs/new/more.txt" in found(index, "more")
+
+
+def test_rescan_of_unindexed_folder(index, tmp_path):
+    assert index._rescan(os.path.realpath(tmp_path / "secret")) is None
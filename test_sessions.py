@@ -0,0 +1,91 @@
+"""
+Tests for server-side sessions and the private state directories: a
+cookie stops working everywhere once its session is logged out or
+revoked, and a state directory someone else could write to is refused.
+
+    python -m pytest -q test_sessions.py
+"""
+
+import os
+import sys
+import subprocess
+
+import pytest
+
+import harness
+
+PASSWORD = "test"
+
+
+@pytest.fixture
+def share(tmp_path):
+    (tmp_path / "a.txt").write_text("a")
+    return harness.load_server(str(tmp_path), ["a.txt"], PASSWORD, SHARE_SEARCH="0", SHARE_INDEX="0")
+
+
+def copy_session(module, client):
+    """A second client presenting the same session cookie, as a stolen copy would."""
+    name = module.app.config["SESSION_COOKIE_NAME"]
+    copy = module.app.test_client()
+    copy.set_cookie(name, client.get_cookie(name).value)
+    return copy
+
+
+def test_cookie_is_opaque_and_works(share):
+    client = harness.login(share, PASSWORD)
+    cookie = client.get_cookie(share.app.config["SESSION_COOKIE_NAME"]).value
+    assert len(cookie) == 43 and "." not in cookie
+    assert copy_session(share, client).get("/api/list").status_code == 200
+
+
+def test_logout_revokes_copied_cookie(share):
+    client = harness.login(share, PASSWORD)
+    copy = copy_session(share, client)
+    assert copy.get("/api/list").status_code == 200
+    client.get("/logout")
+    assert copy.get("/api/list").status_code == 401
+
+
+def test_login_rotates_session(share):
+    client = harness.login(share, PASSWORD)
+    before = copy_session(share, client)
+    client.post("/", data={"pw": PASSWORD})
+    assert before.get("/api/list").status_code == 401
+    assert client.get("/api/list").status_code == 200
+
+
+def test_revoke_sessions_command(share, tmp_path):
+    clients = [harness.login(share, PASSWORD) for _ in range(3)]
+    result = subprocess.run([sys.executable, harness.MAIN_PATH, "revoke-sessions"],
+                            env=dict(os.environ, **harness.server_env(str(tmp_path), PASSWORD)),
+                            capture_output=True, text=True, timeout=60)
+    assert result.returncode == 0, result.stderr
+    assert "Revoked 3 sessions" in result.stdout
+    for client in clients:
+        assert client.get("/api/list").status_code == 401
+
+
+def test_private_dir_is_created_0700(share, tmp_path):
+    path = str(tmp_path / "state" / "new")
+    assert share.private_dir(path) == path
+    assert os.stat(path).st_mode & 0o777 == 0o700
+
+
+@pytest.mark.parametrize("mode", [0o770, 0o702, 0o777])
+def test_private_dir_refuses_writable_by_others(share, tmp_path, mode):
+    path = tmp_path / "shared"
+    path.mkdir()
+    path.chmod(mode)
+    with pytest.raises(SystemExit) as excinfo:
+        share.private_dir(str(path))
+    assert "not writable by group or others" in str(excinfo.value)
+
+
+@pytest.mark.skipif(os.geteuid() != 0, reason="needs root to chown")
+def test_private_dir_refuses_foreign_owner(share, tmp_path):
+    path = tmp_path / "planted"
+    path.mkdir(mode=0o700)
+    os.chown(path, 65534, 65534)
+    with pytest.raises(SystemExit) as excinfo:
+        share.private_dir(str(path))
+    assert "owned by uid 65534" in str(excinfo.value)
@@ -0,0 +1,132 @@
+"""
+Tests for /api/uploads: chunks in any order, digest checks, resuming,
+expiry, and the write permission and overwrite rules.
+
+    python -m pytest -q test_uploads.py
+"""
+
+import time
+import base64
+import hashlib
+
+import pytest
+
+import harness
+
+PASSWORD = "test"
+RULES = ["*", "@upload incoming/", "@upload !incoming/*.exe"]
+DATA = b"0123456789abcdefghij"
+CHUNK = 8
+
+
+def load(root, **env):
+    (root / "incoming").mkdir(exist_ok=True)
+    (root / "incoming" / "old.txt").write_text("old\n")
+    (root / "readonly.txt").write_text("read only\n")
+    return harness.load_server(str(root), RULES, PASSWORD, SHARE_UPLOADS="1", **env)
+
+
+@pytest.fixture
+def share(tmp_path):
+    return load(tmp_path)
+
+
+@pytest.fixture
+def client(share):
+    return harness.login(share, PASSWORD)
+
+
+def digest(data):
+    return {"Content-Digest": f"sha-256=:{base64.b64encode(hashlib.sha256(data).digest()).decode()}:"}
+
+
+def create(client, path="incoming/new.bin", data=DATA, **body):
+    return client.post("/api/uploads", json={"path": path, "size": len(data), "chunk_size": CHUNK,
+                                             "sha256": hashlib.sha256(data).hexdigest(), **body})
+
+
+def put_chunk(client, upload_id, index, data=DATA, body=None):
+    chunk = data[index * CHUNK:(index + 1) * CHUNK]
+    return client.put(f"/api/uploads/{upload_id}/{index}", data=chunk if body is None else body,
+                      headers=digest(chunk))
+
+
+def test_chunks_in_any_order(share, client, tmp_path):
+    upload = create(client).get_json()
+    assert upload["chunks"] == 3
+    for index in (2, 0, 1):
+        assert put_chunk(client, upload["id"], index).status_code == 200
+    response = client.post(f"/api/uploads/{upload['id']}/complete")
+    assert response.status_code == 201
+    assert response.get_json()["size"] == len(DATA)
+    assert (tmp_path / "incoming" / "new.bin").read_bytes() == DATA
+    assert not list((tmp_path / "incoming").glob(".pfss-upload-*"))
+    assert client.get(f"/api/uploads/{upload['id']}").status_code == 404
+
+
+def test_digest_mismatch_is_not_recorded(client):
+    upload = create(client).get_json()
+    response = put_chunk(client, upload["id"], 0, body=b"X" * CHUNK)
+    assert response.status_code == 400
+    assert client.get(f"/api/uploads/{upload['id']}").get_json()["received"] == []
+    missing = client.put(f"/api/uploads/{upload['id']}/0", data=DATA[:CHUNK])
+    assert missing.status_code == 400
+
+
+def test_resume_after_interruption(client, tmp_path):
+    upload = create(client).get_json()
+    put_chunk(client, upload["id"], 1)
+    response = client.post(f"/api/uploads/{upload['id']}/complete")
+    assert response.status_code == 409
+    assert response.get_json()["missing"] == [0, 2]
+
+    # A client that lost its state asks what is there and sends the rest
+    status = client.get(f"/api/uploads/{upload['id']}").get_json()
+    assert status["received"] == [1]
+    for index in set(range(status["chunks"])) - set(status["received"]):
+        assert put_chunk(client, upload["id"], index).status_code == 200
+    assert client.post(f"/api/uploads/{upload['id']}/complete").status_code == 201
+    assert (tmp_path / "incoming" / "new.bin").read_bytes() == DATA
+
+
+def test_whole_file_sha256_is_checked(client, tmp_path):
+    upload = create(client, sha256=hashlib.sha256(b"other").hexdigest()).get_json()
+    for index in range(upload["chunks"]):
+        put_chunk(client, upload["id"], index)
+    response = client.post(f"/api/uploads/{upload['id']}/complete")
+    assert response.status_code == 409
+    assert not (tmp_path / "incoming" / "new.bin").exists()
+
+
+def test_idle_upload_expires(share, client, tmp_path):
+    upload = create(client).get_json()
+    put_chunk(client, upload["id"], 0)
+    share.UPLOAD_STORE.sweep(now=time.time() + share.UPLOAD_TTL - 60)
+    assert client.get(f"/api/uploads/{upload['id']}").status_code == 200
+
+    share.UPLOAD_STORE.sweep(now=time.time() + share.UPLOAD_TTL + 1)
+    assert client.get(f"/api/uploads/{upload['id']}").status_code == 404
+    assert put_chunk(client, upload["id"], 1).status_code == 404
+    assert not list((tmp_path / "incoming").glob(".pfss-upload-*"))
+
+
+@pytest.mark.parametrize("path", ["readonly.txt", "incoming/tool.exe", "allowed_files.txt"])
+def test_upload_needs_write_rule(client, path):
+    assert create(client, path=path).status_code == 403
+
+
+def test_overwrite_is_refused_by_default(client, tmp_path):
+    assert create(client, path="incoming/old.txt").status_code == 409
+    response = create(client, path="incoming/old.txt", overwrite=True)
+    assert response.status_code == 403
+    assert (tmp_path / "incoming" / "old.txt").read_text() == "old\n"
+
+
+def test_overwrite_when_enabled(tmp_path):
+    client = harness.login(load(tmp_path, SHARE_UPLOAD_OVERWRITE="1"), PASSWORD)
+    assert create(client, path="incoming/old.txt").status_code == 409
+    upload = create(client, path="incoming/old.txt", overwrite=True).get_json()
+    for index in range(upload["chunks"]):
+        put_chunk(client, upload["id"], index)
+    assert client.post(f"/api/uploads/{upload['id']}/complete").status_code == 201
+    assert (tmp_path / "incoming" / "old.txt").read_bytes() == DATA
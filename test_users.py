@@ -0,0 +1,95 @@
+"""
+Tests for SHARE_USERS_FILE: per-user and per-group rules on top of
+allowed_files.txt, their precedence, and logging out removed users.
+
+    python -m pytest -q test_users.py
+"""
+
+import pytest
+
+import harness
+
+PASSWORD = "shared"
+FILES = ["public.txt", "logs/a.log", "logs/private/b.log", "home/alice/x.txt", "home/bob/y.txt"]
+
+
+def users_ini(module, *names):
+    sections = {
+        "group:ops": "rules =\n    logs/\n    !logs/private/\n",
+        # alice's own rule comes after the group's, so it wins
+        "user:alice": "groups = ops\nrules =\n    home/alice/\n    logs/private/\n",
+        "user:bob": "groups = ops\nrules = home/bob/\n",
+        "user:carol": "",
+        "user:dave": "",
+    }
+    text = "[group:ops]\n" + sections["group:ops"]
+    for name in names:
+        # Every user's password is their name
+        text += f"\n[{name}]\npassword = {module.hash_password(name[5:])}\n" + sections[name]
+    return text
+
+
+@pytest.fixture
+def share(tmp_path):
+    root = tmp_path / "share"
+    for path in FILES:
+        (root / path).parent.mkdir(parents=True, exist_ok=True)
+        (root / path).write_text(path)
+    users = tmp_path / "users.ini"
+    users.write_text("")
+    module = harness.load_server(str(root), ["public.txt"], PASSWORD, SHARE_USERS_FILE=str(users))
+    users.write_text(users_ini(module, "user:alice", "user:bob", "user:carol", "user:dave"))
+    module.USER_DIRECTORY.reload(force=True)
+    module.users_path = users
+    return module
+
+
+def visible(client):
+    return {path for path in FILES if client.get(f"/download/{path}", buffered=True).status_code == 200}
+
+
+def test_shared_password_sees_allowed_files_only(share):
+    assert visible(harness.login(share, PASSWORD)) == {"public.txt"}
+
+
+@pytest.mark.parametrize("user, expected", [
+    ("alice", {"public.txt", "logs/a.log", "logs/private/b.log", "home/alice/x.txt"}),
+    ("bob", {"public.txt", "logs/a.log", "home/bob/y.txt"}),
+    ("carol", {"public.txt"}),
+])
+def test_per_user_rules_and_group_precedence(share, user, expected):
+    assert visible(harness.login(share, user, user=user)) == expected
+
+
+def test_wrong_password_for_user(share):
+    assert visible(harness.login(share, "bob", user="alice")) == set()
+
+
+def test_identical_rule_lists_share_one_compiled_set(share):
+    directory = share.USER_DIRECTORY
+    assert directory.rules_for("carol") is directory.rules_for("dave")
+    assert directory.rules_for("alice") is not directory.rules_for("bob")
+
+
+def test_compiled_rules_are_dropped_with_old_versions(share):
+    directory = share.USER_DIRECTORY
+    for rules in (["public.txt"], ["public.txt", "logs/"], ["public.txt"]):
+        harness.write_rules(share.BASE_DIR, rules)
+        share.ACCESS_INDEX.reload(force=True)
+        for name in ("alice", "bob", "carol", "dave"):
+            directory.rules_for(name)
+        assert len(directory._by_items) == 3
+    assert directory.rules_for("carol").allows("public.txt")
+    assert not directory.rules_for("carol").allows("logs/a.log")
+
+
+def test_removed_user_is_logged_out(share):
+    alice = harness.login(share, "alice", user="alice")
+    bob = harness.login(share, "bob", user="bob")
+    assert alice.get("/api/list").status_code == 200
+
+    share.users_path.write_text(users_ini(share, "user:bob", "user:carol"))
+    share.USER_DIRECTORY.reload(force=True)
+    assert alice.get("/api/list").status_code == 401
+    assert alice.get("/download/home/alice/x.txt").status_code != 200
+    assert bob.get("/api/list").status_code == 200